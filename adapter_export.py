@@ -0,0 +1,195 @@
+from common import (
+    MAX_LORA_RANK,
+    MODEL_NAME,
+    MODEL_PATH,
+    VOL_MOUNT_PATH,
+    HOURS,
+    find_latest_version,
+    output_vol,
+    training_image,
+    app,
+)
+
+import json
+import shutil
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import List
+
+from incremental_training import prune_optimizer_states
+
+EXPORT_FILE = "export.json"  # written once a checkpoint is exported; its presence skips re-validation
+ADAPTER_WEIGHTS = "adapter_model.safetensors"  # PEFT format, what vLLM and peft load
+ADAPTER_CONFIG = "adapter_config.json"
+TRAINING_WEIGHTS = "adapter_model.pt"  # torchtune format, only needed to warm-start from the latest checkpoint
+SERVING_DTYPE = "bfloat16"  # vLLM serves LoRA weights in the base model's dtype
+REQUIRED_CONFIG_KEYS = ("r", "lora_alpha", "target_modules")
+
+
+@dataclass
+class AdapterExport:
+    """A checkpoint as exported for serving."""
+    path: str
+    dtype: str
+    tensors: int
+    adapter_bytes: int  # what a server reads to load the adapter
+    removed_bytes: int  # base-model copies, training-only files and stale optimizer states deleted
+    load_seconds: float
+    tokenizer_path: str  # the shared tokenizer assets the adapter is served with
+    base_model: str
+
+
+def validate_adapter_config(config: dict) -> dict:
+    """Check a PEFT adapter config can be served and fill in the fields vLLM and peft expect.
+
+    Raises:
+        ValueError: If the config is missing LoRA parameters or its rank exceeds MAX_LORA_RANK
+    """
+    missing = [key for key in REQUIRED_CONFIG_KEYS if key not in config]
+    if missing:
+        raise ValueError(f"Adapter config is missing {', '.join(missing)}")
+    if config["r"] > MAX_LORA_RANK:
+        raise ValueError(f"Adapter rank {config['r']} exceeds the serving limit of {MAX_LORA_RANK}")
+    config.setdefault("base_model_name_or_path", MODEL_NAME)
+    config.setdefault("task_type", "CAUSAL_LM")
+    config.setdefault("peft_type", "LORA")
+    return config
+
+
+def _tree_bytes(path: Path) -> int:
+    if path.is_file():
+        return path.stat().st_size
+    return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+
+
+def strip_checkpoint(checkpoint_dir: Path, keep_training_weights: bool) -> int:
+    """Delete everything a server does not need from a checkpoint; returns the bytes freed.
+
+    torchtune copies the base model's tokenizer, configs and licence into
+    every checkpoint; adapters are served with the base model's tokenizer
+    instead, so those copies are dropped.
+    """
+    keep = {ADAPTER_WEIGHTS, ADAPTER_CONFIG, EXPORT_FILE}
+    if keep_training_weights:
+        keep.add(TRAINING_WEIGHTS)
+    removed = 0
+    for entry in checkpoint_dir.iterdir():
+        if entry.name in keep:
+            continue
+        removed += _tree_bytes(entry)
+        if entry.is_dir():
+            shutil.rmtree(entry)
+        else:
+            entry.unlink()
+    return removed
+
+
+def save_export(export: AdapterExport):
+    with open(Path(export.path) / EXPORT_FILE, "w") as f:
+        json.dump(asdict(export), f, indent=2)
+
+
+def export_adapter(checkpoint_dir: Path, keep_training_weights: bool = True, tokenizer_path: Path = MODEL_PATH) -> AdapterExport:
+    """Export a checkpoint for serving: compact weights in SERVING_DTYPE, a validated config and no copied assets.
+
+    Already exported checkpoints are not re-validated or rewritten; only
+    their training weights are dropped once they are no longer needed.
+
+    Args:
+        checkpoint_dir: An `epoch_N` directory written by the recipe
+        keep_training_weights: Keep the torchtune-format weights for warm starts
+        tokenizer_path: Shared tokenizer assets to serve the adapter with
+
+    Returns:
+        Size and load time of the exported adapter
+    """
+    import torch
+    from safetensors.torch import load_file, save_file
+
+    export_path = checkpoint_dir / EXPORT_FILE
+    if export_path.exists():
+        with open(export_path) as f:
+            export = AdapterExport(**json.load(f))
+        freed = strip_checkpoint(checkpoint_dir, keep_training_weights)
+        if freed:
+            export.removed_bytes += freed
+            save_export(export)
+        return export
+
+    config_path = checkpoint_dir / ADAPTER_CONFIG
+    with open(config_path) as f:
+        config = validate_adapter_config(json.load(f))
+    with open(config_path, "w") as f:
+        json.dump(config, f, indent=2)
+
+    weights_path = checkpoint_dir / ADAPTER_WEIGHTS
+    dtype = getattr(torch, SERVING_DTYPE)
+    tensors = load_file(weights_path)
+    if any(t.is_floating_point() and t.dtype != dtype for t in tensors.values()):
+        tensors = {k: t.to(dtype) if t.is_floating_point() else t for k, t in tensors.items()}
+        tmp_path = weights_path.with_suffix(".tmp")
+        save_file({k: t.contiguous() for k, t in tensors.items()}, tmp_path, metadata={"format": "pt"})
+        tmp_path.replace(weights_path)
+
+    removed = strip_checkpoint(checkpoint_dir, keep_training_weights)
+
+    start = time.perf_counter()
+    loaded = load_file(weights_path)
+    load_seconds = time.perf_counter() - start
+
+    export = AdapterExport(
+        path=str(checkpoint_dir),
+        dtype=SERVING_DTYPE,
+        tensors=len(loaded),
+        adapter_bytes=weights_path.stat().st_size + config_path.stat().st_size,
+        removed_bytes=removed,
+        load_seconds=load_seconds,
+        tokenizer_path=str(tokenizer_path),
+        base_model=config["base_model_name_or_path"],
+    )
+    save_export(export)
+    return export
+
+
+def export_user_adapters(output_dir: Path) -> List[AdapterExport]:
+    """Export every checkpoint of a user's adapter, keeping training weights and optimizer state only for the latest.
+
+    The optimizer states deleted are counted in the latest export's `removed_bytes`.
+    """
+    latest = find_latest_version(output_dir)
+    freed = prune_optimizer_states(output_dir, keep=latest)
+    exports = []
+    for checkpoint_dir in sorted(output_dir.glob("epoch_*")):
+        if not (checkpoint_dir / ADAPTER_WEIGHTS).exists():
+            continue
+        export = export_adapter(checkpoint_dir, keep_training_weights=checkpoint_dir.name == latest)
+        if freed and checkpoint_dir.name == latest:
+            export.removed_bytes += freed
+            save_export(export)
+        print(
+            f"{checkpoint_dir}: {export.adapter_bytes / 1e6:.1f} MB {export.dtype}, "
+            f"loads in {export.load_seconds * 1000:.0f} ms, {export.removed_bytes / 1e6:.1f} MB removed"
+        )
+        exports.append(export)
+    return exports
+
+
+@app.function(
+    image=training_image,
+    volumes={VOL_MOUNT_PATH: output_vol},
+    timeout=2 * HOURS,
+)
+def export_all_adapters() -> List[dict]:
+    """Export every adapter on the volume, e.g. those trained before checkpoints were exported."""
+    exports = []
+    for output_dir in sorted(VOL_MOUNT_PATH.glob("*/*/model")):
+        try:
+            exports += export_user_adapters(output_dir)
+        except Exception as e:
+            print(f"Could not export {output_dir}: {e}")
+        output_vol.commit()
+    total = sum(e.adapter_bytes for e in exports)
+    freed = sum(e.removed_bytes for e in exports)
+    print(f"Exported {len(exports)} checkpoints: {total / 1e9:.2f} GB of adapters, {freed / 1e9:.2f} GB freed")
+    return [asdict(e) for e in exports]
@@ -1,17 +1,23 @@
+import asyncio
 import os
 import json
 import time
-import requests
-import subprocess
 import re
 # When hunks are very large, truncate before sending to the LLM to avoid exceeding token limits.
+from dataclasses import asdict
 from pathlib import Path
 from typing import AsyncIterator, Optional, List, Dict, Any, Tuple
 from token_db import store_token
-from token_db import load_token
+from token_db import validated_token
 from fastapi.responses import HTMLResponse
-from github_actions import review_and_comment, post_github_comment, write_status_comment
-from github_pr_scraper import get_user_model_path
+from github_app import get_installation_token
+from github_client import close_async_github_client, connection_stats, get_async_github_client
+from github_actions import review_pull_request_async, write_status_comment_async
+from pr_snapshot import PRSnapshot, fetch_incremental_snapshot, fetch_pr_snapshot
+from review_state import load_last_reviewed_sha, load_pending_hunks, record_reviewed_sha
+from review_jobs import ReviewJob, load_job
+from single_flight import coalesce_spawns, flight_key, run_single_flight
+from delivery_dedup import DeliveryDeduplicator
 
 
 from common import (
@@ -19,23 +25,40 @@ from common import (
     output_vol,
     app,
     VOL_MOUNT_PATH,
+    REVIEW_JOB_TIMEOUT,
 )
 
-from fintuning import finetune
-from inference import Inference
-from github_pr_scraper import scrape
+from inference_metrics import load_snapshots, render_prometheus
 
 import modal
 
+if modal.is_local():
+    # Register the pipeline's functions with the app when deploying. Containers
+    # import these modules only on the code paths that call them, so the web
+    # function's cold start does not pay for them.
+    import fintuning  # noqa: F401
+    import github_pr_scraper  # noqa: F401
+    import inference  # noqa: F401
+
 
 # API Endpoint
-web_image = base_image.pip_install("fastapi", "uvicorn", "cryptography.fernet", "requests", "PyJWT")
+web_image = base_image.pip_install("fastapi", "uvicorn", "cryptography.fernet", "requests", "httpx[http2]", "PyJWT")
+web_secrets = [
+    modal.Secret.from_name("encryption-key"),
+    modal.Secret.from_name("github-oauth"),
+    modal.Secret.from_name("github_app_private_key"),
+    modal.Secret.from_name("app-id"),
+]
+
+MAX_PANEL_SIZE = 5  # reviewers emulated in a single panel review
+
 
 class WebhookContext:
     def __init__(self, payload: dict):
         self.comment = payload.get("comment", {})
         self.issue = payload.get("issue", {})
         self.repository = payload.get("repository", {})
+        self.installation_id = payload.get("installation", {}).get("id")
         
         self.commenter = self.comment.get("user", {}).get("login")
         self.body = self.comment.get("body", "")
@@ -43,120 +66,174 @@ class WebhookContext:
         self.repo_name = self.repository.get("name")
         self.pr_number = self.issue.get("number")
         
-        # Extract requested user from comment
-        requested_user = self.body.split(" ")[1].strip()
-        self.requested_user = requested_user if requested_user else self.commenter
+        # Extract requested reviewers from comment: "@tech-lead-bot alice [bob carol] [--force-reload]"
+        mention = self.body.split("@tech-lead-bot", 1)[-1].strip().splitlines()
+        requested_users = []
+        for word in (mention[0] if mention else "").split():
+            user = word.lstrip("@")
+            if word.startswith("--") or not user or user in requested_users:
+                continue
+            requested_users.append(user)
+        self.requested_users = requested_users[:MAX_PANEL_SIZE] or [self.commenter]
+        self.requested_user = self.requested_users[0]
 
         if "--force-reload" in self.body:
             self.force_reload = True
         else:
             self.force_reload = False
+        # Warm-start existing adapters on comments made since they were trained
+        self.incremental = "--refresh" in self.body and not self.force_reload
 
 
-processed_deliveries = set()
-        
+deliveries = DeliveryDeduplicator()
+
 
 @app.function(
     image=web_image,
     volumes={VOL_MOUNT_PATH: output_vol},
-    secrets=[modal.Secret.from_name("encryption-key"), modal.Secret.from_name("github-oauth"), modal.Secret.from_name("github_app_private_key"), modal.Secret.from_name("app-id")],
+    secrets=web_secrets,
+    timeout=REVIEW_JOB_TIMEOUT,
+)
+async def process_review_job(job_id: str):
+    """Run a queued review job: scrape, fine-tune, then review the PR.
+
+    Spawned by the webhook, which has already acknowledged the delivery. Every
+    stage transition is persisted so `/jobs/{job_id}` can report progress.
+    """
+    from fintuning import finetune, finetune_batch
+    from github_pr_scraper import scrape
+    from model_provisioning import ensure_model_provisioned
+
+    output_vol.reload()
+    job = load_job(job_id)
+    if job is None:
+        raise Exception(f"No job {job_id}")
+    if job.finished:
+        print(f"Job {job_id} already {job.status}")
+        return
+    if not await asyncio.to_thread(deliveries.claim_job, job_id):
+        # A duplicate delivery accepted at the same moment spawned this job twice
+        print(f"Job {job_id} was already started by another call")
+        return
+
+    installation_token = None
+    try:
+        installation_token = await get_installation_token(job.repo_owner, job.repo_name, job.installation_id)
+        await write_status_comment_async(job.repo_owner, job.repo_name, job.pr_number, "Thinking...", installation_token)
+
+        # Scrape and train every requested reviewer in parallel. Work for a
+        # (user, repo) already in flight for another PR is joined, not repeated.
+        job.set_status("scraping")
+
+        def spawn_scrape(user: str):
+            return scrape.spawn.aio(
+                username=user,
+                repo_owner=job.repo_owner,
+                repo_name=job.repo_name,
+                force_reload=job.force_reload,
+                incremental=job.incremental,
+                pr_number=job.pr_number,
+                commenter=job.commenter,
+                token=installation_token)
+
+        counts = await asyncio.gather(*[
+            run_single_flight(flight_key("scrape", job.repo_owner, job.repo_name, user), lambda user=user: spawn_scrape(user))
+            for user in job.requested_users
+        ])
+        job.samples = dict(zip(job.requested_users, counts))
+
+        reviewers = []
+        for user, count in job.samples.items():
+            print(f"Scraped {count} comments for {user}")
+            if count == -1:
+                await write_status_comment_async(job.repo_owner, job.repo_name, job.pr_number, f"User {user} already exists. Skipping fine-tuning.", installation_token)
+            if count != 0:
+                reviewers.append(user)
+
+        if not reviewers:
+            job.set_status("done")
+            return
+
+        job.set_status("training")
+
+        def spawn_finetune(user: str):
+            return finetune.spawn.aio(
+                username=user,
+                repo_owner=job.repo_owner,
+                repo_name=job.repo_name,
+                force_reload=job.force_reload,
+                incremental=job.incremental)
+
+        if len(reviewers) > 1:
+            # Reviewers not already in flight train together on one base model load
+            spawn_finetune = coalesce_spawns(lambda users: finetune_batch.spawn.aio(
+                adapters=[(user, job.repo_name) for user in users],
+                repo_owner=job.repo_owner,
+                force_reload=job.force_reload,
+                incremental=job.incremental))
+
+        await asyncio.gather(*[
+            run_single_flight(flight_key("finetune", job.repo_owner, job.repo_name, user), lambda user=user: spawn_finetune(user))
+            for user in reviewers
+        ])
+
+        print("Finished fine-tuning")
+
+        # Training can outlive the installation token; the cache re-mints it if it is near expiry
+        job.set_status("reviewing")
+        # Inference replicas refuse to start without the base model rather than download it themselves
+        await ensure_model_provisioned()
+        installation_token = await get_installation_token(job.repo_owner, job.repo_name, job.installation_id)
+        await webhook_functionality(
+            repo_owner=job.repo_owner,
+            repo_name=job.repo_name,
+            pr_number=job.pr_number,
+            commenter=job.commenter,
+            requested_user=reviewers[0],
+            token=installation_token,
+            requested_users=reviewers,
+            full_review=job.force_reload
+        )
+        job.set_status("done")
+    except Exception as e:
+        job.set_status("failed", error=str(e))
+        if installation_token is not None:
+            await write_status_comment_async(job.repo_owner, job.repo_name, job.pr_number, "Something went wrong. Please try again.", installation_token)
+        raise
+
+
+@app.function(
+    image=web_image,
+    volumes={VOL_MOUNT_PATH: output_vol},
+    secrets=web_secrets,
+    allow_concurrent_inputs=100,
 )
 @modal.asgi_app()
 def api():
     from fastapi import FastAPI, HTTPException, Request
-    from fastapi.responses import HTMLResponse, RedirectResponse
+    from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
     from pydantic import BaseModel
     from cryptography.fernet import Fernet
     import urllib.parse
-    import base64
-    from jwt import encode
+    from contextlib import asynccontextmanager
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        yield
+        await close_async_github_client()
 
-    app = FastAPI(title="GitHub Code Review Bot")
+    app = FastAPI(title="GitHub Code Review Bot", lifespan=lifespan)
     
     # Load client info
     client_id = os.environ["GITHUB_CLIENT_ID"]
     client_secret = os.environ["GITHUB_CLIENT_SECRET"]
     fernet = Fernet(os.environ["ENCRYPTION_KEY"])
 
-    def get_installation_token(repo_owner: str, repo_name: str):
-        # Get these from your GitHub App settings
-        app_id = os.environ["APP_ID"]
-        private_key = base64.b64decode(os.environ["GITHUB_APP_PRIVATE_KEY"]).decode()
-        
-        # Generate JWT
-        now = int(time.time())
-        payload = {
-            "iat": now,
-            "exp": now + 600,  # 10 minutes
-            "iss": app_id
-        }
-        jwt_token = encode(payload, private_key, algorithm="RS256")
-
-        headers = {
-            "Authorization": f"Bearer {jwt_token}",
-            "Accept": "application/vnd.github.v3+json"
-        }
-        response = requests.get(
-            "https://api.github.com/app/installations",
-            headers=headers
-        )  
-        installations = response.json()
-
-        # Find the installation for this repository
-        for installation in installations:
-            if installation["account"]["login"] == repo_owner:
-                # Get repositories for this installation
-                installation_id = installation["id"]
-
-                token_response = requests.post(
-                    f"https://api.github.com/app/installations/{installation_id}/access_tokens",
-                    headers=headers
-                )
-
-                installation_token = token_response.json()["token"]
-                
-                # Use the correct endpoint for getting installation repositories
-                repo_headers = {
-                    "Authorization": f"Bearer {installation_token}",
-                    "Accept": "application/vnd.github.v3+json"
-                }
-                repo_response = requests.get(
-                    f"https://api.github.com/installation/repositories",  # Changed this URL
-                    headers=repo_headers
-                )
-                
-                repos = repo_response.json().get("repositories", [])
-                if not repos:
-                    repos = repo_response.json()
-                
-                # Check if this repository is in the installation
-                for repo in repos:
-                    if repo["name"] == repo_name:
-                        return installation_token
-                
-        raise Exception(f"No installation found for {repo_owner}/{repo_name}")
-    
-
     async def authenticate_user(context: WebhookContext) -> tuple[bool, str]:
         """Authenticate user and return (is_authenticated, token_or_auth_url)"""
-        token = load_token(context.commenter)
-        print("token: ", token)
-
+        token = await validated_token(context.commenter)
         if token:
-            # Verify token is still valid
-            try:
-                print("Loaded token. verifying.")
-                response = requests.get(
-                    "https://api.github.com/user",
-                    headers={
-                        "Authorization": f"token {token}",
-                        "Accept": "application/vnd.github.v3+json"
-                    }
-                )
-                if response.status_code == 200:
-                    return True, token
-            except:
-                pass
+            return True, token
 
         # Create OAuth URL with state
         state = fernet.encrypt(
@@ -192,16 +269,6 @@ def api():
         if not delivery_id:
             return {"status": "ignored", "reason": "no delivery ID"}
         
-        if delivery_id in processed_deliveries:
-            print(f"Ignoring duplicate webhook delivery: {delivery_id}")
-            return {"status": "ignored", "reason": "duplicate delivery"}
-        
-        processed_deliveries.add(delivery_id)
-        
-        if len(processed_deliveries) > 100:
-            processed_deliveries.clear()
-        
-
         payload = await request.json()
         event = request.headers.get("X-GitHub-Event")
         
@@ -215,77 +282,48 @@ def api():
             return {"status": "ignored", "reason": "bot not mentioned"}
 
         context = WebhookContext(payload)
-        installation_token = get_installation_token(context.repo_owner, context.repo_name)
-
-
         print(f"Processing webhook for {context.commenter} on PR #{context.pr_number}")
 
-        # is_authenticated, auth_result = await authenticate_user(context)
-        
-        # print("is_authenticated: ", is_authenticated)
-        # print("auth_result: ", auth_result)
-
-        # if not is_authenticated:
-        #     html_content = f"""
-        #     <html>
-        #         <head>
-        #             <title>GitHub Authorization</title>
-        #             <script>
-        #                 window.open("{auth_result}", "_blank");
-        #             </script>
-        #         </head>
-        #         <body>
-        #             <p>Opening GitHub authorization page in a new tab...</p>
-        #             <p>If the page doesn't open automatically, <a href="{auth_result}" target="_blank">click here</a>.</p>
-        #         </body>
-        #     </html>
-        #     """
-            
-        #     write_status_comment(context.repo_owner, context.repo_name, context.pr_number, f"@{context.commenter} Please authorize the bot by clicking this link: {auth_result}", installation_token)
-                
-        #     return HTMLResponse(content=html_content)
- 
-        # User is authenticated, proceed with bot functionality
-        try:
-            write_status_comment(context.repo_owner, context.repo_name, context.pr_number, "Thinking...", installation_token)
-
-            count = scrape.remote(
-                username=context.requested_user, 
-                repo_owner=context.repo_owner, 
-                repo_name=context.repo_name, 
-                force_reload=context.force_reload, 
-                pr_number=context.pr_number, 
-                commenter=context.commenter, 
-                token=installation_token)
-            
-            print(f"Scraped {count} comments for {context.requested_user}")
-
-            if count == -1:
-                write_status_comment(context.repo_owner, context.repo_name, context.pr_number, "User already exists. Skipping fine-tuning.", installation_token)
-            elif count == 0:
-                return {"status": "success", "samples": 0}
-
-            finetune.remote(
-                username=context.requested_user,
-                repo_owner= context.repo_owner, 
-                repo_name=context.repo_name, 
-                force_reload=context.force_reload)
-            
-            print("Finished fine-tuning")
-
-            webhook_functionality(
-                repo_owner=context.repo_owner,
-                repo_name=context.repo_name,
-                pr_number=context.pr_number,
-                commenter=context.commenter,
-                requested_user=context.requested_user,
-                token=installation_token
-            )
+        if await asyncio.to_thread(deliveries.seen, delivery_id):
+            # A redelivery of a delivery we already enqueued reports the existing job
+            await asyncio.to_thread(output_vol.reload)
+            existing = await asyncio.to_thread(load_job, delivery_id)
+            if existing is not None:
+                return JSONResponse(status_code=202, content={"status": existing.status, "job_id": existing.job_id})
+            print(f"Ignoring duplicate webhook delivery: {delivery_id}")
+            return {"status": "ignored", "reason": "duplicate delivery"}
 
-            return {"status": "success", "samples": count}
-        except Exception as e:
-            write_status_comment(context.repo_owner, context.repo_name, context.pr_number, "Something went wrong. Please try again.", installation_token)
-            raise HTTPException(status_code=500, detail=str(e))
+        # Acknowledge immediately; scraping, training and reviewing run in the background.
+        # The job is keyed by the delivery ID, so a duplicate accepted concurrently writes the same job.
+        job = ReviewJob(
+            job_id=delivery_id,
+            repo_owner=context.repo_owner,
+            repo_name=context.repo_name,
+            pr_number=context.pr_number,
+            commenter=context.commenter,
+            requested_users=context.requested_users,
+            force_reload=context.force_reload,
+            incremental=context.incremental,
+            installation_id=context.installation_id,
+        )
+        try:
+            await asyncio.to_thread(job.save)
+            await process_review_job.spawn.aio(job.job_id)
+        except Exception:
+            # Nothing was enqueued, so let GitHub's redelivery of this event through
+            await asyncio.to_thread(deliveries.forget, delivery_id)
+            raise
+
+        return JSONResponse(status_code=202, content={"status": job.status, "job_id": job.job_id, "status_url": f"/jobs/{job.job_id}"})
+
+    @app.get("/jobs/{job_id}")
+    async def job_status(job_id: str):
+        """Report the progress of a review job enqueued by the webhook."""
+        await asyncio.to_thread(output_vol.reload)
+        job = await asyncio.to_thread(load_job, job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Unknown job")
+        return asdict(job)
 
     @app.get("/auth/github/callback")
     @app.post("/auth/github/callback")
@@ -303,7 +341,7 @@ def api():
             commenter, repo_owner, repo_name, pr_number = state_data.split(":")
             
             # Exchange code for token
-            resp = requests.post(
+            resp = await get_async_github_client().post(
                 "https://github.com/login/oauth/access_token",
                 headers={"Accept": "application/json"},
                 data={
@@ -316,12 +354,15 @@ def api():
             if resp.status_code != 200:
                 raise HTTPException(status_code=resp.status_code, detail="Token exchange failed")
             
-            access_token = resp.json().get("access_token")
+            token_data = resp.json()
+            access_token = token_data.get("access_token")
             if not access_token:
                 raise HTTPException(status_code=400, detail="No access token returned")
 
-            # Store the token
-            store_token(commenter, access_token)
+            # Store the token, with its refresh token when the app issues expiring tokens
+            await asyncio.to_thread(
+                store_token, commenter, access_token, token_data.get("refresh_token"), token_data.get("expires_in")
+            )
             print("storing token")  
             return {"status": "success", "message": "User authenticated. You may now close this tab, and return to the PR."}
 
@@ -329,6 +370,20 @@ def api():
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
 
+    @app.get("/metrics")
+    async def metrics():
+        """Prometheus scrape endpoint merging the snapshots every Inference replica dumps to the volume."""
+        from fastapi.responses import PlainTextResponse
+
+        def load_live_snapshots():
+            output_vol.reload()
+            snapshots = load_snapshots(prune=True)
+            output_vol.commit()
+            return snapshots
+
+        snapshots = await asyncio.to_thread(load_live_snapshots)
+        return PlainTextResponse(render_prometheus(snapshots), media_type="text/plain; version=0.0.4")
+
     @app.get("/test")
     async def test():
         return {"message": "Test endpoint working"}
@@ -337,33 +392,80 @@ def api():
 
 
 
-def webhook_functionality(
+async def webhook_functionality(
     repo_owner: str,
     repo_name: str,
     pr_number: int,
     commenter: str,
     requested_user: str,
-    token: str
+    token: str,
+    requested_users: Optional[List[str]] = None,
+    full_review: bool = False
 ):
-    """Review code and post a comment in one go."""
-    # Get PR file content
-    headers = {
-        "Authorization": f"token {token}",
-        "Accept": "application/vnd.github.v3+json"
-    }
-
-    files_url = f"https://api.github.com/repos/{repo_owner}/{repo_name}/pulls/{pr_number}/files"
-
-    print("Fetching PR files from:", files_url)
-    resp = requests.get(files_url, headers=headers)
-
-    if resp.status_code != 200:
-        raise Exception(f"Failed to fetch PR files: {resp.status_code} - {resp.text}")
-    files = resp.json()
-    # Schedule review and comments for each file
-    for f in files:
-        file_path = f.get("filename")
-        print("writing a comment on this file: ", file_path)
-        review_and_comment(requested_user, repo_owner, repo_name, pr_number, file_path, commenter, token)
+    """Review code and post a comment in one go.
+
+    Hunks are triaged, then generated and posted through an asyncio pipeline
+    so GPU and GitHub latency overlap. With more than one entry in
+    `requested_users`, the PR is reviewed as a panel and requests for all
+    reviewers' adapters share the replica's batches.
+
+    Each reviewer's last reviewed head SHA is recorded, so later invocations
+    only review hunks changed since then unless `full_review` is set. Hunks
+    the triage budget left out are recorded with it and carried into the
+    next review.
+    """
+    snapshot = await asyncio.to_thread(fetch_pr_snapshot, repo_owner, repo_name, pr_number, token)
+    usernames = requested_users or [requested_user]
+
+    def review_states() -> Dict[str, Tuple[Optional[str], Tuple[str, ...]]]:
+        output_vol.reload()
+        if full_review:
+            return {username: (None, ()) for username in usernames}
+        return {
+            username: (
+                load_last_reviewed_sha(repo_owner, repo_name, pr_number, username),
+                tuple(sorted(load_pending_hunks(repo_owner, repo_name, pr_number, username))),
+            )
+            for username in usernames
+        }
+
+    # Group reviewers by what they have left to review, so a panel shares one comparison
+    by_base: Dict[Tuple[Optional[str], Tuple[str, ...]], List[str]] = {}
+    up_to_date = []
+    for username, (base_sha, pending) in (await asyncio.to_thread(review_states)).items():
+        if base_sha == snapshot.head_sha and not pending:
+            up_to_date.append(username)
+            continue
+        by_base.setdefault((base_sha, pending), []).append(username)
+    if up_to_date:
+        print(f"PR #{pr_number} already reviewed as {', '.join(up_to_date)} at {snapshot.head_sha}")
+        await write_status_comment_async(
+            repo_owner, repo_name, pr_number,
+            f"No new changes since {snapshot.head_sha[:7]}, already reviewed as {', '.join(up_to_date)}. Add `--force-reload` for a full review.",
+            token)
+
+    for (base_sha, pending), reviewers in by_base.items():
+        target = snapshot
+        if base_sha == snapshot.head_sha:
+            target = PRSnapshot(repo_owner, repo_name, pr_number, snapshot.head_sha, [])
+        elif base_sha is not None:
+            target = await asyncio.to_thread(fetch_incremental_snapshot, snapshot, base_sha, token)
+        if target is None:
+            target = snapshot
+        elif target is not snapshot and pending:
+            # Hunks the budget left out last time are still unreviewed
+            target = target.with_hunks(snapshot, pending)
+        print(f"Reviewing {len(target.hunks())} hunk(s) in {len(target.files)} file(s) as {', '.join(reviewers)}")
+        report = await review_pull_request_async(reviewers, target, token)
+        if report["total"]["failed"]:
+            # Leave the last reviewed head in place so the failed hunks are retried next time
+            print(f"{report['total']['failed']} hunk review(s) failed, not recording {snapshot.head_sha} as reviewed")
+            continue
+        over_budget = report["total"]["over_budget"]
+        if over_budget:
+            print(f"{len(over_budget)} hunk(s) over the budget will be reviewed next time")
+        for username in reviewers:
+            await asyncio.to_thread(record_reviewed_sha, repo_owner, repo_name, pr_number, username, snapshot.head_sha, over_budget)
+
+    print(f"GitHub connections: {connection_stats()}")
     return {"status": "scheduled"}
-    
\ No newline at end of file
@@ -0,0 +1,280 @@
+from common import app
+from github_actions import PendingReview, review_pull_request_async
+from inference import Inference, LocalInference
+from inference_metrics import Histogram
+from pr_snapshot import PRSnapshot
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+from typing import List, Optional
+
+
+DEFAULT_REVIEWERS = ["alice", "bob", "carol", "dave"]
+PANEL_FRACTION = 0.3  # share of PRs that ask for a panel of two or three reviewers
+FILE_EXTENSIONS = [".py", ".ts", ".go", ".java", ".rs"]
+CODE_LINES = [
+    "result = compute(value, options)",
+    "if not items:",
+    "    return None",
+    "for index, item in enumerate(items):",
+    "logger.info(\"processing %s\", item)",
+    "cache[key] = value",
+    "raise ValueError(\"unexpected state\")",
+    "total += item.size * factor",
+]
+
+
+def synthetic_hunk(rng: random.Random, new_start: int, num_lines: int) -> str:
+    """Build a unified diff hunk with a mix of context, removed and added lines."""
+    kinds = rng.choices([" ", "-", "+"], weights=[4, 1, 3], k=num_lines)
+    if "+" not in kinds:
+        kinds.append("+")
+    body = [f"{kind}{rng.choice(CODE_LINES)}\n" for kind in kinds]
+    old_count = sum(kind != "+" for kind in kinds)
+    new_count = sum(kind != "-" for kind in kinds)
+    return f"@@ -{new_start},{old_count} +{new_start},{new_count} @@\n" + "".join(body)
+
+
+def synthetic_pr(
+    rng: random.Random,
+    pr_number: int,
+    reviewers: List[str],
+    max_files: int = 8,
+    max_hunks: int = 4,
+    max_hunk_lines: int = 40,
+) -> dict:
+    """Build a synthetic PR shaped like the `/pulls/{n}/files` listing.
+
+    File counts, hunk counts and hunk sizes are drawn from skewed
+    distributions so most PRs are small and a few are large. Reviewers are
+    drawn with Zipf-like weights so some adapters are much hotter than others,
+    and some PRs ask for a panel so multi-LoRA batches are exercised.
+    """
+    files = []
+    for i in range(min(max_files, 1 + int(rng.expovariate(1 / 3)))):
+        hunks, line = [], 1
+        for _ in range(rng.randint(1, max_hunks)):
+            line += rng.randint(5, 120)
+            num_lines = min(max_hunk_lines, 2 + int(rng.expovariate(1 / 10)))
+            hunks.append(synthetic_hunk(rng, line, num_lines))
+            line += num_lines
+        files.append({
+            "filename": f"src/module_{pr_number}_{i}{rng.choice(FILE_EXTENSIONS)}",
+            "status": "modified",
+            "patch": "".join(hunks),
+        })
+    weights = [1 / (rank + 1) for rank in range(len(reviewers))]
+    panel_size = rng.randint(2, min(3, len(reviewers))) if len(reviewers) > 1 and rng.random() < PANEL_FRACTION else 1
+    panel: List[str] = []
+    while len(panel) < panel_size:
+        reviewer = rng.choices(reviewers, weights=weights)[0]
+        if reviewer not in panel:
+            panel.append(reviewer)
+    return {"number": pr_number, "reviewers": panel, "files": files}
+
+
+class CommentSink:
+    """Counts what the pipeline would post, optionally simulating GitHub latency."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.posted = 0
+        self.submissions = 0
+        self.lock = threading.Lock()
+
+    def review_for(self, pr: dict) -> "SimulatedReview":
+        return SimulatedReview(self, pr["number"])
+
+
+class SimulatedReview(PendingReview):
+    """A `PendingReview` whose submissions go to a `CommentSink` instead of GitHub."""
+
+    def __init__(self, sink: CommentSink, pr_number: int):
+        super().__init__("bench", "bench", pr_number, token="", head_sha="0" * 40)
+        self.sink = sink
+
+    def _submit_chunk(self, comments: List[dict], body: Optional[str] = None) -> bool:
+        if self.sink.latency:
+            time.sleep(self.sink.latency)
+        with self.sink.lock:
+            self.sink.posted += len(comments)
+            self.sink.submissions += 1
+        return True
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile of `values` for q in [0, 100]."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+async def run_pr(model, pr: dict, sink: CommentSink, repo_owner: str = "bench", repo_name: str = "bench") -> dict:
+    """Review one PR through the production pipeline and return its report."""
+    snapshot = PRSnapshot.from_files(repo_owner, repo_name, pr["number"], "0" * 40, pr["files"])
+    return await review_pull_request_async(pr["reviewers"], snapshot, token="", model=model, review=sink.review_for(pr))
+
+
+def run_benchmark(
+    model,
+    rate_per_min: float,
+    num_prs: int,
+    concurrency: int = 16,
+    reviewers: Optional[List[str]] = None,
+    github_latency: float = 0.0,
+    seed: int = 0,
+    verbose: bool = False,
+) -> dict:
+    """Drive `review_pull_request_async` with synthetic PRs arriving as a Poisson process.
+
+    Every PR goes through triage, micro-batched `review_batch` calls and the
+    posting stage, as on the webhook path. Latency is measured from each
+    PR's scheduled arrival, so time spent waiting for one of the
+    `concurrency` slots counts against it just as a backlog of webhooks would.
+
+    Returns:
+        Throughput, latency percentiles and the model's occupancy metrics
+    """
+    rng = random.Random(seed)
+    prs = [synthetic_pr(rng, n, reviewers or DEFAULT_REVIEWERS) for n in range(1, num_prs + 1)]
+    sink = CommentSink(github_latency)
+    latencies: List[float] = []
+    totals = {"requests": 0, "failed": 0}
+    failures = 0
+
+    async def timed(pr: dict, arrival: float, slots: asyncio.Semaphore):
+        nonlocal failures
+        try:
+            async with slots:
+                report = await run_pr(model, pr, sink)
+        except Exception as e:
+            print(f"PR #{pr['number']} failed: {e}", file=sys.stderr)
+            failures += 1
+            return
+        latencies.append(time.monotonic() - arrival)
+        totals["requests"] += report["total"]["requests"]
+        totals["failed"] += report["total"]["failed"]
+
+    async def drive():
+        slots = asyncio.Semaphore(concurrency)
+        tasks = []
+        arrival = t0
+        for pr in prs:
+            arrival += rng.expovariate(rate_per_min / 60)
+            await asyncio.sleep(max(0.0, arrival - time.monotonic()))
+            tasks.append(asyncio.create_task(timed(pr, arrival, slots)))
+        await asyncio.gather(*tasks)
+
+    output = sys.stdout if verbose else open(os.devnull, "w")
+    t0 = time.monotonic()
+    with contextlib.redirect_stdout(output):
+        asyncio.run(drive())
+    elapsed = time.monotonic() - t0
+
+    hunks = sum(f["patch"].count("\n@@") + 1 for pr in prs for f in pr["files"])
+    occupancy = model.metrics.remote()
+    in_flight = Histogram.from_dict(occupancy["histograms"]["in_flight_requests"])
+    queue_wait = Histogram.from_dict(occupancy["histograms"]["queue_wait_seconds"])
+    ttft = Histogram.from_dict(occupancy["histograms"]["time_to_first_token_seconds"])
+
+    return {
+        "prs": num_prs,
+        "failed_prs": failures,
+        "hunks": hunks,
+        "review_requests": totals["requests"],
+        "failed_requests": totals["failed"],
+        "comments_posted": sink.posted,
+        "review_submissions": sink.submissions,
+        "target_rate_per_min": rate_per_min,
+        "elapsed_s": elapsed,
+        "throughput_prs_per_min": len(latencies) / elapsed * 60,
+        "throughput_hunks_per_s": hunks / elapsed,
+        "latency_p50_s": percentile(latencies, 50),
+        "latency_p95_s": percentile(latencies, 95),
+        "latency_p99_s": percentile(latencies, 99),
+        "inference_requests": occupancy["requests"],
+        "inference_max_in_flight": occupancy["max_in_flight"],
+        "inference_mean_in_flight": in_flight.sum / in_flight.count if in_flight.count else 0.0,
+        "inference_queue_wait_p95_s": queue_wait.quantile(0.95),
+        "inference_ttft_p95_s": ttft.quantile(0.95),
+    }
+
+
+def print_report(report: dict):
+    print("\n=== Review pipeline benchmark ===")
+    for key, value in report.items():
+        print(f"{key:>28}: {value:.3f}" if isinstance(value, float) else f"{key:>28}: {value}")
+
+
+def check_regressions(report: dict, max_p95: Optional[float], min_throughput: Optional[float]) -> List[str]:
+    """Return a message for every threshold the report violates."""
+    problems = []
+    if report["failed_prs"]:
+        problems.append(f"{report['failed_prs']} PR(s) failed")
+    if report["failed_requests"]:
+        problems.append(f"{report['failed_requests']} of {report['review_requests']} hunk review(s) failed to generate")
+    if max_p95 is not None and (report["latency_p95_s"] or 0) > max_p95:
+        problems.append(f"p95 latency {report['latency_p95_s']:.3f}s exceeds {max_p95}s")
+    if min_throughput is not None and report["throughput_prs_per_min"] < min_throughput:
+        problems.append(f"throughput {report['throughput_prs_per_min']:.2f} PRs/min below {min_throughput}")
+    return problems
+
+
+@app.local_entrypoint()
+def bench(rate: float = 30.0, prs: int = 50, concurrency: int = 16, github_latency: float = 0.0, seed: int = 0):
+    """Benchmark the GPU `Inference` class: `modal run benchmark.py --rate 30 --prs 50`.
+
+    Occupancy figures come from whichever replica answers the metrics call.
+    """
+    report = run_benchmark(Inference(), rate, prs, concurrency, github_latency=github_latency, seed=seed)
+    print_report(report)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """CPU-only benchmark against an in-process engine, e.g. for CI regression checks."""
+    parser = argparse.ArgumentParser(description="Benchmark the review pipeline on a local inference backend.")
+    parser.add_argument("--backend", choices=["fake", "cpu"], default="fake")
+    parser.add_argument("--rate", type=float, default=60.0, help="target PR arrival rate per minute")
+    parser.add_argument("--prs", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=16, help="PRs processed at once")
+    parser.add_argument("--token-latency", type=float, default=0.005, help="fake engine seconds per token")
+    parser.add_argument("--max-batch-size", type=int, default=None, help="fake engine concurrent request cap")
+    parser.add_argument("--github-latency", type=float, default=0.0, help="simulated seconds per review submission")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", dest="json_path", help="also write the report to this file")
+    parser.add_argument("--max-p95", type=float, help="fail if p95 PR latency exceeds this many seconds")
+    parser.add_argument("--min-throughput", type=float, help="fail if throughput drops below this many PRs/min")
+    parser.add_argument("--verbose", action="store_true", help="keep the pipeline's own logging")
+    args = parser.parse_args(argv)
+
+    engine_kwargs = {}
+    if args.backend == "fake":
+        engine_kwargs = {"token_latency": args.token_latency, "max_batch_size": args.max_batch_size}
+    model = LocalInference(args.backend, **engine_kwargs)
+
+    report = run_benchmark(
+        model, args.rate, args.prs, args.concurrency,
+        github_latency=args.github_latency, seed=args.seed, verbose=args.verbose,
+    )
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    problems = check_regressions(report, args.max_p95, args.min_throughput)
+    for problem in problems:
+        print(f"REGRESSION: {problem}", file=sys.stderr)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,6 +10,15 @@ WANDB_PROJECT = "github-comment-finetune"
 MINUTES = 60  # seconds
 HOURS = 60 * MINUTES
 REMOTE_CONFIG_PATH = Path("/llama3_1_8B_lora.yaml")
+REMOTE_RECIPE_PATH = Path("/lora_early_stopping.py")
+MAX_LORA_RANK = 32  # largest adapter rank vLLM is configured to serve
+
+# Timeouts of the jobs run through single_flight; its lease must outlast every one of them
+SCRAPE_TIMEOUT = 2 * HOURS
+PROVISION_TIMEOUT = 1 * HOURS
+FINETUNE_TIMEOUT = 2 * HOURS
+FINETUNE_BATCH_TIMEOUT = 8 * HOURS
+REVIEW_JOB_TIMEOUT = SCRAPE_TIMEOUT + max(FINETUNE_TIMEOUT, FINETUNE_BATCH_TIMEOUT) + 1 * HOURS  # waits on both, then reviews
 
 # System prompt for code review
 SYSTEM_PROMPT = """You are {USERNAME}, a developer who writes code review comments on GitHub.
@@ -19,11 +28,14 @@ Be specific, helpful, and focus on important issues. Your tone should be snarky.
 
 app = modal.App(name="github-codereview-bot")
 output_vol = modal.Volume.from_name("github-codereview-vol", create_if_missing=True)
+inflight_jobs = modal.Dict.from_name("github-codereview-inflight", create_if_missing=True)
+processed_deliveries = modal.Dict.from_name("github-codereview-deliveries", create_if_missing=True)
+oauth_tokens = modal.Dict.from_name("github-codereview-oauth-tokens", create_if_missing=True)  # Fernet-encrypted
 
 # Images
 base_image = (
     modal.Image.debian_slim()
-    .pip_install("requests", "pandas", "tqdm", "cryptography",
+    .pip_install("requests", "httpx[http2]", "pandas", "tqdm", "cryptography",
         "fastapi",
         "uvicorn")
 )
@@ -34,6 +46,7 @@ training_image = (
     .apt_install("git")
     .pip_install("git+https://github.com/pytorch/torchtune.git@06a837953a89cdb805c7538ff5e0cc86c7ab44d9")
     .add_local_file(Path(__file__).parent / "llama3_1_8B_lora.yaml", REMOTE_CONFIG_PATH.as_posix())
+    .add_local_file(Path(__file__).parent / "lora_early_stopping.py", REMOTE_RECIPE_PATH.as_posix())
 )
 
 vllm_image = modal.Image.debian_slim(python_version="3.12").pip_install(
@@ -49,6 +62,14 @@ def get_user_model_path(username: str, repo_name: Optional[str] = None) -> Path:
     """Get path to user's model directory"""
     return VOL_MOUNT_PATH / (repo_name or "data") / username / "model"
 
+def get_review_state_path(repo_owner: str, repo_name: str, pr_number: int, username: str) -> Path:
+    """Get path to the record of the last head SHA reviewed as `username` on a PR"""
+    return VOL_MOUNT_PATH / "reviews" / repo_owner / repo_name / str(pr_number) / f"{username}.json"
+
+def get_job_path(job_id: str) -> Path:
+    """Get path to the persisted state of a background review job"""
+    return VOL_MOUNT_PATH / "jobs" / f"{job_id}.json"
+
 def get_user_checkpoint_path(username: str, repo_name: Optional[str] = None, version: Optional[int] = None) -> Path:
     """Get path to specific checkpoint"""
     user_model_path = get_user_model_path(username, repo_name)
@@ -75,4 +96,8 @@ def find_latest_version(directory: Path) -> str:
                 if value > largest:
                     largest = value
 
-    return f"epoch_{largest}"
\ No newline at end of file
+    return f"epoch_{largest}"
+
+def has_adapter(directory: Path) -> bool:
+    """Whether a trained adapter checkpoint exists in directory"""
+    return find_latest_version(directory) not in ("", "epoch_-1")
\ No newline at end of file
@@ -0,0 +1,134 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, Optional
+
+import modal
+
+from common import HOURS, app, base_image, processed_deliveries
+
+DELIVERY_TTL = 72 * HOURS  # GitHub allows redelivering a webhook for three days
+MAX_LOCAL_DELIVERIES = 10_000  # per-container cache in front of the shared store
+TICKET_PREFIX = "ticket:"  # per-delivery key taken by the one job run that processes it
+
+
+class InMemoryDeliveryStore:
+    """Stand-in for the shared `modal.Dict`, e.g. for local runs and tests."""
+
+    def __init__(self):
+        self.data: Dict[str, Any] = {}
+
+    def get(self, key: str, default: Optional[Any] = None) -> Any:
+        return self.data.get(key, default)
+
+    def put(self, key: str, value: Any):
+        self.data[key] = value
+
+    def update(self, **kwargs: Any):
+        self.data.update(kwargs)
+
+    def pop(self, key: str) -> Any:
+        return self.data.pop(key)
+
+    def items(self) -> Iterator:
+        return iter(list(self.data.items()))
+
+
+def _seen_at(entry: Any) -> float:
+    # Entries written by older versions are bare timestamps
+    return entry["seen_at"] if isinstance(entry, dict) else entry
+
+
+class DeliveryDeduplicator:
+    """Remembers webhook delivery IDs across containers for `ttl` seconds.
+
+    Every container keeps a bounded cache of the deliveries it has seen,
+    evicting the least recently recorded first, in front of a store shared
+    by all containers. Redeliveries that land on another container or
+    arrive hours later are still recognised.
+
+    `modal.Dict` has no atomic put-if-absent, so recording is at-least-once:
+    two containers receiving the same delivery at the same moment may both
+    accept it. Acceptance only creates the job keyed by the delivery ID,
+    which is idempotent, and the job itself runs once: recording a delivery
+    also writes a start ticket, and `pop` is atomic, so only one
+    `claim_job` call can take it.
+    """
+
+    def __init__(self, store=processed_deliveries, ttl: float = DELIVERY_TTL, max_local: int = MAX_LOCAL_DELIVERIES):
+        self.store = store
+        self.ttl = ttl
+        self.max_local = max_local
+        self.local: "OrderedDict[str, float]" = OrderedDict()  # delivery_id -> first seen, least recently recorded first
+        self.lock = threading.Lock()
+
+    def _remember(self, delivery_id: str, seen_at: float):
+        # Timestamps from the store can be older than ones already cached, so expiry is checked on lookup
+        self.local[delivery_id] = seen_at
+        self.local.move_to_end(delivery_id)
+        while len(self.local) > self.max_local:
+            self.local.popitem(last=False)
+
+    def _seen_locally(self, delivery_id: str, now: float) -> bool:
+        seen_at = self.local.get(delivery_id)
+        if seen_at is None:
+            return False
+        if seen_at < now - self.ttl:
+            del self.local[delivery_id]
+            return False
+        return True
+
+    def seen(self, delivery_id: str) -> bool:
+        """Record a delivery and its start ticket, returning True if it was already recorded within the TTL."""
+        now = time.time()
+        with self.lock:
+            if self._seen_locally(delivery_id, now):
+                return True
+
+        entry = self.store.get(delivery_id)
+        if entry is not None and _seen_at(entry) >= now - self.ttl:
+            with self.lock:
+                self._remember(delivery_id, _seen_at(entry))
+            return True
+
+        # One round trip; a concurrent duplicate rewrites the same ticket rather than adding one
+        self.store.update(**{delivery_id: {"seen_at": now}, TICKET_PREFIX + delivery_id: {"seen_at": now}})
+        with self.lock:
+            self._remember(delivery_id, now)
+        return False
+
+    def claim_job(self, delivery_id: str) -> bool:
+        """Take the start ticket of a recorded delivery; only one caller ever gets True."""
+        try:
+            self.store.pop(TICKET_PREFIX + delivery_id)
+            return True
+        except KeyError:
+            return False
+
+    def forget(self, delivery_id: str):
+        """Drop a delivery recorded by `seen` whose processing never started, so a redelivery is accepted."""
+        with self.lock:
+            self.local.pop(delivery_id, None)
+        for key in (delivery_id, TICKET_PREFIX + delivery_id):
+            try:
+                self.store.pop(key)
+            except KeyError:
+                pass
+
+    def prune(self) -> int:
+        """Drop expired deliveries from the shared store and return how many were removed."""
+        cutoff = time.time() - self.ttl
+        expired = [delivery_id for delivery_id, entry in self.store.items() if _seen_at(entry) < cutoff]
+        for delivery_id in expired:
+            try:
+                self.store.pop(delivery_id)
+            except KeyError:
+                pass
+        return len(expired)
+
+
+@app.function(image=base_image, schedule=modal.Period(hours=6))
+def prune_deliveries():
+    """Keep the shared delivery store bounded by removing entries past their TTL."""
+    removed = DeliveryDeduplicator().prune()
+    print(f"Pruned {removed} expired webhook deliveries")
@@ -1,146 +1,224 @@
 from common import (
-    MODEL_NAME,
     MODEL_PATH,
     REMOTE_CONFIG_PATH,
+    REMOTE_RECIPE_PATH,
+    find_latest_version,
+    has_adapter,
     get_user_data_path,
     get_user_model_path,
     output_vol,
-    HOURS,
+    FINETUNE_BATCH_TIMEOUT,
+    FINETUNE_TIMEOUT,
     VOL_MOUNT_PATH,
     WANDB_PROJECT,
     training_image,
     app,
 )
+from adapter_export import TRAINING_WEIGHTS, export_user_adapters
+from model_provisioning import ensure_model_provisioned
+from packed_dataset import PACKED_SEQ_LEN, examples_path, prepare_packed_dataset, remove_packed_dataset, without_holdout
+from training_schedule import EARLY_STOPPING_PATIENCE, MAX_EPOCHS, plan_schedule
+from incremental_training import (
+    INCREMENTAL_MAX_EPOCHS,
+    load_trained_hashes,
+    optimizer_state_path,
+    record_trained_examples,
+    select_incremental_examples,
+)
+import asyncio
+import json
 import os
 import subprocess
 import modal
 from modal import Image
-from typing import Optional
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
 from pathlib import Path
 
 
-def download_model():
-    """Download the model using torchtune."""
-    import subprocess
-    import os
+@dataclass
+class TrainingRun:
+    """One adapter's training inputs, prepared by `plan_training_run`."""
+    username: str
+    repo_name: Optional[str]
+    data_path: Path
+    train_path: Path  # data_path, or the new examples plus replay for an incremental run
+    output_dir: Path
+    packed_path: Path  # tokenized cache of train_path, deleted with it
+    examples: List[dict]  # what the adapter is trained on: train_path without the validation holdout
+    overrides: List[str]  # torchtune config overrides specific to this adapter
+
+
+def ensure_base_model():
+    # A missing, partial or corrupt base model is repaired file by file by one shared job, see model_provisioning.py
+    asyncio.run(ensure_model_provisioned())
+
+
+def plan_training_run(username: str, repo_name: Optional[str], force_reload: bool = False, incremental: bool = False, packed: bool = True) -> Optional[TrainingRun]:
+    """Pack a user's scraped data and derive the recipe overrides for training their adapter.
+
+    With `packed=False` the recipe trains on the unpacked examples instead,
+    batched by length to limit padding.
+
+    Returns:
+        The run to train, or None if the existing adapter is kept
+    """
     import shutil
 
-    # Clean up existing model directory if it exists
-    if MODEL_PATH.exists():
-        print(f"Cleaning up existing model directory: {MODEL_PATH}")
-        shutil.rmtree(MODEL_PATH)
-    
-    MODEL_PATH.mkdir(parents=True, exist_ok=True)
-    token = os.getenv("HUGGINGFACE_TOKEN")
-    
-    print(f"Downloading model {MODEL_NAME} to {MODEL_PATH}")
-    try:
-        subprocess.run(
-            [
-                "tune",
-                "download",
-                MODEL_NAME,
-                "--output-dir",
-                MODEL_PATH.as_posix(),
-                "--ignore-patterns",
-                "original/consolidated.00.pth",
-                "--hf-token",  # Changed from --token to --hf-token
-                token,
-            ],
-            check=True  # This will raise an exception if the command fails
-        )
-        
-        # Verify the download
-        print("\nDownloaded files:")
-        for root, dirs, files in os.walk(MODEL_PATH):
-            level = root.replace(str(MODEL_PATH), '').count(os.sep)
-            indent = ' ' * 4 * level
-            print(f"{indent}{os.path.basename(root)}/")
-            subindent = ' ' * 4 * (level + 1)
-            for f in files:
-                print(f"{subindent}{f}")
-        
-        print("\nModel download complete!")
-        
-    except subprocess.CalledProcessError as e:
-        print(f"Error downloading model: {e}")
-        raise
-    except Exception as e:
-        print(f"Unexpected error during model download: {e}")
-        raise
+    data_path = get_user_data_path(username, repo_name)
+    print(f"Data path: {data_path}")
+    output_dir = get_user_model_path(username, repo_name)
+    print(f"Output dir: {output_dir}")
+
+    if has_adapter(output_dir) and not force_reload and not incremental:
+        print(f"Model already exists for {username}/{repo_name}, skipping fine-tuning.")
+        return None
+
+    if force_reload and output_dir.exists():
+        print(f"Removing existing model for {username}/{repo_name}")
+        shutil.rmtree(output_dir)
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    (output_dir / "early_stopping.json").unlink(missing_ok=True)  # left by the previous run
+
+    with open(data_path) as f:
+        examples = json.load(f)
+
+    # New checkpoints are numbered after existing ones, so earlier versions stay servable
+    train_path = data_path
+    train_examples = examples
+    warm_start_args = []
+    max_epochs = MAX_EPOCHS
+    if has_adapter(output_dir):
+        latest = find_latest_version(output_dir)
+        warm_start_args.append(f"epoch_offset={int(latest.split('_')[1]) + 1}")
+        trained = load_trained_hashes(output_dir)
+        if trained is None:
+            print(f"{latest} predates incremental training, retraining from the base model")
+        elif not (output_dir / latest / TRAINING_WEIGHTS).exists():
+            print(f"{latest} has no training weights to warm-start from, retraining from the base model")
+        else:
+            new, replay = select_incremental_examples(examples, trained)
+            if not new:
+                print(f"No new examples for {username}/{repo_name}, {latest} is up to date.")
+                os.remove(data_path)
+                return None
+
+            print(f"Warm-starting from {latest} with {len(new)} new and {len(replay)} replayed examples")
+            train_path = data_path.with_name(f"{data_path.stem}.incremental.json")
+            train_examples = new + replay
+            with open(train_path, "w") as f:
+                json.dump(train_examples, f)
+            warm_start_args.append(f"warm_start_adapter={(output_dir / latest / TRAINING_WEIGHTS).as_posix()}")
+            optimizer_path = optimizer_state_path(output_dir, latest)
+            if optimizer_path:
+                warm_start_args.append(f"warm_start_optimizer={optimizer_path.as_posix()}")
+            max_epochs = INCREMENTAL_MAX_EPOCHS
+
+    # Tokenize and pack once; retries of a failed run reuse the cache
+    packed_path, validation_path, packing = prepare_packed_dataset(train_path, MODEL_PATH / "original" / "tokenizer.model")
+    output_vol.commit()
+    if packing.packs == 0:
+        raise ValueError(f"No trainable examples in {train_path}")
+
+    if packed:
+        schedule = plan_schedule(packing.packs, max_epochs=max_epochs)
+        print(f"Training schedule for {packing.packs} packs: {schedule}")
+        dataset_args = []
+    else:
+        schedule = plan_schedule(packing.examples, seq_len=packing.mean_example_len, max_epochs=max_epochs)
+        print(f"Training schedule for {packing.examples} unpacked examples: {schedule}")
+        dataset_args = [
+            "dataset._component_=packed_dataset.cached_tokenized_dataset",
+            f"dataset.path={examples_path(packed_path).as_posix()}",
+            "dataset.packed=False",
+            "length_bucketing=True",
+        ]
+    overrides = [
+        f"output_dir={output_dir.as_posix()}",
+        f"dataset_path={train_path.as_posix()}",
+        f"packed_dataset_path={packed_path.as_posix()}",
+        *dataset_args,
+        *schedule.as_overrides(),
+        f"validation_path={validation_path.as_posix()}" if validation_path else "validation_path=null",
+        f"early_stopping_patience={EARLY_STOPPING_PATIENCE}",
+        *warm_start_args,
+    ]
+    # Held-out examples were never trained on, so a later incremental run still counts them as new
+    trained = without_holdout(train_examples, packing)
+    return TrainingRun(username, repo_name, data_path, train_path, output_dir, packed_path, trained, overrides)
+
+
+def run_recipe(*overrides: str):
+    """Run the LoRA recipe with the shared config plus `overrides`."""
+    wandb_args = [
+        "metric_logger._component_=torchtune.training.metric_logging.WandBLogger",
+        f"metric_logger.project={WANDB_PROJECT}",
+    ]
+    subprocess.run(
+        [
+            "tune",
+            "run",
+            REMOTE_RECIPE_PATH.as_posix(),
+            "--config",
+            REMOTE_CONFIG_PATH,
+            f"tokenizer.max_seq_len={PACKED_SEQ_LEN}",
+            f"model_path={MODEL_PATH.as_posix()}",
+            *overrides,
+            *wandb_args,
+        ],
+        # `tune run` must be able to import the packed dataset component
+        env={**os.environ, "PYTHONPATH": str(Path(__file__).parent)},
+        check=True,
+    )
 
-def prepare_adapter_for_inference(base_model_path, adapter_path):
-    """Copy necessary tokenizer files to make adapter work with vLLM."""
-    import os
+
+def finish_training_run(run: TrainingRun) -> dict:
+    """Keep the best checkpoint of a finished run, export it for serving and delete the user's data."""
     import shutil
 
-    print(f"\nPreparing adapter for inference:")
-    print(f"Base model path: {base_model_path}")
-    print(f"Adapter path: {adapter_path}")
+    output_dir = run.output_dir
+    print(f"Model saved to {output_dir}")
 
-    # Check if tokenizer files already exist in adapter directory
-    adapter_tokenizer_files = [f for f in os.listdir(adapter_path) 
-                              if f.startswith("tokenizer") or f.startswith("special_tokens")]
+    # Keep the epoch with the best validation loss as the latest checkpoint
+    early_stopping_path = output_dir / "early_stopping.json"
+    if early_stopping_path.exists():
+        with open(early_stopping_path) as f:
+            best_epoch = json.load(f)["best_epoch"]
+        for entry in output_dir.glob("epoch_*"):
+            if entry.is_dir() and int(entry.name.split("_")[1]) > best_epoch:
+                print(f"Removing {entry.name}, validation loss was best at epoch_{best_epoch}")
+                shutil.rmtree(entry)
 
-    if len(adapter_tokenizer_files) > 0:
-        print("Tokenizer files already exist in adapter directory, skipping copy.")
-        print(f"Found files: {adapter_tokenizer_files}")
-        return
+    # Verify the model was saved correctly
+    if not has_adapter(output_dir):
+        raise FileNotFoundError(f"No model checkpoint found in {output_dir}")
+
+    # Serving-dtype weights and a validated config; tokenizer assets are shared from the base model.
+    # Only the latest checkpoint keeps its training weights and optimizer state, for warm starts.
+    export_user_adapters(output_dir)
+    record_trained_examples(output_dir, run.examples)
+
+    # delete user data after finetuning, including its tokenized copies
+    os.remove(run.data_path)
+    if run.train_path != run.data_path:
+        os.remove(run.train_path)
+    remove_packed_dataset(run.packed_path)
+
+    return {"status": "success", "model_path": str(output_dir)}
 
-    # No tokenizer files in adapter directory: copy from base model
-    print("No tokenizer files found in adapter directory, copying from base model.")
-    
-    # Find tokenizer files in base model
-    tokenizer_files = [f for f in os.listdir(base_model_path) 
-                      if f.startswith("tokenizer") or f.startswith("special_tokens")]
-    
-    print(f"Found tokenizer files in base model: {tokenizer_files}")
-    
-    # Copy to adapter directory
-    for file in tokenizer_files:
-        src = os.path.join(base_model_path, file)
-        dst = os.path.join(adapter_path, file)
-        shutil.copy(src, dst)
-        print(f"Copied {file} to adapter directory")
-    
-    # Ensure adapter_config.json has all required fields
-    import json
-    config_path = os.path.join(adapter_path, "adapter_config.json")
-    with open(config_path, 'r') as f:
-        config = json.load(f)
-    
-    print("\nCurrent adapter config:")
-    print(json.dumps(config, indent=2))
-    
-    # Add missing fields if needed
-    updated = False
-    if "base_model_name_or_path" not in config:
-        config["base_model_name_or_path"] = "meta-llama/Meta-Llama-3.1-8B-Instruct"
-        updated = True
-    if "task_type" not in config:
-        config["task_type"] = "CAUSAL_LM"
-        updated = True
-    
-    if updated:
-        print("\nUpdating adapter config with missing fields...")
-        with open(config_path, 'w') as f:
-            json.dump(config, f, indent=2)
-        print("Updated adapter config:")
-        print(json.dumps(config, indent=2))
-    
-    print("\nAdapter preparation complete!")
 
 @app.function(
     image=training_image,
     gpu="H100",
     volumes={VOL_MOUNT_PATH: output_vol},
-    timeout=2 * HOURS,
+    timeout=FINETUNE_TIMEOUT,
     secrets=[
         modal.Secret.from_name("huggingface-secret"),
         modal.Secret.from_name("wandb-secret")
     ],
 )
-def finetune(username: str, repo_owner: str = None, recipe_args: str = None, cleanup: bool = False, repo_name: str = None, force_reload: bool = False):
+def finetune(username: str, repo_owner: str = None, recipe_args: str = None, cleanup: bool = False, repo_name: str = None, force_reload: bool = False, incremental: bool = False, packed: bool = True):
     """Fine-tune a model on the user's GitHub comment history.
     
     Args:
@@ -148,78 +226,29 @@ def finetune(username: str, repo_owner: str = None, recipe_args: str = None, cle
         repo_owner: Repository owner for data path
         recipe_args: Additional arguments to pass to torchtune
         cleanup: Remove user data after fine-tuning
+        force_reload: Delete the existing adapter and train from the base model
+        incremental: Warm-start from the latest adapter and train only on
+            examples it has not seen, plus a replay sample of old ones. The
+            result is written as a new `epoch_N` version.
+        packed: Train on packed sequences; False trains on length-bucketed
+            batches of single examples
     """
-    import shlex
-    import shutil
-
-    #  if something happens to the model, we can download it again
-    if not MODEL_PATH.exists():
-        print("Downloading model...")
-        download_model()
-        output_vol.commit()
-
-    data_path = get_user_data_path(username, repo_name)
-    print(f"Data path: {data_path}")
-    output_dir = get_user_model_path(username, repo_name)
-    print(f"Output dir: {output_dir}")
-
-    if output_dir.exists() and (output_dir / "epoch_1").exists() and not force_reload:
-        print(f"Model already exists for {username}/{repo_name}, skipping fine-tuning.")
-        return
+    ensure_base_model()
 
     print(f"Username: {username}")
     print(f"Repo name: {repo_name}")
     print(f"Repo owner: {repo_owner}")
 
-    if force_reload and output_dir.exists():
-        print(f"Removing existing model for {username}/{repo_name}")
-        shutil.rmtree(output_dir)
-
-    output_dir.mkdir(parents=True, exist_ok=True)
-
-    wandb_args = [
-        "metric_logger._component_=torchtune.training.metric_logging.WandBLogger",
-        f"metric_logger.project={WANDB_PROJECT}",
-    ]
+    run = plan_training_run(username, repo_name, force_reload, incremental, packed)
+    if run is None:
+        return
 
     print("Starting fine-tuning...")
 
     try: 
-        subprocess.run(
-            [
-                "tune",
-                "run",
-                "lora_finetune_single_device",
-                "--config",
-                REMOTE_CONFIG_PATH,
-                f"output_dir={output_dir.as_posix()}",
-                f"dataset_path={data_path.as_posix()}",
-                f"model_path={MODEL_PATH.as_posix()}",
-                *wandb_args,
-            ]
-        )
-
+        run_recipe(*run.overrides)
         print("Fine-tuning complete.")
-        print(f"Model saved to {output_dir}")
-
-        # Verify the model was saved correctly
-        epoch_dir = output_dir / "epoch_1"
-        if not epoch_dir.exists():
-            raise FileNotFoundError(f"Model directory not found at {epoch_dir}")
-
-        # List contents of epoch_1 directory
-        print("\nContents of epoch_1 directory:")
-        for file in epoch_dir.iterdir():
-            print(f"- {file.name}")
-            if file.name in ["adapter_model.pt", "adapter_model.safetensors"]:
-                print(f"  Size: {file.stat().st_size} bytes")
-
-        prepare_adapter_for_inference(MODEL_PATH, (output_dir / "epoch_1"))
-        
-        # delete user data after finetuning
-        os.remove(data_path)
-                
-        return {"status": "success", "model_path": str(output_dir)}
+        return finish_training_run(run)
         
     except subprocess.CalledProcessError as e:
         print(f"Fine-tuning failed with error: {e}")
@@ -227,3 +256,86 @@ def finetune(username: str, repo_owner: str = None, recipe_args: str = None, cle
     except Exception as e:
         print(f"Unexpected error during fine-tuning: {e}")
         raise
+
+
+@app.function(
+    image=training_image,
+    gpu="H100",
+    volumes={VOL_MOUNT_PATH: output_vol},
+    timeout=FINETUNE_BATCH_TIMEOUT,
+    secrets=[
+        modal.Secret.from_name("huggingface-secret"),
+        modal.Secret.from_name("wandb-secret")
+    ],
+)
+def finetune_batch(adapters: List[Tuple[str, Optional[str]]], repo_owner: str = None, force_reload: bool = False, incremental: bool = False, packed: bool = True) -> dict:
+    """Fine-tune several users' adapters in one container, loading the base model once.
+
+    Adapters are trained one after another in a single recipe process that
+    keeps the frozen base weights on the GPU and only resets the LoRA
+    weights, so each adapter after the first skips the container start,
+    the model download check and the 16 GB checkpoint load.
+
+    Args:
+        adapters: (username, repo_name) of every adapter to train
+        repo_owner: Repository owner, for logging
+        force_reload: Delete existing adapters and train from the base model
+        incremental: Warm-start existing adapters, see `finetune`
+        packed: Train on packed sequences, see `finetune`
+
+    Returns:
+        Per-adapter status and timing, keyed by (username, repo_name). Raises after
+        saving the successful adapters if any adapter failed.
+    """
+    import tempfile
+    import time
+
+    start = time.perf_counter()
+    ensure_base_model()
+
+    results, runs = {}, []
+    for username, repo_name in adapters:
+        try:
+            run = plan_training_run(username, repo_name, force_reload, incremental, packed)
+        except Exception as e:
+            print(f"Could not prepare {username}/{repo_name}: {e}")
+            results[username, repo_name] = {"status": "failed", "error": str(e)}
+            continue
+        if run is None:
+            results[username, repo_name] = {"status": "skipped"}
+        else:
+            runs.append(run)
+    prepare_seconds = time.perf_counter() - start
+
+    if runs:
+        with tempfile.TemporaryDirectory() as tmp:
+            adapters_file, report_file = Path(tmp) / "adapters.yaml", Path(tmp) / "report.json"
+            from omegaconf import OmegaConf
+
+            OmegaConf.save(OmegaConf.create([run.overrides for run in runs]), adapters_file)
+            print(f"Training {len(runs)} adapters on one base model load (repo owner {repo_owner})...")
+            try:
+                run_recipe(f"adapters_file={adapters_file.as_posix()}", f"batch_report={report_file.as_posix()}")
+            except subprocess.CalledProcessError as e:
+                print(f"Batch fine-tuning failed with error: {e}")
+            report = json.loads(report_file.read_text()) if report_file.exists() else []
+
+        for run, entry in zip(runs, report):
+            results[run.username, run.repo_name] = entry
+            if entry["status"] == "success":
+                try:
+                    entry.update(finish_training_run(run))
+                except Exception as e:
+                    entry.update(status="failed", error=str(e))
+        for run in runs[len(report):]:
+            results[run.username, run.repo_name] = {"status": "failed", "error": "recipe exited before training this adapter"}
+
+    print(f"\nBatch of {len(adapters)} adapters ({prepare_seconds:.1f}s packing):")
+    for (username, repo_name), entry in results.items():
+        timing = f"{entry['seconds']:.1f}s (setup {entry.get('setup_seconds', 0):.1f}s)" if "seconds" in entry else "-"
+        print(f"- {username}/{repo_name}: {entry['status']} {timing}")
+
+    failed = [f"{username}/{repo_name}" for (username, repo_name), entry in results.items() if entry["status"] == "failed"]
+    if failed:
+        raise RuntimeError(f"Fine-tuning failed for {', '.join(failed)}; the other adapters were saved")
+    return results
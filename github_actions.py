@@ -1,14 +1,16 @@
 from token_db import get_github_token
-import requests
-from parsing_helpers import split_into_hunks, extract_added_line_numbers
-from inference import Inference
+import asyncio
+from github_client import get_async_github_client, get_github_client
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+from pr_snapshot import PRSnapshot, fetch_pr_snapshot, hunk_key
+from triage import MAX_REVIEWED_HUNKS, triage_hunks, summarize_skipped
 from token_db import load_token
 
-MAX_HUNK_LINES = 200  # maximum lines of diff context per hunk
-TRUNCATION_NOTICE = "\n... (truncated) ...\n"
 
-
-def post_github_comment(repo_owner: str, repo_name: str, pr_number: int, comment: str, path: str, position: int, commenter: str, token: str) -> bool:
+def post_github_comment(repo_owner: str, repo_name: str, pr_number: int, comment: str, path: str, position: int, commenter: str, token: str, commit_id: Optional[str] = None) -> bool:
     """Post a comment to a GitHub PR.
     
     Args:
@@ -19,38 +21,33 @@ def post_github_comment(repo_owner: str, repo_name: str, pr_number: int, comment
         path: Path to the file being commented on
         position: Position in the diff to comment on
         commenter: Commenter's username
+        commit_id: PR head SHA; looked up from the PR's commits when omitted
 
     Returns:
         True if comment was posted successfully
     """
     print("getting token in post_github_comment")
 
-    headers = {
-        "Authorization": f"token {token}",
-        "Accept": "application/vnd.github.v3+json"
-    }
-    
-    url = f"https://api.github.com/repos/{repo_owner}/{repo_name}/pulls/{pr_number}/comments"
+    github = get_github_client()
+    url = f"/repos/{repo_owner}/{repo_name}/pulls/{pr_number}/comments"
     
     data = {
         "body": comment,
-        "commit_id": None,  # Will be filled in by GitHub from the PR
+        "commit_id": commit_id,
         "path": path,
         "line": position
     }
+
+    if commit_id is None:
+        # Get the latest commit in the PR to use as commit_id
+        commit_response = github.get(f"/repos/{repo_owner}/{repo_name}/pulls/{pr_number}/commits", token=token)
+
+        if commit_response.status_code == 200:
+            commits = commit_response.json()
+            if commits:
+                data["commit_id"] = commits[-1]["sha"]
     
-    # Get the latest commit in the PR to use as commit_id
-    commit_response = requests.get(
-        f"https://api.github.com/repos/{repo_owner}/{repo_name}/pulls/{pr_number}/commits",
-        headers=headers
-    )
-    
-    if commit_response.status_code == 200:
-        commits = commit_response.json()
-        if commits:
-            data["commit_id"] = commits[-1]["sha"]
-    
-    response = requests.post(url, headers=headers, json=data)
+    response = github.post(url, token=token, json=data)
     
     if response.status_code in (201, 200):
         print(f"Comment posted successfully to PR #{pr_number}")
@@ -59,6 +56,85 @@ def post_github_comment(repo_owner: str, repo_name: str, pr_number: int, comment
         print(f"Failed to post comment: {response.status_code} - {response.text}")
         return False
 
+MAX_REVIEW_COMMENTS = 50  # comments per submitted review; larger reviews are split
+
+
+def get_pr_head_sha(repo_owner: str, repo_name: str, pr_number: int, token: str) -> Optional[str]:
+    """Return the SHA of the PR's head commit."""
+    response = get_github_client().get(f"/repos/{repo_owner}/{repo_name}/pulls/{pr_number}", token=token)
+    if response.status_code != 200:
+        print(f"Failed to fetch PR #{pr_number}: {response.status_code} - {response.text}")
+        return None
+    return response.json()["head"]["sha"]
+
+
+class PendingReview:
+    """Collects generated comments and submits them as a single PR review.
+
+    The head SHA is resolved once, and comments are sent through
+    `POST /pulls/{n}/reviews` so reviewers get one notification instead of one
+    per comment. Reviews are only split when they exceed MAX_REVIEW_COMMENTS.
+    """
+
+    def __init__(self, repo_owner: str, repo_name: str, pr_number: int, token: str, head_sha: Optional[str] = None):
+        self.repo_owner = repo_owner
+        self.repo_name = repo_name
+        self.pr_number = pr_number
+        self.token = token
+        self.head_sha = head_sha
+        self.comments: List[dict] = []
+
+    def add(self, path: str, line: int, body: str):
+        self.comments.append({"path": path, "line": line, "side": "RIGHT", "body": body})
+
+    def _submit_chunk(self, comments: List[dict], body: Optional[str] = None) -> bool:
+        data = {"commit_id": self.head_sha, "event": "COMMENT", "comments": comments}
+        if body:
+            data["body"] = body
+        response = get_github_client().post(
+            f"/repos/{self.repo_owner}/{self.repo_name}/pulls/{self.pr_number}/reviews",
+            token=self.token,
+            json=data
+        )
+        if response.status_code in (201, 200):
+            return True
+        print(f"Failed to submit review: {response.status_code} - {response.text}")
+        return False
+
+    def _post_individually(self, comments: List[dict]) -> int:
+        # A single bad anchor line rejects the whole review, so salvage the rest one by one
+        posted = 0
+        for c in comments:
+            if post_github_comment(self.repo_owner, self.repo_name, self.pr_number, c["body"], c["path"], c["line"], None, self.token, commit_id=self.head_sha):
+                posted += 1
+        return posted
+
+    def submit(self) -> int:
+        """Submit every collected comment and return how many were posted."""
+        comments, self.comments = self.comments, []
+        return self.submit_comments(comments)
+
+    def submit_comments(self, comments: List[dict], body: Optional[str] = None) -> int:
+        """Submit the given comments as review(s) and return how many were posted.
+
+        `body` is set on the first review; with no comments, it is submitted on its own.
+        """
+        if not comments and not body:
+            return 0
+        if self.head_sha is None:
+            self.head_sha = get_pr_head_sha(self.repo_owner, self.repo_name, self.pr_number, self.token)
+
+        posted = 0
+        chunks = [comments[i:i + MAX_REVIEW_COMMENTS] for i in range(0, len(comments), MAX_REVIEW_COMMENTS)] or [[]]
+        for i, chunk in enumerate(chunks):
+            if self._submit_chunk(chunk, body if i == 0 else None):
+                posted += len(chunk)
+            else:
+                posted += self._post_individually(chunk)
+        print(f"Posted {posted}/{len(comments)} comment(s) to PR #{self.pr_number}")
+        return posted
+
+
 def review_and_comment(
     username: str,
     repo_owner: str,
@@ -66,101 +142,226 @@ def review_and_comment(
     pr_number: int,
     file_path: str,
     commenter: str,
-    token: str
+    token: str,
+    model=None,
+    snapshot: Optional[PRSnapshot] = None,
+    review: Optional[PendingReview] = None
 ):
-    """Review code and post a comment in one go."""
+    """Review code and post a comment in one go.
+
+    `model` defaults to `get_inference()`, so setting INFERENCE_BACKEND=cpu or
+    INFERENCE_BACKEND=fake runs the review without a GPU. `snapshot` is the
+    PR fetched once by the caller; it is fetched here when omitted. Comments
+    are added to `review`, which the caller submits; without one, the file's
+    comments are submitted as their own review.
+    """
+    from inference import get_inference
+
     # Get PR file content
     # token = load_token(commenter)
+    snapshot = snapshot or fetch_pr_snapshot(repo_owner, repo_name, pr_number, token)
+    owns_review = review is None
+    review = review or PendingReview(repo_owner, repo_name, pr_number, token, head_sha=snapshot.head_sha)
 
-    headers = {
-        "Authorization": f"token {token}",
-        "Accept": "application/vnd.github.v3+json"
-    }
-    
-    # Get the file content from the PR
-    file_resp = requests.get(
-        f"https://api.github.com/repos/{repo_owner}/{repo_name}/pulls/{pr_number}/files",
-        headers=headers
-    )
-    
-    if file_resp.status_code != 200:
-        print(f"Error getting PR files: {file_resp.status_code}")
-        return
-    
-    files = file_resp.json()
-    target_file = None
-
-    for file in files:
-        if file["filename"] == file_path:
-            target_file = file
-            break
-    
+    target_file = snapshot.file(file_path)
     if not target_file:
         print(f"File {file_path} not found in PR")
         return
-    
-    # Split the diff into individual hunks
-    patch = target_file.get("patch", "")
-    hunks = split_into_hunks(patch)
 
+    hunks = target_file.hunks
     print(f"Split into {len(hunks)} hunk(s) in {file_path}")
-    
-    if not hunks:
-        # fallback to a single hunk starting at line 1
-        hunks = [(1, patch)]
 
-    model = Inference()
+    kept, skipped = triage_hunks([(file_path, new_start, hunk_text) for new_start, hunk_text in hunks], budget=None)
+    if skipped:
+        print(f"Triage skipped {len(skipped)} hunk(s) in {file_path} ({summarize_skipped(skipped)})")
+    hunks = [(t.new_start, t.hunk_text) for t in kept]
+
+    model = model or get_inference()
     # For each hunk, generate and post a comment
     for new_start, hunk_text in hunks:
-        # Truncate overly long hunks to avoid exceeding model context length
-        lines = hunk_text.splitlines(keepends=True)
-        if len(lines) > MAX_HUNK_LINES:
-            head = lines[:MAX_HUNK_LINES//2]
-            tail = lines[-MAX_HUNK_LINES//2:]
-            hunk_text = ''.join(head) + TRUNCATION_NOTICE + ''.join(tail)
-        # Generate comment for this hunk
-        comment = ""
-        for chunk in model.generate.remote_gen(hunk_text, file_path, username, repo_owner, repo_name):
-            comment += chunk
-        if not comment.strip():
+        # Generate a one-line comment for this hunk, anchored to one of its added lines
+        result = model.review.remote(hunk_text, new_start, file_path, username, repo_owner, repo_name)
+        if not result.comment:
             continue
+        comment = result.comment
+        position = result.line
+        print(f"Generated comment for line {position} ({result.completion_tokens} tokens, confidence {result.confidence})")
 
-        # Map '+' lines to actual file positions
-        positions = extract_added_line_numbers(hunk_text, new_start)
-        print("New start", new_start)
-        print("Positions", positions)
-
-        if not positions:
-            # fallback to header start
-            positions = [new_start]
-        # Post one comment at the first added line
-        position = positions[0]
-        success = post_github_comment(
-            repo_owner,
-            repo_name,
-            pr_number,
-            comment,
-            file_path,
-            position,
-            commenter,
-            token
-        )
-        if success:
-            print(f"Posted comment at line {position} in {file_path}")
-        else:
-            print(f"Failed to post comment at line {position}")
+        review.add(file_path, position, comment)
 
+    if owns_review:
+        review.submit()
 
-def write_status_comment(repo_owner: str, repo_name: str, pr_number: int, comment_body: str, token: str):
-    headers = {
-        "Authorization": f"token {token}",
-        "Accept": "application/vnd.github.v3+json"
+
+GENERATION_WORKERS = 8  # concurrent Inference.review_batch calls per PR
+GENERATION_BATCH_SIZE = 8  # (hunk x reviewer) pairs per review_batch call
+QUEUE_SIZE_PER_WORKER = 2  # bounded queues apply backpressure to faster stages
+
+
+@dataclass
+class StageTiming:
+    """Busy time and item count of one pipeline stage."""
+    name: str
+    items: int = 0
+    busy_s: float = 0.0
+    first_start: Optional[float] = None
+    last_end: Optional[float] = None
+
+    @contextmanager
+    def timed(self):
+        start = time.monotonic()
+        if self.first_start is None:
+            self.first_start = start
+        try:
+            yield
+        finally:
+            self.last_end = time.monotonic()
+            self.busy_s += self.last_end - start
+            self.items += 1
+
+    def summary(self) -> dict:
+        span = (self.last_end - self.first_start) if self.first_start and self.last_end else 0.0
+        return {"items": self.items, "busy_s": round(self.busy_s, 3), "span_s": round(span, 3)}
+
+
+async def review_pull_request_async(
+    usernames: List[str],
+    snapshot: PRSnapshot,
+    token: str,
+    model=None,
+    review: Optional[PendingReview] = None,
+    budget: Optional[int] = MAX_REVIEWED_HUNKS,
+    workers: int = GENERATION_WORKERS,
+    batch_size: int = GENERATION_BATCH_SIZE
+) -> Dict[str, dict]:
+    """Review a whole PR through a producer / generation / posting pipeline.
+
+    A producer feeds triaged (hunk x reviewer) pairs into a bounded queue, a
+    pool of `workers` sends micro-batches of up to `batch_size` pairs to
+    `Inference.review_batch`, so requests for different reviewers' adapters
+    share the engine's batches, and a posting stage submits a review chunk
+    as soon as MAX_REVIEW_COMMENTS comments are ready, so GitHub and GPU
+    latency overlap instead of adding up. Pairs whose generation failed are
+    counted in the body of the final review.
+
+    Args:
+        usernames: GitHub usernames of the reviewers to emulate
+        snapshot: The PR, fetched once by the caller
+        review: Where to collect comments; defaults to a new `PendingReview`
+        budget: Maximum number of hunks reviewed per PR, None for no limit
+        workers: Number of concurrent generation calls
+        batch_size: Maximum pairs per generation call
+
+    Returns:
+        Per-stage timings, plus the end-to-end wall time, request and failure
+        counts and the `hunk_key`s left out by the budget under "total"
+    """
+    from inference import ReviewRequest, get_inference
+
+    repo_owner, repo_name = snapshot.repo_owner, snapshot.repo_name
+    review = review or PendingReview(repo_owner, repo_name, snapshot.pr_number, token, head_sha=snapshot.head_sha)
+    model = model or get_inference()
+
+    hunks = snapshot.hunks()
+    kept, skipped = triage_hunks(hunks, budget)
+    print(f"Triage kept {len(kept)} of {len(hunks)} hunk(s)" + (f", skipped {summarize_skipped(skipped)}" if skipped else ""))
+
+    work_queue: asyncio.Queue = asyncio.Queue(maxsize=workers * batch_size * QUEUE_SIZE_PER_WORKER)
+    post_queue: asyncio.Queue = asyncio.Queue(maxsize=workers * batch_size * QUEUE_SIZE_PER_WORKER)
+    timings = {name: StageTiming(name) for name in ("produce", "generate", "post")}
+    total = len(kept) * len(usernames)
+    failed = 0
+    t0 = time.monotonic()
+
+    async def produce():
+        for t in kept:
+            for username in usernames:
+                with timings["produce"].timed():
+                    await work_queue.put(ReviewRequest(t.hunk_text, t.new_start, t.file_path, username, repo_owner, repo_name))
+        for _ in range(workers):
+            await work_queue.put(None)
+
+    async def generate():
+        nonlocal failed
+        done = False
+        while not done:
+            # Wait for one request, then take whatever else is already queued
+            batch = [request] if (request := await work_queue.get()) is not None else []
+            done = not batch
+            while batch and len(batch) < batch_size and not work_queue.empty():
+                if (request := work_queue.get_nowait()) is None:
+                    done = True
+                    break
+                batch.append(request)
+            if not batch:
+                continue
+            try:
+                with timings["generate"].timed():
+                    results = await model.review_batch.remote.aio(batch)
+            except Exception as e:
+                failed += len(batch)
+                print(f"Generation failed for {len(batch)} pair(s) starting at {batch[0].file_path}:{batch[0].new_start}: {e}")
+                continue
+            for request, result in zip(batch, results):
+                await post_queue.put((request, result))
+
+    async def submit(comments: List[dict], body: Optional[str] = None):
+        with timings["post"].timed():
+            await asyncio.to_thread(review.submit_comments, comments, body)
+
+    async def post():
+        submissions = []
+        while (item := await post_queue.get()) is not None:
+            request, result = item
+            if not result.comment:
+                continue
+            body = f"**{request.username}:** {result.comment}" if len(usernames) > 1 else result.comment
+            review.add(request.file_path, result.line, body)
+            if len(review.comments) >= MAX_REVIEW_COMMENTS:
+                # Post full chunks in the background while generation continues
+                comments, review.comments = review.comments, []
+                submissions.append(asyncio.create_task(submit(comments)))
+        comments, review.comments = review.comments, []
+        summary = f"Could not generate {failed} of {total} hunk review(s); they will be retried when the bot is called again." if failed else None
+        await asyncio.gather(submit(comments, summary), *submissions)
+
+    poster = asyncio.create_task(post())
+    generators = [asyncio.create_task(generate()) for _ in range(workers)]
+    try:
+        await produce()
+        await asyncio.gather(*generators)
+    finally:
+        # Stop every stage even when one failed, so no task outlives the review
+        for task in generators:
+            task.cancel()
+        if not poster.done():
+            await post_queue.put(None)
+        await poster
+
+    report = {name: timing.summary() for name, timing in timings.items()}
+    report["total"] = {
+        "wall_s": round(time.monotonic() - t0, 3),
+        "requests": total,
+        "failed": failed,
+        "over_budget": [hunk_key(t.file_path, t.hunk_text) for t in skipped if t.category == "over_budget"],
     }
+    print(f"Pipeline timings: {report}")
+    return report
 
-    comment_url = f"https://api.github.com/repos/{repo_owner}/{repo_name}/issues/{pr_number}/comments"
+
+def write_status_comment(repo_owner: str, repo_name: str, pr_number: int, comment_body: str, token: str):
+    comment_url = f"/repos/{repo_owner}/{repo_name}/issues/{pr_number}/comments"
     comment_data = {
         "body": comment_body
     }
-    response = requests.post(comment_url, headers=headers, json=comment_data)
+    response = get_github_client().post(comment_url, token=token, json=comment_data)
+    if response.status_code != 201:
+        print(f"Failed to post comment: {response.status_code} - {response.text}")
+
+
+async def write_status_comment_async(repo_owner: str, repo_name: str, pr_number: int, comment_body: str, token: str):
+    """`write_status_comment` on the async client, for use inside event loops."""
+    comment_url = f"/repos/{repo_owner}/{repo_name}/issues/{pr_number}/comments"
+    response = await get_async_github_client().post(comment_url, token=token, json={"body": comment_body})
     if response.status_code != 201:
         print(f"Failed to post comment: {response.status_code} - {response.text}")
\ No newline at end of file
@@ -0,0 +1,104 @@
+import base64
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from github_client import get_async_github_client
+
+JWT_LIFETIME = 600  # seconds; GitHub rejects app JWTs valid for longer than 10 minutes
+JWT_CLOCK_SKEW = 60  # backdate `iat` to tolerate clock drift
+TOKEN_REFRESH_MARGIN = 5 * 60  # re-mint installation tokens this long before they expire
+
+_lock = threading.Lock()
+_jwt: Optional[Tuple[str, float]] = None  # (jwt, expires_at)
+_installation_ids: Dict[Tuple[str, str], int] = {}
+_installation_tokens: Dict[int, Tuple[str, float]] = {}  # installation_id -> (token, expires_at)
+
+
+def app_jwt() -> str:
+    """Return a JWT authenticating as the GitHub App, reused until shortly before it expires."""
+    global _jwt
+    from jwt import encode
+
+    with _lock:
+        if _jwt is not None and _jwt[1] - time.time() > JWT_CLOCK_SKEW:
+            return _jwt[0]
+
+        # Get these from your GitHub App settings
+        app_id = os.environ["APP_ID"]
+        private_key = base64.b64decode(os.environ["GITHUB_APP_PRIVATE_KEY"]).decode()
+
+        now = int(time.time())
+        payload = {
+            "iat": now - JWT_CLOCK_SKEW,
+            "exp": now + JWT_LIFETIME - JWT_CLOCK_SKEW,
+            "iss": app_id
+        }
+        _jwt = (encode(payload, private_key, algorithm="RS256"), payload["exp"])
+        return _jwt[0]
+
+
+def remember_installation(repo_owner: str, repo_name: str, installation_id: int):
+    """Record the installation for a repository, e.g. from a webhook payload's `installation.id`."""
+    with _lock:
+        _installation_ids[(repo_owner, repo_name)] = installation_id
+
+
+async def get_installation_id(repo_owner: str, repo_name: str) -> int:
+    """Resolve the app installation covering `repo_owner/repo_name`, memoized per process."""
+    with _lock:
+        if (repo_owner, repo_name) in _installation_ids:
+            return _installation_ids[(repo_owner, repo_name)]
+
+    response = await get_async_github_client().get(f"/repos/{repo_owner}/{repo_name}/installation", token=app_jwt(), scheme="Bearer")
+    if response.status_code != 200:
+        raise Exception(f"No installation found for {repo_owner}/{repo_name}: {response.status_code} - {response.text}")
+
+    installation_id = response.json()["id"]
+    remember_installation(repo_owner, repo_name, installation_id)
+    return installation_id
+
+
+def _parse_expires_at(value: str) -> float:
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+async def get_installation_token(repo_owner: str, repo_name: str, installation_id: Optional[int] = None) -> str:
+    """Return an installation access token for the repository.
+
+    Tokens are cached per installation and reused until TOKEN_REFRESH_MARGIN
+    before GitHub's `expires_at`, so a warm container skips the JWT and
+    token round trips entirely.
+
+    Args:
+        repo_owner: Owner of the repository
+        repo_name: Name of the repository
+        installation_id: Installation ID if already known (webhooks include it)
+
+    Returns:
+        The installation access token
+    """
+    if installation_id is not None:
+        remember_installation(repo_owner, repo_name, installation_id)
+    else:
+        installation_id = await get_installation_id(repo_owner, repo_name)
+
+    with _lock:
+        cached = _installation_tokens.get(installation_id)
+        if cached is not None and cached[1] - time.time() > TOKEN_REFRESH_MARGIN:
+            return cached[0]
+
+    response = await get_async_github_client().post(f"/app/installations/{installation_id}/access_tokens", token=app_jwt(), scheme="Bearer")
+    if response.status_code != 201:
+        if response.status_code == 404:
+            # The app was uninstalled or moved; resolve it again next time
+            with _lock:
+                _installation_ids.pop((repo_owner, repo_name), None)
+        raise Exception(f"Failed to mint installation token for {repo_owner}/{repo_name}: {response.status_code} - {response.text}")
+
+    data = response.json()
+    with _lock:
+        _installation_tokens[installation_id] = (data["token"], _parse_expires_at(data["expires_at"]))
+    return data["token"]
@@ -0,0 +1,231 @@
+import asyncio
+import threading
+import weakref
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError
+from urllib3.util.retry import Retry
+
+GITHUB_API_URL = "https://api.github.com"
+GITHUB_ACCEPT = "application/vnd.github.v3+json"
+DEFAULT_TIMEOUT = 30.0  # seconds per request
+CONNECT_TIMEOUT = 5.0
+POOL_SIZE = 32  # keep-alive connections per host
+MAX_RETRIES = 3
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})  # never replay a POST
+MAX_RETRY_AFTER = 60  # seconds; a longer Retry-After fails the request instead of stalling it
+
+
+def github_headers(token: Optional[str] = None, scheme: str = "token") -> Dict[str, str]:
+    """Headers for a GitHub API call; `scheme` is "token" for OAuth/installation tokens, "Bearer" for app JWTs."""
+    headers = {"Accept": GITHUB_ACCEPT}
+    if token:
+        headers["Authorization"] = f"{scheme} {token}"
+    return headers
+
+
+def _url(path_or_url: str) -> str:
+    return path_or_url if path_or_url.startswith("http") else f"{GITHUB_API_URL}{path_or_url}"
+
+
+@dataclass
+class ConnectionStats:
+    """Request and connection counters; `reused` is requests served on an existing connection."""
+    requests: int = 0
+    connections: int = 0
+    retries: int = 0
+
+    @property
+    def reused(self) -> int:
+        return max(0, self.requests - self.connections)
+
+    def as_dict(self) -> dict:
+        return {"requests": self.requests, "connections": self.connections, "reused": self.reused, "retries": self.retries}
+
+
+class CappedRetry(Retry):
+    """urllib3 `Retry` that gives up instead of honouring a Retry-After over MAX_RETRY_AFTER.
+
+    The rate-limited response is then returned to the caller, as when
+    retries run out.
+    """
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if response is not None and (self.get_retry_after(response) or 0) > MAX_RETRY_AFTER:
+            raise MaxRetryError(_pool, url, f"Retry-After exceeds {MAX_RETRY_AFTER}s")
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+class GitHubClient:
+    """Synchronous GitHub client on a keep-alive `requests.Session`.
+
+    Every call shares one connection pool, so only the first request to a host
+    pays for the TCP and TLS handshakes. Idempotent requests are retried with
+    backoff on rate limiting and server errors.
+    """
+
+    def __init__(self, pool_size: int = POOL_SIZE, timeout: float = DEFAULT_TIMEOUT, max_retries: int = MAX_RETRIES):
+        self.timeout = (CONNECT_TIMEOUT, timeout)
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=pool_size,
+            max_retries=CappedRetry(
+                total=max_retries,
+                backoff_factor=0.5,
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=RETRY_METHODS,
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            ),
+        )
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.session.hooks["response"].append(self._count)
+        self.counters = ConnectionStats()
+        self._connections: "weakref.WeakSet" = weakref.WeakSet()  # pooled connections seen so far
+        self._lock = threading.Lock()
+
+    def _count(self, response: requests.Response, *args, **kwargs):
+        # The connection is still attached to the raw response while hooks run
+        connection = getattr(response.raw, "connection", None)
+        retries = getattr(response.raw, "retries", None)
+        with self._lock:
+            if retries is not None:
+                self.counters.retries += len(retries.history)
+            if connection is not None and connection not in self._connections:
+                self._connections.add(connection)
+                self.counters.connections += 1
+
+    def request(self, method: str, path_or_url: str, token: Optional[str] = None, scheme: str = "token", headers: Optional[dict] = None, **kwargs) -> requests.Response:
+        """Send a request; `path_or_url` may be an API path like "/repos/o/r" or a full URL."""
+        merged = github_headers(token, scheme)
+        merged.update(headers or {})
+        kwargs.setdefault("timeout", self.timeout)
+        with self._lock:
+            self.counters.requests += 1
+        return self.session.request(method, _url(path_or_url), headers=merged, **kwargs)
+
+    def get(self, path_or_url: str, **kwargs) -> requests.Response:
+        return self.request("GET", path_or_url, **kwargs)
+
+    def post(self, path_or_url: str, **kwargs) -> requests.Response:
+        return self.request("POST", path_or_url, **kwargs)
+
+    def stats(self) -> ConnectionStats:
+        return self.counters
+
+
+class AsyncGitHubClient:
+    """Asynchronous GitHub client on a keep-alive `httpx.AsyncClient`.
+
+    HTTP/2 is used when the `h2` package is installed, multiplexing requests
+    over a single connection to api.github.com.
+    """
+
+    def __init__(self, pool_size: int = POOL_SIZE, timeout: float = DEFAULT_TIMEOUT, max_retries: int = MAX_RETRIES):
+        import httpx
+
+        try:
+            import h2  # noqa: F401
+            http2 = True
+        except ImportError:
+            http2 = False
+
+        self.max_retries = max_retries
+        self.counters = ConnectionStats()
+        self._streams: set[int] = set()
+        self.client = httpx.AsyncClient(
+            http2=http2,
+            timeout=httpx.Timeout(timeout, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            event_hooks={"response": [self._count_connection]},
+        )
+
+    async def _count_connection(self, response):
+        stream = response.extensions.get("network_stream")
+        if stream is not None and id(stream) not in self._streams:
+            self._streams.add(id(stream))
+            self.counters.connections += 1
+
+    async def request(self, method: str, path_or_url: str, token: Optional[str] = None, scheme: str = "token", headers: Optional[dict] = None, **kwargs):
+        """Send a request; `path_or_url` may be an API path like "/repos/o/r" or a full URL."""
+        import httpx
+
+        merged = github_headers(token, scheme)
+        merged.update(headers or {})
+        self.counters.requests += 1
+        attempts = self.max_retries + 1 if method.upper() in RETRY_METHODS else 1
+        for attempt in range(attempts):
+            try:
+                response = await self.client.request(method, _url(path_or_url), headers=merged, **kwargs)
+            except httpx.TransportError:
+                if attempt == attempts - 1:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt == attempts - 1:
+                    return response
+                retry_after = response.headers.get("Retry-After")
+                if retry_after and retry_after.isdigit():
+                    if int(retry_after) > MAX_RETRY_AFTER:
+                        return response
+                    await asyncio.sleep(int(retry_after))
+                    self.counters.retries += 1
+                    continue
+            self.counters.retries += 1
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+    async def get(self, path_or_url: str, **kwargs):
+        return await self.request("GET", path_or_url, **kwargs)
+
+    async def post(self, path_or_url: str, **kwargs):
+        return await self.request("POST", path_or_url, **kwargs)
+
+    def stats(self) -> ConnectionStats:
+        return self.counters
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+_client: Optional[GitHubClient] = None
+_client_lock = threading.Lock()
+# Keyed by the loop itself, so a client goes away with its loop and is never handed to a new one
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncGitHubClient]" = weakref.WeakKeyDictionary()
+
+
+def get_github_client() -> GitHubClient:
+    """The process-wide sync client, created on first use."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = GitHubClient()
+        return _client
+
+
+def get_async_github_client() -> AsyncGitHubClient:
+    """The async client for the running event loop, created on first use."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.client.is_closed:
+        client = _async_clients[loop] = AsyncGitHubClient()
+    return client
+
+
+async def close_async_github_client():
+    """Close the running event loop's async client, e.g. when the app shuts down."""
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def connection_stats() -> dict:
+    """Connection reuse counters of every client in this process, e.g. for logging."""
+    stats = {"sync": get_github_client().stats().as_dict()}
+    for loop, client in list(_async_clients.items()):
+        stats[f"async-{id(loop)}"] = client.stats().as_dict()
+    return stats
@@ -1,20 +1,21 @@
-import requests
 import json
 import time
 import os
 
 from collections import defaultdict 
 from github_actions import write_status_comment
+from github_client import connection_stats, get_github_client
 
 from common import (
     SYSTEM_PROMPT,
     get_user_data_path,
     get_user_model_path,
+    has_adapter,
     app,
     output_vol,
     VOL_MOUNT_PATH,
     base_image,
-    HOURS,
+    SCRAPE_TIMEOUT,
 )
 import modal
 
@@ -24,11 +25,7 @@ class GitHubPRScraper:
         self.token = token
         self.owner = owner
         self.repo = repo
-        self.headers = {
-            "Authorization": f"token {token}",
-            "Accept": "application/vnd.github.v3+json"
-        }
-        self.base_url = "https://api.github.com"
+        self.github = get_github_client()
         
     def get_all_prs(self, state="all", max_pages=None):
         """Get all PRs in the repository."""
@@ -36,10 +33,10 @@ class GitHubPRScraper:
         page = 1
         
         while True:
-            url = f"{self.base_url}/repos/{self.owner}/{self.repo}/pulls"
+            url = f"/repos/{self.owner}/{self.repo}/pulls"
             params = {"state": state, "page": page, "per_page": 100}
             
-            response = requests.get(url, headers=self.headers, params=params)
+            response = self.github.get(url, token=self.token, params=params)
             
             if response.status_code != 200:
                 print(f"Error fetching PRs: {response.status_code}")
@@ -73,10 +70,10 @@ class GitHubPRScraper:
         page = 1
         
         while True:
-            url = f"{self.base_url}/repos/{self.owner}/{self.repo}/pulls/{pr_number}/comments"
+            url = f"/repos/{self.owner}/{self.repo}/pulls/{pr_number}/comments"
             params = {"page": page, "per_page": 100}
             
-            response = requests.get(url, headers=self.headers, params=params)
+            response = self.github.get(url, token=self.token, params=params)
             
             if response.status_code != 200:
                 print(f"Error fetching PR review comments: {response.status_code}")
@@ -103,8 +100,8 @@ class GitHubPRScraper:
     
     def get_pr_files(self, pr_number):
         """Get files changed in a specific PR."""
-        url = f"{self.base_url}/repos/{self.owner}/{self.repo}/pulls/{pr_number}/files"
-        response = requests.get(url, headers=self.headers)
+        url = f"/repos/{self.owner}/{self.repo}/pulls/{pr_number}/files"
+        response = self.github.get(url, token=self.token)
         
         if response.status_code != 200:
             print(f"Error fetching PR files: {response.status_code}")
@@ -115,10 +112,10 @@ class GitHubPRScraper:
     
     def get_file_content(self, commit_sha, filename):
         """Get file content at a specific commit."""
-        url = f"{self.base_url}/repos/{self.owner}/{self.repo}/contents/{filename}"
+        url = f"/repos/{self.owner}/{self.repo}/contents/{filename}"
         params = {"ref": commit_sha}
         
-        response = requests.get(url, headers=self.headers, params=params)
+        response = self.github.get(url, token=self.token, params=params)
         
         if response.status_code != 200:
             print(f"Error fetching file content: {response.status_code}")
@@ -268,9 +265,9 @@ class GitHubPRScraper:
 @app.function(
     image=base_image,
     volumes={VOL_MOUNT_PATH: output_vol},
-    timeout=2 * HOURS,
+    timeout=SCRAPE_TIMEOUT,
 )
-def scrape(username: str, repo_owner: str, repo_name: str, force_reload: bool, pr_number: int, commenter: str, token: str) -> int:
+def scrape(username: str, repo_owner: str, repo_name: str, force_reload: bool, pr_number: int, commenter: str, token: str, incremental: bool = False) -> int:
     """Scrape GitHub PR comments for a user.
     
     Args:
@@ -278,6 +275,8 @@ def scrape(username: str, repo_owner: str, repo_name: str, force_reload: bool, p
         repo_owner: Owner of the repository
         repo_name: Name of the repository
         token: GitHub OAuth token for authentication
+        incremental: Scrape again even though an adapter exists, so finetune()
+            can warm-start it on the new comments
         
     Returns:
         Number of examples collected
@@ -285,14 +284,10 @@ def scrape(username: str, repo_owner: str, repo_name: str, force_reload: bool, p
     import pandas as pd
     from tqdm import tqdm
 
-    headers = {
-        "Authorization": f"token {token}",
-        "Accept": "application/vnd.github.v3+json"
-    }
-
+    github = get_github_client()
 
     output_dir = get_user_model_path(username, repo_name)
-    if output_dir.exists() and (output_dir / "epoch_1").exists() and not force_reload:
+    if has_adapter(output_dir) and not force_reload and not incremental:
         print(f"Data already exists for {username}/{repo_name}")
         return -1
     
@@ -307,9 +302,9 @@ def scrape(username: str, repo_owner: str, repo_name: str, force_reload: bool, p
     write_status_comment(repo_owner, repo_name, pr_number, scraping_message, token)
     
     while True:
-        response = requests.get(
-            f"https://api.github.com/repos/{repo_owner}/{repo_name}/pulls",
-            headers=headers,
+        response = github.get(
+            f"/repos/{repo_owner}/{repo_name}/pulls",
+            token=token,
             params={"state": "all", "page": page, "per_page": 100}
         )
         
@@ -343,9 +338,9 @@ def scrape(username: str, repo_owner: str, repo_name: str, force_reload: bool, p
         page = 1
         
         while True:
-            response = requests.get(
-                f"https://api.github.com/repos/{repo_owner}/{repo_name}/pulls/{pr_number_iteration}/comments",
-                headers=headers,
+            response = github.get(
+                f"/repos/{repo_owner}/{repo_name}/pulls/{pr_number_iteration}/comments",
+                token=token,
                 params={"page": page, "per_page": 100}
             )
             
@@ -375,9 +370,9 @@ def scrape(username: str, repo_owner: str, repo_name: str, force_reload: bool, p
                     continue
                 
                 # Get file content at commit
-                file_response = requests.get(
-                    f"https://api.github.com/repos/{repo_owner}/{repo_name}/contents/{path}",
-                    headers=headers,
+                file_response = github.get(
+                    f"/repos/{repo_owner}/{repo_name}/contents/{path}",
+                    token=token,
                     params={"ref": commit_id}
                 )
                 
@@ -441,4 +436,5 @@ def scrape(username: str, repo_owner: str, repo_name: str, force_reload: bool, p
     output_vol.commit()
     
     print(f"Collected {len(examples)} examples for {username}")
+    print(f"GitHub connections: {connection_stats()}")
     return len(examples)
\ No newline at end of file
@@ -0,0 +1,148 @@
+import argparse
+import ast
+import os
+import subprocess
+import sys
+from typing import List, Optional, Tuple
+
+
+DEFAULT_MODULE = "api"
+IMPORT_BUDGET_SECONDS = 1.5  # cold-start import time allowed for the web function
+# Modules the web container must not load at import time
+FORBIDDEN_MODULES = [
+    "torch", "transformers", "peft", "vllm", "pandas",
+    "fintuning", "inference", "inference_engines", "github_pr_scraper",
+]
+
+# Imported by `api` only under `modal.is_local()`, i.e. when deploying, never in the web container
+DEPLOY_ONLY_MODULES = ["fintuning", "github_pr_scraper", "inference"]
+
+
+def parse_importtime(stderr: str) -> List[Tuple[int, int, str]]:
+    """Parse `-X importtime` output into (depth, cumulative microseconds, module) entries.
+
+    Entries are in the order imports finished, so each module follows the
+    modules it imported, which are one level deeper.
+    """
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((depth, int(cumulative), name.strip()))
+    return entries
+
+
+def _subtree_start(entries: List[Tuple[int, int, str]], index: int) -> int:
+    """Index of the first module imported (directly or not) by the entry at `index`."""
+    depth = entries[index][0]
+    start = index
+    while start > 0 and entries[start - 1][0] > depth:
+        start -= 1
+    return start
+
+
+def container_imports(entries: List[Tuple[int, int, str]], module: str, deploy_only: List[str] = DEPLOY_ONLY_MODULES) -> Tuple[float, List[Tuple[int, int, str]]]:
+    """Import time and modules of `module` as a container loads it, leaving out its deploy-only imports.
+
+    Returns:
+        Seconds spent importing, and the entries imported on the container path
+    """
+    root = max(i for i, (depth, _, name) in enumerate(entries) if depth == 0 and name == module)
+    subtree = entries[_subtree_start(entries, root):root]
+    excluded = set()
+    deploy_us = 0
+    for i, (depth, cumulative, name) in enumerate(subtree):
+        if depth == 1 and name in deploy_only:
+            excluded.update(range(_subtree_start(subtree, i), i + 1))
+            deploy_us += cumulative
+    kept = [entry for i, entry in enumerate(subtree) if i not in excluded]
+    return (entries[root][1] - deploy_us) / 1e6, kept
+
+
+def unguarded_deploy_imports(module: str, deploy_only: List[str] = DEPLOY_ONLY_MODULES) -> List[str]:
+    """Deploy-only modules that `module` imports at module level outside `if modal.is_local():`.
+
+    The timing leaves these imports out, so this check keeps them from
+    slipping onto the container path unnoticed.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), f"{module}.py")
+    with open(path) as f:
+        tree = ast.parse(f.read())
+
+    found = []
+
+    def visit(statements: List[ast.stmt], guarded: bool):
+        for statement in statements:
+            if isinstance(statement, ast.If):
+                visit(statement.body, guarded or ast.unparse(statement.test) == "modal.is_local()")
+                visit(statement.orelse, guarded)
+            elif isinstance(statement, ast.Try):
+                for block in (statement.body, statement.orelse, statement.finalbody, *[h.body for h in statement.handlers]):
+                    visit(block, guarded)
+            elif isinstance(statement, (ast.Import, ast.ImportFrom)) and not guarded:
+                names = [alias.name for alias in statement.names] if isinstance(statement, ast.Import) else [statement.module or ""]
+                found.extend(name for name in names if name.split(".")[0] in deploy_only)
+
+    visit(tree.body, False)
+    return found
+
+
+def measure(module: str = DEFAULT_MODULE, repeat: int = 3, top: int = 10) -> dict:
+    """Import `module` in fresh interpreters and report the best import time and what it loaded.
+
+    Times come from `python -X importtime`. The modules `module` imports
+    only when deploying are subtracted, so the report matches a cold
+    container. The fastest of `repeat` runs is used so a cold disk cache on
+    the first run does not make the check flaky.
+    """
+    env = {"ENCRYPTION_KEY": "budget-check", "GITHUB_CLIENT_ID": "budget-check", **os.environ}
+    runs = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-W", "ignore", "-c", f"import {module}"],
+            capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+        runs.append(container_imports(parse_importtime(result.stderr), module))
+
+    seconds, imported = min(runs, key=lambda run: run[0])
+    names = {name for _, _, name in imported}
+    return {
+        "module": module,
+        "seconds": seconds,
+        "forbidden_loaded": [name for name in FORBIDDEN_MODULES if name in names],
+        "unguarded_imports": unguarded_deploy_imports(module),
+        "slowest": sorted(((cumulative, name) for _, cumulative, name in imported), reverse=True)[:top],
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Fail when the web function's cold-start imports exceed the budget or load heavy modules."""
+    parser = argparse.ArgumentParser(description="Check the cold-start import time of the web function.")
+    parser.add_argument("--module", default=DEFAULT_MODULE)
+    parser.add_argument("--budget", type=float, default=IMPORT_BUDGET_SECONDS, help="seconds allowed for the import")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    report = measure(args.module, args.repeat)
+    print(f"import {report['module']}: {report['seconds']:.3f}s (budget {args.budget:.3f}s)")
+    for cumulative, name in report["slowest"]:
+        print(f"{cumulative / 1e6:>10.3f}s  {name}")
+
+    problems = []
+    if report["seconds"] > args.budget:
+        problems.append(f"import took {report['seconds']:.3f}s, over the {args.budget}s budget")
+    if report["forbidden_loaded"]:
+        problems.append(f"heavy modules loaded at import: {', '.join(report['forbidden_loaded'])}")
+    if report["unguarded_imports"]:
+        problems.append(f"deploy-only modules imported outside `if modal.is_local():`: {', '.join(report['unguarded_imports'])}")
+    for problem in problems:
+        print(f"REGRESSION: {problem}", file=sys.stderr)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
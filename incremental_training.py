@@ -0,0 +1,82 @@
+import hashlib
+import json
+import math
+import random
+from pathlib import Path
+from typing import Iterable, List, Optional, Set, Tuple
+
+TRAINED_EXAMPLES_FILE = "trained_examples.json"  # hashes of every example an adapter has seen
+OPTIMIZER_STATE_DIR = "optimizer_state"  # per-epoch optimizer state written by lora_early_stopping.py
+REPLAY_FRACTION = 0.25  # old examples replayed per new example, to keep the adapter from drifting
+MIN_REPLAY_EXAMPLES = 16
+INCREMENTAL_MAX_EPOCHS = 3
+
+
+def example_hash(example: dict) -> str:
+    """Stable identity of a training example, independent of key order."""
+    return hashlib.sha256(json.dumps(example["messages"], sort_keys=True).encode()).hexdigest()
+
+
+def load_trained_hashes(output_dir: Path) -> Optional[Set[str]]:
+    """Hashes of the examples the user's adapter was trained on, or None for adapters trained before they were recorded."""
+    path = output_dir / TRAINED_EXAMPLES_FILE
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return set(json.load(f))
+
+
+def record_trained_examples(output_dir: Path, examples: Iterable[dict]):
+    """Add examples to the set the user's adapter has been trained on."""
+    hashes = load_trained_hashes(output_dir) or set()
+    hashes.update(example_hash(e) for e in examples)
+    path = output_dir / TRAINED_EXAMPLES_FILE
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(sorted(hashes), f)
+    tmp_path.replace(path)
+
+
+def select_incremental_examples(
+    examples: List[dict],
+    trained: Set[str],
+    replay_fraction: float = REPLAY_FRACTION,
+    seed: int = 0,
+) -> Tuple[List[dict], List[dict]]:
+    """Split a freshly scraped history into unseen examples and a replay sample of seen ones.
+
+    Args:
+        examples: Every example scraped for the user
+        trained: Hashes of the examples the adapter was already trained on
+        replay_fraction: Replayed old examples per new example
+        seed: Seed for the replay sample
+
+    Returns:
+        The new examples and the old examples to replay alongside them
+    """
+    new, old = [], []
+    for example in examples:
+        (old if example_hash(example) in trained else new).append(example)
+    if not new:
+        return [], []
+    num_replay = min(len(old), max(MIN_REPLAY_EXAMPLES, math.ceil(replay_fraction * len(new))))
+    return new, random.Random(seed).sample(old, num_replay)
+
+
+def optimizer_state_path(output_dir: Path, version: str) -> Optional[Path]:
+    """Optimizer state saved with checkpoint `version` (an `epoch_N` name), if any."""
+    path = output_dir / OPTIMIZER_STATE_DIR / f"{version}.pt"
+    return path if path.exists() else None
+
+
+def prune_optimizer_states(output_dir: Path, keep: str) -> int:
+    """Delete optimizer states of every checkpoint except `keep` and return the bytes freed; only the latest is ever resumed from."""
+    state_dir = output_dir / OPTIMIZER_STATE_DIR
+    if not state_dir.exists():
+        return 0
+    freed = 0
+    for path in state_dir.glob("epoch_*.pt"):
+        if path.stem != keep:
+            freed += path.stat().st_size
+            path.unlink()
+    return freed
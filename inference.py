@@ -1,32 +1,219 @@
 from common import (
     get_user_checkpoint_path,
-    SYSTEM_PROMPT,
     MODEL_PATH,
+    SYSTEM_PROMPT,
     vllm_image,
     output_vol,
     VOL_MOUNT_PATH,
     MINUTES,
     app,
 )
+from inference_engines import Adapter, EngineOutput, GenerationParams, InferenceEngine, create_engine
+from inference_metrics import METRICS_DUMP_INTERVAL, InferenceMetrics, RequestMetrics
+from model_provisioning import model_ready
+from parsing_helpers import choose_anchor_line
 
+from dataclasses import dataclass
 from typing import Optional, AsyncIterator
+import asyncio
+import inspect
+import math
+import os
+import threading
 import time
-from pathlib import Path
+import uuid
 import modal
-from modal import Image, Function, Secret, Stub
-from modal import asgi_app, method
 
 
+DEFAULT_INFERENCE_BACKEND = "vllm"
+
+REVIEW_PARAMS = GenerationParams(
+    repetition_penalty=1.1,
+    temperature=0.2,
+    top_p=0.95,
+    top_k=50,
+    max_tokens=1024,
+)
 
+# One-line review mode: the system prompt asks for a single line, so stop there
+REVIEW_MAX_TOKENS = 96
+ONE_LINE_PARAMS = GenerationParams(
+    repetition_penalty=1.1,
+    temperature=0.2,
+    top_p=0.95,
+    top_k=50,
+    max_tokens=REVIEW_MAX_TOKENS,
+    stop=["\n"],
+    logprobs=True,
+)
 
-# Inference Module
-with vllm_image.imports():
-    from vllm.engine.arg_utils import AsyncEngineArgs
-    from vllm.engine.async_llm_engine import AsyncLLMEngine
-    from vllm.lora.request import LoRARequest
-    from vllm.sampling_params import SamplingParams
-    from vllm.utils import random_uuid
 
+@dataclass
+class ReviewResult:
+    """A single-line review comment generated for one hunk."""
+    comment: str
+    line: int  # anchor line in the new file
+    logprob: Optional[float]  # cumulative logprob of the comment tokens, if the backend reports it
+    confidence: Optional[float]  # geometric-mean token probability in [0, 1]
+    prompt_tokens: int
+    completion_tokens: int
+
+
+@dataclass
+class ReviewRequest:
+    """One (hunk, reviewer) pair to review in a batch."""
+    hunk_text: str
+    new_start: int
+    file_path: str
+    username: str
+    repo_owner: Optional[str] = None
+    repo_name: Optional[str] = None
+
+
+def build_conversation(code_content: str, file_path: str, username: str) -> list[dict]:
+    """Build the chat conversation used to ask for a review of `code_content`."""
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT.replace("{USERNAME}", username)},
+        {"role": "user", "content": f"File: {file_path}\n\nCode:\n```\n{code_content}\n```"}
+    ]
+
+
+class ReviewGenerator:
+    """Backend-agnostic review generation shared by every `Inference` flavour.
+
+    Every request is timed and recorded in `self.metrics`. When `persist` is
+    set (inside Modal), `start_metrics_dumps` writes snapshots to the volume
+    once a minute from a background thread, off the request path. Volume
+    reloads and commits are serialized by `volume_lock`, since Modal does not
+    allow them to overlap.
+    """
+
+    def __init__(self, engine: InferenceEngine, persist: bool = True):
+        self.engine = engine
+        self.persist = persist
+        self.loras: dict[str, int] = dict()  # per replica LoRA identifier
+        self.warm_adapters: set[str] = set()
+        self.metrics = InferenceMetrics()
+        self.volume_lock = threading.Lock()  # held across every output_vol reload and commit on this replica
+
+    def adapter_for(self, username: str, repo_owner: Optional[str], repo_name: Optional[str]) -> Adapter:
+        if self.persist:
+            with self.volume_lock:
+                output_vol.reload()
+        checkpoint_path = get_user_checkpoint_path(username, repo_name)
+
+        # Each checkpoint version gets its own ID, so a refreshed adapter is loaded instead of the cached one
+        ident = f"{username}-{repo_owner}-{checkpoint_path.name}"
+        if ident not in self.loras:
+            self.loras[ident] = len(self.loras) + 1
+        return Adapter(ident, self.loras[ident], checkpoint_path)
+
+    async def _generate(self, conversation: list[dict], params: GenerationParams, adapter: Adapter) -> AsyncIterator[EngineOutput]:
+        """Run one request through the engine, recording its metrics."""
+        t0 = time.monotonic()
+        in_flight = self.metrics.request_started()
+        request_metrics, ttft, output = None, None, None
+        try:
+            prompt = await self.engine.render_prompt(conversation, adapter)
+            async for output in self.engine.generate(prompt, params, uuid.uuid4().hex, adapter):
+                if ttft is None and output.num_generated_tokens:
+                    ttft = time.monotonic() - t0
+                yield output
+
+            if output is not None:
+                request_metrics = RequestMetrics(
+                    queue_wait=output.queue_time,
+                    ttft=ttft,
+                    latency=time.monotonic() - t0,
+                    prompt_tokens=output.num_prompt_tokens,
+                    completion_tokens=output.num_generated_tokens,
+                    cached_prompt_tokens=output.num_cached_tokens,
+                    in_flight=in_flight,
+                )
+            # The first request through an adapter on this replica includes loading it
+            if adapter.name not in self.warm_adapters and ttft is not None:
+                self.warm_adapters.add(adapter.name)
+                self.metrics.observe_adapter_first_ttft(ttft)
+        finally:
+            self.metrics.request_finished(request_metrics)
+
+    def dump_metrics(self):
+        """Persist this replica's metrics snapshot to the volume."""
+        with self.volume_lock:
+            self.metrics.dump()
+            output_vol.commit()
+
+    def start_metrics_dumps(self, interval: float = METRICS_DUMP_INTERVAL):
+        """Dump metrics every `interval` seconds from a daemon thread, so idle replicas stay visible at /metrics."""
+        def dump_periodically():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.dump_metrics()
+                except Exception as e:
+                    print(f"Failed to dump inference metrics: {e}")
+
+        threading.Thread(target=dump_periodically, daemon=True).start()
+
+    async def stream(
+        self,
+        code_content: str,
+        file_path: str,
+        username: str,
+        repo_owner: Optional[str] = None,
+        repo_name: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        adapter = self.adapter_for(username, repo_owner, repo_name)
+        print(f"Using LoRA {adapter} for {username} on {self.engine.name}")
+
+        conversation = build_conversation(code_content, file_path, username)
+        index = 0
+        async for output in self._generate(conversation, REVIEW_PARAMS, adapter):
+            if len(output.text) > index:
+                yield output.text[index:]
+            index = len(output.text)
+
+    async def review(
+        self,
+        hunk_text: str,
+        new_start: int,
+        file_path: str,
+        username: str,
+        repo_owner: Optional[str] = None,
+        repo_name: Optional[str] = None
+    ) -> ReviewResult:
+        adapter = self.adapter_for(username, repo_owner, repo_name)
+        conversation = build_conversation(hunk_text, file_path, username)
+
+        output = None
+        async for output in self._generate(conversation, ONE_LINE_PARAMS, adapter):
+            pass
+
+        comment = output.text.strip() if output else ""
+        completion_tokens = output.num_generated_tokens if output else 0
+        logprob = output.cumulative_logprob if output else None
+        confidence = None
+        if logprob is not None and completion_tokens:
+            confidence = math.exp(logprob / completion_tokens)
+
+        return ReviewResult(
+            comment=comment,
+            line=choose_anchor_line(hunk_text, new_start, comment),
+            logprob=logprob,
+            confidence=confidence,
+            prompt_tokens=output.num_prompt_tokens if output else 0,
+            completion_tokens=completion_tokens,
+        )
+
+    async def review_batch(self, requests: list[ReviewRequest]) -> list[ReviewResult]:
+        # Submitting everything at once lets the engine batch across reviewer adapters
+        return await asyncio.gather(*[
+            self.review(r.hunk_text, r.new_start, r.file_path, r.username, r.repo_owner, r.repo_name)
+            for r in requests
+        ])
+
+
+# Inference Module
 @app.cls(
     image=vllm_image,
     gpu="L40S",
@@ -39,85 +226,181 @@ class Inference:
     @modal.enter()
     def enter(self):
         """Initialize the inference engine."""
-        engine_args = AsyncEngineArgs(
-            model=str(MODEL_PATH) if isinstance(MODEL_PATH, Path) else MODEL_PATH,
-            gpu_memory_utilization=0.95,
-            tensor_parallel_size=1,
-            enable_lora=True,
-            enforce_eager=True,
-            max_lora_rank=32,
-            max_model_len=4096,
-            max_loras=16,
-            enable_prefix_caching=True,
-        )
-        self.engine = AsyncLLMEngine.from_engine_args(engine_args)
-        self.loras: dict[str, int] = dict()  # per replica LoRA identifier
+        backend = os.environ.get("INFERENCE_BACKEND", DEFAULT_INFERENCE_BACKEND)
+        if backend == "vllm" and not model_ready():
+            # Never start vLLM on a partial download, and never block a cold start on a download
+            raise RuntimeError(
+                f"Base model at {MODEL_PATH} is not provisioned; run "
+                "`modal run model_provisioning.py::provision_base_model`"
+            )
+        self.generator = ReviewGenerator(create_engine(backend))
+        self.generator.start_metrics_dumps()
 
     @modal.method()
     async def generate(
-        self, 
-        code_content: str, 
-        file_path: str, 
-        username: str, 
+        self,
+        code_content: str,
+        file_path: str,
+        username: str,
         repo_owner: Optional[str] = None,
         repo_name: Optional[str] = None
     ) -> AsyncIterator[str]:
         """Generate a code review comment for the given code.
-        
+
         Args:
             code_content: The code to review
             file_path: Path to the file being reviewed
             username: GitHub username of reviewer to emulate
             repo_owner: Repository owner for model path
-            
+
         Returns:
             Generated comment as an async stream
         """
-        ident = f"{username}-{repo_owner}"
-        if ident not in self.loras:
-            self.loras[ident] = len(self.loras) + 1
-        
-        output_vol.reload()
-        checkpoint_path = get_user_checkpoint_path(username, repo_name)
-        lora_request = LoRARequest(ident, self.loras[ident], lora_local_path=checkpoint_path)
-        print(f"Using LoRA {lora_request} for {username}")
-
-        tokenizer = await self.engine.get_tokenizer(lora_request=lora_request)
-        
-        # Prepare prompt
-        conversation = [
-            {"role": "system", "content": SYSTEM_PROMPT.replace("{USERNAME}", username)},
-            {"role": "user", "content": f"File: {file_path}\n\nCode:\n```\n{code_content}\n```"}
-        ]
-        
-        prompt = tokenizer.apply_chat_template(
-            conversation=conversation, 
-            tokenize=False, 
-            add_generation_prompt=True
-        )
-        
-        sampling_params = SamplingParams(
-            repetition_penalty=1.1,
-            temperature=0.2,
-            top_p=0.95,
-            top_k=50,
-            max_tokens=1024,
-        )
-        
-        request_id = random_uuid()
-        results_generator = self.engine.generate(
-            prompt,
-            sampling_params,
-            request_id,
-            lora_request=lora_request,
-        )
+        async for chunk in self.generator.stream(code_content, file_path, username, repo_owner, repo_name):
+            yield chunk
+
+    @modal.method()
+    async def review(
+        self,
+        hunk_text: str,
+        new_start: int,
+        file_path: str,
+        username: str,
+        repo_owner: Optional[str] = None,
+        repo_name: Optional[str] = None
+    ) -> ReviewResult:
+        """Generate a one-line review comment for a diff hunk.
+
+        Generation stops at the first newline under a small token budget and
+        the whole result is returned at once instead of streamed.
+
+        Args:
+            hunk_text: The diff hunk to review, including its header
+            new_start: First line of the hunk in the new file
+            file_path: Path to the file being reviewed
+            username: GitHub username of reviewer to emulate
+            repo_owner: Repository owner for model path
+
+        Returns:
+            The comment, its anchor line, score and token counts
+        """
+        return await self.generator.review(hunk_text, new_start, file_path, username, repo_owner, repo_name)
+
+    @modal.method()
+    async def review_batch(self, requests: list[ReviewRequest]) -> list[ReviewResult]:
+        """Review many (hunk, reviewer) pairs in one call.
+
+        All requests are submitted to the engine together, so hunks for
+        different reviewers share batches through multi-LoRA serving.
+
+        Args:
+            requests: The hunks to review and the reviewer to emulate for each
+
+        Returns:
+            One result per request, in the same order
+        """
+        return await self.generator.review_batch(requests)
+
+    @modal.method()
+    def metrics(self) -> dict:
+        """Return this replica's metrics snapshot (histograms, in-flight counts)."""
+        return self.generator.metrics.snapshot()
+
+    @modal.exit()
+    def exit(self):
+        """Persist the final metrics snapshot before the replica scales down."""
+        self.generator.dump_metrics()
+
+
+class _LocalCall:
+    """Mimics a Modal method call style (`f(...)` and `f.aio(...)`) for in-process calls."""
+
+    def __init__(self, sync_fn, async_fn):
+        self._sync_fn = sync_fn
+        self.aio = async_fn
+
+    def __call__(self, *args, **kwargs):
+        return self._sync_fn(*args, **kwargs)
+
+
+class _LocalMethod:
+    """In-process stand-in for a `modal.method` handle.
+
+    Wraps an async generator (`remote_gen`), a coroutine or a plain function
+    (`remote`). Calls run on the owning event loop's thread, so a handle can be
+    used from any thread, or from another event loop through `.aio`.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, fn):
+        self._loop = loop
+        self._fn = fn
+        if inspect.isasyncgenfunction(fn):
+            self.remote_gen = _LocalCall(self._iterate, self._aiterate)
+        self.remote = _LocalCall(self._call, self._call_aio)
+
+    async def _coro(self, *args, **kwargs):
+        if inspect.isasyncgenfunction(self._fn):
+            return [chunk async for chunk in self._fn(*args, **kwargs)]
+        if inspect.iscoroutinefunction(self._fn):
+            return await self._fn(*args, **kwargs)
+        return self._fn(*args, **kwargs)
+
+    def _submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def _call(self, *args, **kwargs):
+        return self._submit(self._coro(*args, **kwargs)).result()
+
+    async def _call_aio(self, *args, **kwargs):
+        return await asyncio.wrap_future(self._submit(self._coro(*args, **kwargs)))
+
+    @staticmethod
+    async def _next(agen):
+        return await agen.__anext__()
+
+    def _iterate(self, *args, **kwargs):
+        agen = self._fn(*args, **kwargs)
+        while True:
+            try:
+                yield self._submit(self._next(agen)).result()
+            except StopAsyncIteration:
+                return
+
+    async def _aiterate(self, *args, **kwargs):
+        agen = self._fn(*args, **kwargs)
+        while True:
+            try:
+                yield await asyncio.wrap_future(self._submit(self._next(agen)))
+            except StopAsyncIteration:
+                return
+
+
+class LocalInference:
+    """Runs `Inference` in-process on a CPU-friendly backend ("cpu" or "fake").
+
+    Exposes the same `generate.remote_gen(...)`, `review.remote(...)`,
+    `review_batch.remote(...)` and `metrics.remote()` call styles as the
+    Modal class so the review pipeline can run unchanged without a GPU. The
+    engine lives on a background event loop, so concurrent callers are
+    batched the way a replica would batch them.
+    """
+
+    def __init__(self, backend: str = "fake", **engine_kwargs):
+        self.generator = ReviewGenerator(create_engine(backend, **engine_kwargs), persist=False)
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name=f"local-inference-{backend}", daemon=True).start()
+        self.generate = _LocalMethod(self._loop, self.generator.stream)
+        self.review = _LocalMethod(self._loop, self.generator.review)
+        self.review_batch = _LocalMethod(self._loop, self.generator.review_batch)
+        self.metrics = _LocalMethod(self._loop, self.generator.metrics.snapshot)
+
 
-        t0 = time.time()
-        index, tokens = 0, 0
-        async for request_output in results_generator:
-            yield request_output.outputs[0].text[index:]
-            index = len(request_output.outputs[0].text)
+def get_inference(backend: Optional[str] = None):
+    """Return the Modal `Inference` handle, or a `LocalInference` for CPU backends.
 
-        tokens = len(request_output.outputs[0].token_ids)
-        throughput = tokens / (time.time() - t0)
-        print(f"🧠: Effective throughput of {throughput:.2f} tok/s")
+    The backend defaults to the `INFERENCE_BACKEND` environment variable.
+    """
+    backend = backend or os.environ.get("INFERENCE_BACKEND", DEFAULT_INFERENCE_BACKEND)
+    if backend == DEFAULT_INFERENCE_BACKEND:
+        return Inference()
+    return LocalInference(backend)
@@ -0,0 +1,331 @@
+from common import (
+    MAX_LORA_RANK,
+    MODEL_PATH,
+    vllm_image,
+)
+
+import asyncio
+import hashlib
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional
+
+
+# Inference backends
+with vllm_image.imports():
+    from vllm.engine.arg_utils import AsyncEngineArgs
+    from vllm.engine.async_llm_engine import AsyncLLMEngine
+    from vllm.lora.request import LoRARequest
+    from vllm.sampling_params import SamplingParams
+
+CPU_MODEL_NAME = "HuggingFaceTB/SmolLM2-135M-Instruct"  # small enough to run on a laptop
+
+
+@dataclass
+class GenerationParams:
+    """Backend-independent sampling parameters."""
+    max_tokens: int = 1024
+    temperature: float = 0.2
+    top_p: float = 0.95
+    top_k: int = 50
+    repetition_penalty: float = 1.1
+    stop: List[str] = field(default_factory=list)
+    logprobs: bool = False  # report the cumulative logprob of the sampled tokens
+
+
+@dataclass
+class Adapter:
+    """A reviewer's LoRA adapter as seen by an engine."""
+    name: str
+    id: int
+    path: Path
+
+
+@dataclass
+class EngineOutput:
+    """Cumulative state of a generation request, yielded as it progresses."""
+    text: str
+    num_prompt_tokens: int
+    num_generated_tokens: int
+    finished: bool
+    cumulative_logprob: Optional[float] = None
+    queue_time: Optional[float] = None  # seconds spent waiting before being scheduled
+    num_cached_tokens: Optional[int] = None  # prompt tokens served from the prefix cache
+
+
+class InferenceEngine(ABC):
+    """Interface shared by every inference backend.
+
+    Engines turn a chat conversation into a prompt and stream cumulative
+    `EngineOutput`s for it, optionally with a reviewer adapter applied.
+    """
+    name = "base"
+
+    @abstractmethod
+    async def render_prompt(self, conversation: List[Dict[str, str]], adapter: Optional[Adapter] = None) -> str:
+        """Apply the chat template to a conversation."""
+
+    @abstractmethod
+    def generate(
+        self,
+        prompt: str,
+        params: GenerationParams,
+        request_id: str,
+        adapter: Optional[Adapter] = None,
+    ) -> AsyncIterator[EngineOutput]:
+        """Stream cumulative outputs for a prompt until the request finishes."""
+
+
+def _apply_stop(text: str, stop: List[str]) -> tuple[str, bool]:
+    """Cut text at the first stop sequence, returning (text, stopped)."""
+    cut = min((text.find(s) for s in stop if s in text), default=-1)
+    if cut == -1:
+        return text, False
+    return text[:cut], True
+
+
+class VLLMEngine(InferenceEngine):
+    """vLLM engine serving the base model with per-reviewer LoRA adapters on GPU."""
+    name = "vllm"
+
+    def __init__(self, model_path: Path = MODEL_PATH):
+        engine_args = AsyncEngineArgs(
+            model=str(model_path),
+            gpu_memory_utilization=0.95,
+            tensor_parallel_size=1,
+            enable_lora=True,
+            enforce_eager=True,
+            max_lora_rank=MAX_LORA_RANK,
+            max_model_len=4096,
+            max_loras=16,
+            enable_prefix_caching=True,
+        )
+        self.engine = AsyncLLMEngine.from_engine_args(engine_args)
+
+    def _lora_request(self, adapter: Optional[Adapter]):
+        if adapter is None:
+            return None
+        return LoRARequest(adapter.name, adapter.id, lora_local_path=str(adapter.path))
+
+    async def render_prompt(self, conversation, adapter=None):
+        # Adapters are exported without tokenizer files; every reviewer shares the base tokenizer
+        tokenizer = await self.engine.get_tokenizer()
+        return tokenizer.apply_chat_template(
+            conversation=conversation,
+            tokenize=False,
+            add_generation_prompt=True
+        )
+
+    async def generate(self, prompt, params, request_id, adapter=None):
+        sampling_params = SamplingParams(
+            repetition_penalty=params.repetition_penalty,
+            temperature=params.temperature,
+            top_p=params.top_p,
+            top_k=params.top_k,
+            max_tokens=params.max_tokens,
+            stop=params.stop or None,
+            logprobs=0 if params.logprobs else None,
+        )
+        results_generator = self.engine.generate(
+            prompt,
+            sampling_params,
+            request_id,
+            lora_request=self._lora_request(adapter),
+        )
+        async for request_output in results_generator:
+            output = request_output.outputs[0]
+            request_metrics = getattr(request_output, "metrics", None)
+            yield EngineOutput(
+                text=output.text,
+                num_prompt_tokens=len(request_output.prompt_token_ids or []),
+                num_generated_tokens=len(output.token_ids),
+                finished=request_output.finished,
+                cumulative_logprob=output.cumulative_logprob if params.logprobs else None,
+                queue_time=getattr(request_metrics, "time_in_queue", None),
+                num_cached_tokens=getattr(request_output, "num_cached_tokens", None),
+            )
+
+
+class CPUEngine(InferenceEngine):
+    """Small causal LM on CPU via transformers, for development without a GPU.
+
+    Reviewer adapters are applied with peft when it is installed and the
+    adapter matches the base model; otherwise the base model is used.
+    """
+    name = "cpu"
+
+    def __init__(self, model_name: str = CPU_MODEL_NAME):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForCausalLM.from_pretrained(model_name)
+        self.model.eval()
+        self.loaded_adapters: set[str] = set()
+        # transformers models are not safe to drive from several threads at once
+        self.lock = asyncio.Lock()
+
+    async def render_prompt(self, conversation, adapter=None):
+        if self.tokenizer.chat_template:
+            return self.tokenizer.apply_chat_template(
+                conversation=conversation,
+                tokenize=False,
+                add_generation_prompt=True
+            )
+        return "".join(f"{m['role']}: {m['content']}\n" for m in conversation) + "assistant: "
+
+    def _select_adapter(self, adapter: Optional[Adapter]):
+        """Return the model to generate with, activating the adapter if possible."""
+        if adapter is None or not (adapter.path / "adapter_config.json").exists():
+            return self.model
+        try:
+            from peft import PeftModel
+        except ImportError:
+            return self.model
+
+        try:
+            if not isinstance(self.model, PeftModel):
+                self.model = PeftModel.from_pretrained(self.model, str(adapter.path), adapter_name=adapter.name)
+            elif adapter.name not in self.loaded_adapters:
+                self.model.load_adapter(str(adapter.path), adapter_name=adapter.name)
+            self.loaded_adapters.add(adapter.name)
+            self.model.set_adapter(adapter.name)
+            return self.model
+        except Exception as e:
+            print(f"Could not apply adapter {adapter.name} on CPU, using base model: {e}")
+            return self.model.get_base_model() if isinstance(self.model, PeftModel) else self.model
+
+    async def generate(self, prompt, params, request_id, adapter=None):
+        from threading import Thread
+        from transformers import TextIteratorStreamer
+
+        t_queued = time.monotonic()
+        async with self.lock:
+            queue_time = time.monotonic() - t_queued
+            model = self._select_adapter(adapter)
+            inputs = self.tokenizer(prompt, return_tensors="pt")
+            num_prompt_tokens = int(inputs["input_ids"].shape[-1])
+            streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+            worker = Thread(target=model.generate, kwargs=dict(
+                **inputs,
+                streamer=streamer,
+                max_new_tokens=params.max_tokens,
+                do_sample=params.temperature > 0,
+                temperature=params.temperature or None,
+                top_p=params.top_p,
+                top_k=params.top_k,
+                repetition_penalty=params.repetition_penalty,
+            ))
+            worker.start()
+
+            text, stopped = "", False
+            while not stopped:
+                delta = await asyncio.to_thread(next, streamer, None)
+                if delta is None:
+                    break
+                text, stopped = _apply_stop(text + delta, params.stop)
+                yield EngineOutput(
+                    text=text,
+                    num_prompt_tokens=num_prompt_tokens,
+                    num_generated_tokens=len(self.tokenizer.encode(text, add_special_tokens=False)),
+                    finished=False,
+                    queue_time=queue_time,
+                )
+            # Drain the streamer so the generation thread can exit
+            await asyncio.to_thread(lambda: [_ for _ in streamer])
+            await asyncio.to_thread(worker.join)
+
+        yield EngineOutput(
+            text=text,
+            num_prompt_tokens=num_prompt_tokens,
+            num_generated_tokens=len(self.tokenizer.encode(text, add_special_tokens=False)),
+            finished=True,
+            queue_time=queue_time,
+        )
+
+
+class FakeEngine(InferenceEngine):
+    """Deterministic engine with a configurable per-token latency.
+
+    The same prompt always produces the same comment, which makes it suitable
+    for exercising and benchmarking the review pipeline without any model.
+    `max_batch_size` caps concurrent requests so queueing can be simulated.
+    """
+    name = "fake"
+
+    COMMENTS = [
+        "Did you test this at all, or are we just vibing?",
+        "This naming is a crime scene, please pick something descriptive.",
+        "Pull this into a helper instead of copy-pasting it again.",
+        "Missing error handling here, what happens when this fails?",
+        "This loop is doing way more work than it needs to.",
+        "Nit: this comment describes what the code does, not why.",
+    ]
+
+    def __init__(self, token_latency: float = 0.01, prefill_latency: float = 0.0, max_batch_size: Optional[int] = None):
+        self.token_latency = token_latency
+        self.prefill_latency = prefill_latency
+        self.slots = asyncio.Semaphore(max_batch_size) if max_batch_size else None
+
+    async def render_prompt(self, conversation, adapter=None):
+        return "".join(f"{m['role']}: {m['content']}\n" for m in conversation) + "assistant: "
+
+    async def generate(self, prompt, params, request_id, adapter=None):
+        if self.slots is None:
+            async for output in self._generate(prompt, params, adapter, queue_time=0.0):
+                yield output
+            return
+
+        t_queued = time.monotonic()
+        async with self.slots:
+            async for output in self._generate(prompt, params, adapter, queue_time=time.monotonic() - t_queued):
+                yield output
+
+    async def _generate(self, prompt, params, adapter, queue_time):
+        seed = f"{adapter.name if adapter else ''}\n{prompt}".encode()
+        index = int(hashlib.sha256(seed).hexdigest(), 16) % len(self.COMMENTS)
+        words = self.COMMENTS[index].split(" ")
+        num_prompt_tokens = len(prompt.split())
+
+        if self.prefill_latency:
+            await asyncio.sleep(self.prefill_latency)
+
+        # A fixed, seed-dependent per-token logprob keeps scores deterministic
+        token_logprob = -0.05 * (1 + index) if params.logprobs else None
+
+        def output(text: str, generated: int, finished: bool) -> EngineOutput:
+            return EngineOutput(
+                text=text,
+                num_prompt_tokens=num_prompt_tokens,
+                num_generated_tokens=generated,
+                finished=finished,
+                cumulative_logprob=None if token_logprob is None else token_logprob * generated,
+                queue_time=queue_time,
+            )
+
+        text, generated = "", 0
+        for i, word in enumerate(words[:params.max_tokens]):
+            if self.token_latency:
+                await asyncio.sleep(self.token_latency)
+            text, stopped = _apply_stop(text + (" " if i else "") + word, params.stop)
+            generated += 1
+            if stopped:
+                break
+            yield output(text, generated, finished=False)
+
+        yield output(text, generated, finished=True)
+
+
+ENGINES = {
+    VLLMEngine.name: VLLMEngine,
+    CPUEngine.name: CPUEngine,
+    FakeEngine.name: FakeEngine,
+}
+
+
+def create_engine(backend: str, **kwargs) -> InferenceEngine:
+    """Instantiate the inference backend registered under `backend`."""
+    if backend not in ENGINES:
+        raise ValueError(f"Unknown inference backend {backend!r}, expected one of {sorted(ENGINES)}")
+    return ENGINES[backend](**kwargs)
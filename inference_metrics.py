@@ -0,0 +1,223 @@
+from common import VOL_MOUNT_PATH, MINUTES
+
+import json
+import os
+import time
+import uuid
+from bisect import bisect_left
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+
+METRICS_DIR = VOL_MOUNT_PATH / "metrics" / "inference"
+METRICS_DUMP_INTERVAL = 1 * MINUTES
+SNAPSHOT_MAX_AGE = 5 * METRICS_DUMP_INTERVAL  # live replicas dump every interval; older snapshots are from replicas that are gone
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+RATE_BUCKETS = [1, 5, 10, 25, 50, 100, 200, 400, 800, 1600]
+TOKEN_BUCKETS = [16, 64, 128, 256, 512, 1024, 2048, 4096]
+CONCURRENCY_BUCKETS = [1, 2, 4, 8, 16, 32, 50, 64, 128]
+
+
+class Histogram:
+    """Fixed-bucket histogram in the Prometheus style (cumulative `le` buckets)."""
+
+    def __init__(self, buckets: Iterable[float]):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other: "Histogram"):
+        if other.buckets != self.buckets:
+            raise ValueError("Cannot merge histograms with different buckets")
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimate a quantile by linear interpolation inside its bucket."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            if seen + c >= rank and c:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / c
+            seen += c
+        return self.buckets[-1]
+
+    def to_dict(self) -> dict:
+        return {"buckets": self.buckets, "counts": self.counts, "count": self.count, "sum": self.sum}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Histogram":
+        hist = cls(data["buckets"])
+        hist.counts = list(data["counts"])
+        hist.count = data["count"]
+        hist.sum = data["sum"]
+        return hist
+
+
+@dataclass
+class RequestMetrics:
+    """Timings and token counts of one generation request."""
+    queue_wait: Optional[float]
+    ttft: Optional[float]
+    latency: float
+    prompt_tokens: int
+    completion_tokens: int
+    cached_prompt_tokens: Optional[int]
+    in_flight: int  # requests in flight on this replica when this one started
+
+    @property
+    def decode_tokens_per_s(self) -> Optional[float]:
+        if self.ttft is None or self.completion_tokens < 2 or self.latency <= self.ttft:
+            return None
+        return (self.completion_tokens - 1) / (self.latency - self.ttft)
+
+
+HISTOGRAMS = {
+    "queue_wait_seconds": LATENCY_BUCKETS,
+    "time_to_first_token_seconds": LATENCY_BUCKETS,
+    "request_latency_seconds": LATENCY_BUCKETS,
+    "decode_tokens_per_second": RATE_BUCKETS,
+    "prompt_tokens": TOKEN_BUCKETS,
+    "completion_tokens": TOKEN_BUCKETS,
+    "prefix_cache_hit_tokens": TOKEN_BUCKETS,
+    "adapter_first_ttft_seconds": LATENCY_BUCKETS,
+    "in_flight_requests": CONCURRENCY_BUCKETS,
+}
+
+
+class InferenceMetrics:
+    """Per-replica aggregation of `RequestMetrics` into histograms.
+
+    Snapshots are dumped to the volume periodically so the web app can serve
+    the merged view of every replica at `/metrics`.
+    """
+
+    def __init__(self, replica_id: Optional[str] = None):
+        self.replica_id = replica_id or os.environ.get("MODAL_TASK_ID") or uuid.uuid4().hex[:12]
+        self.histograms = {name: Histogram(buckets) for name, buckets in HISTOGRAMS.items()}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+        self.errors = 0
+
+    def request_started(self) -> int:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return self.in_flight
+
+    def request_finished(self, metrics: Optional[RequestMetrics]):
+        self.in_flight -= 1
+        self.requests += 1
+        if metrics is None:
+            self.errors += 1
+            return
+
+        observations = {
+            "queue_wait_seconds": metrics.queue_wait,
+            "time_to_first_token_seconds": metrics.ttft,
+            "request_latency_seconds": metrics.latency,
+            "decode_tokens_per_second": metrics.decode_tokens_per_s,
+            "prompt_tokens": metrics.prompt_tokens,
+            "completion_tokens": metrics.completion_tokens,
+            "prefix_cache_hit_tokens": metrics.cached_prompt_tokens,
+            "in_flight_requests": metrics.in_flight,
+        }
+        for name, value in observations.items():
+            if value is not None:
+                self.histograms[name].observe(value)
+
+    def observe_adapter_first_ttft(self, seconds: float):
+        """Record the time-to-first-token of the first request through an adapter on this replica."""
+        self.histograms["adapter_first_ttft_seconds"].observe(seconds)
+
+    def snapshot(self) -> dict:
+        return {
+            "replica_id": self.replica_id,
+            "timestamp": time.time(),
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "histograms": {name: h.to_dict() for name, h in self.histograms.items()},
+        }
+
+    def dump(self, directory: Path = METRICS_DIR) -> Path:
+        """Write this replica's snapshot to `directory/<replica_id>.json`."""
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f"{self.replica_id}.json"
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.snapshot(), f)
+        tmp_path.replace(path)
+        return path
+
+
+def load_snapshots(directory: Path = METRICS_DIR, max_age: Optional[float] = SNAPSHOT_MAX_AGE, prune: bool = False) -> List[dict]:
+    """Load replica snapshots from the volume, skipping those older than `max_age` seconds.
+
+    Args:
+        directory: Where replicas dump their snapshots
+        max_age: Oldest snapshot to report, or None for all of them
+        prune: Delete the skipped snapshots from the volume
+
+    Returns:
+        The snapshots of live replicas
+    """
+    if not directory.exists():
+        return []
+    snapshots = []
+    for path in sorted(directory.glob("*.json")):
+        with open(path) as f:
+            snapshot = json.load(f)
+        if max_age is None or time.time() - snapshot["timestamp"] <= max_age:
+            snapshots.append(snapshot)
+        elif prune:
+            path.unlink(missing_ok=True)
+    return snapshots
+
+
+def render_prometheus(snapshots: List[dict], prefix: str = "inference") -> str:
+    """Render replica snapshots in the Prometheus text exposition format.
+
+    Histograms are merged across replicas; gauges are reported per replica.
+    """
+    lines: List[str] = []
+    merged: Dict[str, Histogram] = {}
+    for snapshot in snapshots:
+        for name, data in snapshot["histograms"].items():
+            hist = Histogram.from_dict(data)
+            if name in merged:
+                merged[name].merge(hist)
+            else:
+                merged[name] = hist
+
+    for name, hist in merged.items():
+        metric = f"{prefix}_{name}"
+        lines.append(f"# TYPE {metric} histogram")
+        cumulative = 0
+        for bound, count in zip(hist.buckets + ["+Inf"], hist.counts):
+            cumulative += count
+            lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"{metric}_sum {hist.sum}")
+        lines.append(f"{metric}_count {hist.count}")
+
+    for gauge, kind in (("in_flight", "gauge"), ("max_in_flight", "gauge"), ("requests", "counter"), ("errors", "counter")):
+        metric = f"{prefix}_{gauge}" + ("_total" if kind == "counter" else "")
+        lines.append(f"# TYPE {metric} {kind}")
+        for snapshot in snapshots:
+            lines.append(f'{metric}{{replica="{snapshot["replica_id"]}"}} {snapshot[gauge]}')
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,114 @@
+import random
+from dataclasses import dataclass
+from typing import Iterator, List, Sequence
+
+BUCKET_BATCHES = 50  # batches per bucket; larger groups lengths more tightly but shuffles less
+
+
+@dataclass
+class PaddingReport:
+    """Tokens spent on padding per epoch, with and without length bucketing."""
+    tokens: int
+    bucketed_padding: int
+    shuffled_padding: int
+
+    @property
+    def savings(self) -> float:
+        """Fraction of the shuffled batches' padding that bucketing avoids."""
+        return 1 - self.bucketed_padding / self.shuffled_padding if self.shuffled_padding else 0.0
+
+    def __str__(self) -> str:
+        bucketed = self.bucketed_padding / (self.tokens + self.bucketed_padding)
+        shuffled = self.shuffled_padding / (self.tokens + self.shuffled_padding)
+        return (
+            f"padding {bucketed:.1%} of batch tokens with length bucketing vs {shuffled:.1%} shuffled "
+            f"({self.savings:.0%} of padded tokens saved)"
+        )
+
+
+def padding_tokens(lengths: Sequence[int], batches: List[List[int]]) -> int:
+    """Padding added when each batch is padded to its longest example."""
+    return sum(len(batch) * max(lengths[i] for i in batch) - sum(lengths[i] for i in batch) for batch in batches)
+
+
+class LengthBucketedBatchSampler:
+    """Batch sampler that groups examples of similar token length.
+
+    Each epoch shuffles the examples, splits them into buckets of
+    `bucket_batches` batches, sorts every bucket by length and cuts it into
+    batches, then shuffles the order of all batches. Examples in a batch are
+    close in length, so padding to the longest one wastes little, while
+    which examples share a bucket and the order batches are seen in still
+    change every epoch. Pass it as a DataLoader `batch_sampler`.
+
+    Args:
+        lengths: Token length of every example
+        batch_size: Examples per batch
+        shuffle: Randomize bucket contents and batch order
+        seed: Base seed; each epoch uses `seed + epoch`
+        drop_last: Drop the examples that would make up an incomplete batch,
+            chosen at random before bucketing so they are not the longest ones
+        bucket_batches: Batches per bucket
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        batch_size: int,
+        shuffle: bool = True,
+        seed: int = 0,
+        drop_last: bool = True,
+        bucket_batches: int = BUCKET_BATCHES,
+    ):
+        self.lengths = list(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.bucket_size = batch_size * bucket_batches
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _order(self, rng: random.Random) -> List[int]:
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            rng.shuffle(indices)
+        if self.drop_last:
+            # Drop the remainder now; after sorting it would always be the longest examples of the last bucket
+            del indices[len(indices) - len(indices) % self.batch_size:]
+        return indices
+
+    def _chunk(self, indices: List[int]) -> List[List[int]]:
+        return [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+
+    def batches(self, epoch: int) -> List[List[int]]:
+        rng = random.Random(self.seed + epoch)
+        indices = self._order(rng)
+        # Sorting within buckets keeps every bucket but the last a whole number of batches
+        ordered = []
+        for start in range(0, len(indices), self.bucket_size):
+            ordered += sorted(indices[start:start + self.bucket_size], key=self.lengths.__getitem__)
+        batches = self._chunk(ordered)
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def padding_report(self, epoch: int = 0) -> PaddingReport:
+        """Compare this epoch's padding to plain shuffled batches of the same size."""
+        bucketed = self.batches(epoch)
+        shuffled = self._chunk(self._order(random.Random(self.seed + epoch)))
+        return PaddingReport(
+            tokens=sum(self.lengths[i] for batch in bucketed for i in batch),
+            bucketed_padding=padding_tokens(self.lengths, bucketed),
+            shuffled_padding=padding_tokens(self.lengths, shuffled),
+        )
+
+    def __iter__(self) -> Iterator[List[int]]:
+        return iter(self.batches(self.epoch))
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return -(-len(self.lengths) // self.batch_size)
@@ -0,0 +1,271 @@
+"""torchtune's single-device LoRA recipe with early stopping and warm starts.
+
+Run with `tune run lora_early_stopping.py --config ...`. After every epoch's
+checkpoint the adapter is evaluated on `validation_path` (packed like the
+training data, see packed_dataset.py); training stops once validation loss
+has not improved for `early_stopping_patience` epochs, and
+`output_dir/early_stopping.json` records the per-epoch losses and the best
+epoch.
+
+`warm_start_adapter` starts from a previous run's `adapter_model.pt` (and
+`warm_start_optimizer` from its optimizer state) instead of fresh LoRA
+weights. Checkpoints are numbered from `epoch_offset`, so a warm-started run
+writes new `epoch_N` versions next to the ones it started from.
+
+With `adapters_file` (a YAML list of per-adapter override lists) the recipe
+trains several adapters in one process: the base model is loaded once and
+only its LoRA weights are reset between adapters. `batch_report` receives
+per-adapter status and timing.
+
+With `length_bucketing: True` an unpacked dataset is batched by
+`length_bucketing.LengthBucketedBatchSampler`, which groups examples of
+similar length so batches carry little padding; the padding saved is logged.
+"""
+import json
+import sys
+import time
+from functools import partial
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+import torch
+from omegaconf import DictConfig, OmegaConf
+from torch import nn
+from torch.utils.data import DataLoader
+from torchtune import config, training, utils
+from torchtune.config._utils import _get_component_from_path
+from torchtune.data import padded_collate_packed
+from torchtune.modules.peft import LoRALinear, get_adapter_params
+
+from incremental_training import OPTIMIZER_STATE_DIR
+from length_bucketing import LengthBucketedBatchSampler
+from recipes.lora_finetune_single_device import LoRAFinetuneRecipeSingleDevice
+
+log = utils.get_logger("INFO")
+
+EARLY_STOPPING_FILE = "early_stopping.json"
+
+
+class StopTraining(Exception):
+    """Raised after a checkpoint when validation loss has stopped improving."""
+
+
+class LoRAEarlyStoppingRecipe(LoRAFinetuneRecipeSingleDevice):
+    def __init__(self, cfg: DictConfig, base_model: Optional[nn.Module] = None) -> None:
+        super().__init__(cfg)
+        self._base_model = base_model  # set up by a previous adapter in the same batch
+        self._output_dir = Path(cfg.output_dir)
+        self._validation_path: Optional[str] = cfg.get("validation_path", None)
+        self._patience = cfg.get("early_stopping_patience", 1)
+        self._val_losses: Dict[int, float] = {}
+        self._optimizer_state_path: Optional[Path] = None  # written by this run, for the best epoch so far
+        self._epoch_offset = cfg.get("epoch_offset", 0)
+        self._length_bucketing = cfg.get("length_bucketing", False)
+
+    def setup(self, cfg: DictConfig) -> None:
+        super().setup(cfg)
+        if cfg.get("warm_start_adapter", None):
+            self.warm_start(cfg.warm_start_adapter, cfg.get("warm_start_optimizer", None))
+        self._val_dataloader = None
+        if self._validation_path:
+            from packed_dataset import CachedPackedDataset
+
+            self._val_dataloader = DataLoader(
+                CachedPackedDataset(self._validation_path),
+                batch_size=cfg.batch_size,
+                shuffle=False,
+                collate_fn=padded_collate_packed,
+            )
+
+    def load_checkpoint(self, cfg_checkpointer: DictConfig) -> Dict[str, Any]:
+        if self._base_model is None:
+            return super().load_checkpoint(cfg_checkpointer)
+        # The base weights are already on the GPU; the checkpointer is only needed to save the adapter
+        self._checkpointer = config.instantiate(cfg_checkpointer, resume_from_checkpoint=False)
+        return {training.MODEL_KEY: None}
+
+    def _setup_model(
+        self,
+        cfg_model: DictConfig,
+        enable_activation_checkpointing: bool,
+        enable_activation_offloading: bool,
+        compile_model: bool,
+        base_model_state_dict: Dict[str, Any],
+        lora_weights_state_dict: Optional[Dict[str, Any]] = None,
+    ) -> nn.Module:
+        if self._base_model is None:
+            return super()._setup_model(
+                cfg_model, enable_activation_checkpointing, enable_activation_offloading,
+                compile_model, base_model_state_dict, lora_weights_state_dict,
+            )
+
+        # Reuse the frozen base model and start from fresh LoRA weights
+        model = self._base_model
+        for module in model.modules():
+            if isinstance(module, LoRALinear):
+                module.initialize_parameters()
+        for param in model.parameters():
+            param.grad = None
+        self._lora_rank = cfg_model.lora_rank
+        self._lora_alpha = cfg_model.lora_alpha
+        self._lora_attn_modules = list(cfg_model.lora_attn_modules)
+        self._apply_lora_to_mlp = cfg_model.apply_lora_to_mlp
+        self._apply_lora_to_output = getattr(cfg_model, "apply_lora_to_output", False)
+        self.adapter_params = get_adapter_params(model)
+        self._is_dora = False
+        self.activations_handling_ctx = training.get_act_offloading_ctx_manager(model, enable_activation_offloading)
+        log.info("Reusing the base model loaded for the previous adapter.")
+        return model
+
+    def _setup_data(
+        self,
+        cfg_dataset: DictConfig,
+        shuffle: bool,
+        batch_size: int,
+        collate_fn: str,
+    ) -> Tuple[LengthBucketedBatchSampler, DataLoader]:
+        if not self._length_bucketing or cfg_dataset.get("packed", False):
+            return super()._setup_data(cfg_dataset, shuffle, batch_size, collate_fn)
+
+        ds = config.instantiate(cfg_dataset, self._tokenizer)
+        lengths = getattr(ds, "lengths", None) or [len(ds[i]["tokens"]) for i in range(len(ds))]
+        # Only the first epoch's batches are compared; later epochs pad about as much
+        sampler = LengthBucketedBatchSampler(lengths, batch_size, shuffle=shuffle, seed=0, drop_last=True)
+        report = sampler.padding_report()
+        log.info(f"Length bucketing: {report}")
+        self._metric_logger.log_dict(
+            {"padding_tokens_bucketed": report.bucketed_padding, "padding_tokens_shuffled": report.shuffled_padding},
+            step=0,
+        )
+        dataloader = DataLoader(
+            dataset=ds,
+            batch_sampler=sampler,
+            collate_fn=partial(
+                _get_component_from_path(collate_fn),
+                padding_idx=self._tokenizer.pad_id,
+                ignore_idx=self._loss_fn.ignore_index,
+            ),
+        )
+        log.info("Dataset and length-bucketed sampler are initialized.")
+        return sampler, dataloader
+
+    def warm_start(self, adapter_path: str, optimizer_path: Optional[str] = None) -> None:
+        """Load LoRA weights, and optionally AdamW moments, saved by an earlier run."""
+        adapter_state = torch.load(adapter_path, map_location=self._device, weights_only=True)
+        _, unexpected = self._model.load_state_dict(adapter_state, strict=False)
+        if unexpected:
+            raise ValueError(f"Adapter at {adapter_path} does not match the model: {unexpected[:5]}")
+        log.info(f"Warm-started {len(adapter_state)} adapter tensors from {adapter_path}")
+
+        if optimizer_path:
+            # Keep this run's param groups (learning rate and schedule); only the moments carry over
+            optimizer_state = self._optimizer.state_dict()
+            optimizer_state["state"] = torch.load(optimizer_path, map_location=self._device, weights_only=True)
+            self._optimizer.load_state_dict(optimizer_state)
+            log.info(f"Restored optimizer state from {optimizer_path}")
+
+    @torch.no_grad()
+    def validation_loss(self) -> float:
+        """Token-weighted mean loss over the held-out packs."""
+        self._model.eval()
+        total_loss, total_tokens = 0.0, 0
+        for batch in self._val_dataloader:
+            utils.batch_to_device(batch, self._device)
+            num_tokens = (batch["labels"] != self._loss_fn.ignore_index).sum().item()
+            total_loss += self._loss_step(batch).item() * num_tokens
+            total_tokens += num_tokens
+        self._model.train()
+        return total_loss / max(total_tokens, 1)
+
+    def save_optimizer_state(self, epoch: int) -> None:
+        """Save the AdamW moments for warm starts, replacing those saved earlier in this run.
+
+        Only the checkpoint training ends on is ever warm-started from, so
+        at most one of this run's optimizer states is kept on the volume.
+        """
+        path = self._output_dir / OPTIMIZER_STATE_DIR / f"epoch_{epoch}.pt"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        torch.save(self._optimizer.state_dict()["state"], path)
+        if self._optimizer_state_path is not None and self._optimizer_state_path != path:
+            self._optimizer_state_path.unlink(missing_ok=True)
+        self._optimizer_state_path = path
+
+    def save_checkpoint(self, epoch: int) -> None:
+        epoch += self._epoch_offset
+        super().save_checkpoint(epoch)
+
+        if self._val_dataloader is None:
+            self.save_optimizer_state(epoch)
+            return
+
+        val_loss = self.validation_loss()
+        self._val_losses[epoch] = val_loss
+        best_epoch = min(self._val_losses, key=self._val_losses.get)
+        if best_epoch == epoch:
+            # Later epochs are deleted once training ends, so only the best one's state can be resumed
+            self.save_optimizer_state(epoch)
+        self._metric_logger.log_dict({"val_loss": val_loss}, step=self.global_step)
+        log.info(f"Epoch {epoch}: validation loss {val_loss:.4f} (best epoch {best_epoch})")
+
+        with open(self._output_dir / EARLY_STOPPING_FILE, "w") as f:
+            json.dump({"val_losses": self._val_losses, "best_epoch": best_epoch}, f)
+
+        if epoch - best_epoch >= self._patience:
+            raise StopTraining(f"No validation improvement for {epoch - best_epoch} epoch(s)")
+
+
+def train_adapter(recipe: LoRAEarlyStoppingRecipe) -> None:
+    try:
+        recipe.train()
+    except StopTraining as e:
+        log.info(f"Stopping early: {e}")
+    finally:
+        recipe.cleanup()
+
+
+def train_batch(cfg: DictConfig) -> None:
+    """Train every adapter in `cfg.adapters_file` on one base model and write `cfg.batch_report`."""
+    base_model = None
+    report = []
+    for overrides in OmegaConf.load(cfg.adapters_file):
+        adapter_cfg = OmegaConf.merge(cfg, OmegaConf.from_dotlist(list(overrides)))
+        entry = {"output_dir": adapter_cfg.output_dir, "status": "failed", "loaded_base_model": base_model is None}
+        start = time.perf_counter()
+        recipe = None
+        try:
+            config.log_config(recipe_name="LoRAEarlyStoppingRecipe", cfg=adapter_cfg)
+            recipe = LoRAEarlyStoppingRecipe(cfg=adapter_cfg, base_model=base_model)
+            recipe.setup(cfg=adapter_cfg)
+            entry["setup_seconds"] = time.perf_counter() - start
+            train_adapter(recipe)
+            entry["status"] = "success"
+        except Exception as e:
+            log.exception(f"Training {adapter_cfg.output_dir} failed")
+            entry["error"] = str(e)
+        if base_model is None and recipe is not None:
+            # Base weights are frozen, so a model loaded before the adapter failed (even during setup) is reused
+            base_model = getattr(recipe, "_model", None)
+        recipe = None
+        torch.cuda.empty_cache()
+        entry["seconds"] = time.perf_counter() - start
+        report.append(entry)
+        log.info(f"{entry['output_dir']}: {entry['status']} in {entry['seconds']:.1f}s")
+
+    with open(cfg.batch_report, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+@config.parse
+def recipe_main(cfg: DictConfig) -> None:
+    if cfg.get("adapters_file", None):
+        train_batch(cfg)
+        return
+
+    config.log_config(recipe_name="LoRAEarlyStoppingRecipe", cfg=cfg)
+    recipe = LoRAEarlyStoppingRecipe(cfg=cfg)
+    recipe.setup(cfg=cfg)
+    train_adapter(recipe)
+
+
+if __name__ == "__main__":
+    sys.exit(recipe_main())
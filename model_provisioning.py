@@ -0,0 +1,241 @@
+from common import (
+    MODEL_NAME,
+    MODEL_PATH,
+    VOL_MOUNT_PATH,
+    PROVISION_TIMEOUT,
+    output_vol,
+    training_image,
+    app,
+)
+
+import asyncio
+import fnmatch
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import modal
+
+from single_flight import run_single_flight
+
+MANIFEST_FILE = "manifest.json"  # expected files, sizes and checksums of the base model
+READY_FILE = ".ready.json"  # written once every manifest entry is present and verified
+IGNORE_PATTERNS = ["original/consolidated.00.pth", ".gitattributes", "*.md"]  # not needed for training or serving
+VERIFY_WORKERS = 4
+DOWNLOAD_WORKERS = 4
+PROVISION_KEY = "provision:base-model"  # single_flight key shared by everything that provisions the model
+
+
+@dataclass
+class ManifestEntry:
+    """One file of the base model as published on the Hugging Face Hub."""
+    path: str
+    size: int
+    sha256: Optional[str] = None  # LFS files
+    git_sha1: Optional[str] = None  # small files stored in git
+
+
+@dataclass
+class ProvisionReport:
+    """What provisioning found and fixed."""
+    revision: str
+    files: int
+    verified: int = 0  # hashed and matched the manifest
+    reused: int = 0  # unchanged since they were last verified
+    downloaded: List[str] = field(default_factory=list)
+    bytes_downloaded: int = 0
+    seconds: float = 0.0
+
+
+def fetch_manifest(repo_id: str = MODEL_NAME, revision: Optional[str] = None, token: Optional[str] = None, ignore_patterns: List[str] = IGNORE_PATTERNS) -> dict:
+    """List the model's files with their sizes and checksums at `revision` (default: the latest)."""
+    from huggingface_hub import HfApi
+
+    info = HfApi().model_info(repo_id, revision=revision, files_metadata=True, token=token)
+    files = []
+    for sibling in info.siblings:
+        if any(fnmatch.fnmatch(sibling.rfilename, pattern) for pattern in ignore_patterns):
+            continue
+        if sibling.lfs is not None:
+            files.append(ManifestEntry(sibling.rfilename, sibling.lfs.size, sha256=sibling.lfs.sha256))
+        else:
+            files.append(ManifestEntry(sibling.rfilename, sibling.size, git_sha1=sibling.blob_id))
+    return {"repo_id": repo_id, "revision": info.sha, "files": [asdict(f) for f in files]}
+
+
+def load_manifest(model_path: Path = MODEL_PATH) -> Optional[dict]:
+    path = model_path / MANIFEST_FILE
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def file_checksum(path: Path, entry: ManifestEntry) -> str:
+    """Checksum in the form the manifest records for this entry."""
+    if entry.sha256 is not None:
+        digest = hashlib.sha256()
+    else:
+        # Git blob ID: sha1 over a "blob <size>\0" header and the content
+        digest = hashlib.sha1(f"blob {path.stat().st_size}\0".encode())
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(16 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def verify_file(model_path: Path, entry: ManifestEntry) -> bool:
+    """Whether the file exists with the manifest's size and checksum."""
+    path = model_path / entry.path
+    if not path.exists() or path.stat().st_size != entry.size:
+        return False
+    return file_checksum(path, entry) == (entry.sha256 or entry.git_sha1)
+
+
+def _file_state(path: Path) -> List[int]:
+    stat = path.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def model_ready(model_path: Path = MODEL_PATH) -> bool:
+    """Cheap readiness check: the ready marker matches the manifest and every file still has its verified size.
+
+    Checksums are only computed by `provision_model`; this only stats files,
+    so it is fast enough for every container start.
+    """
+    manifest = load_manifest(model_path)
+    marker = model_path / READY_FILE
+    if manifest is None or not marker.exists():
+        return False
+    with open(marker) as f:
+        ready = json.load(f)
+    if ready.get("revision") != manifest["revision"]:
+        return False
+    for entry in manifest["files"]:
+        path = model_path / entry["path"]
+        if not path.exists() or path.stat().st_size != entry["size"]:
+            return False
+    return True
+
+
+def provision_model(model_path: Path = MODEL_PATH, repo_id: str = MODEL_NAME, token: Optional[str] = None) -> ProvisionReport:
+    """Make `model_path` a complete, verified copy of the base model, downloading only what is missing or corrupt.
+
+    Files verified by an earlier run and untouched since (same size and
+    mtime) are trusted without rehashing; everything else is hashed against
+    the manifest and re-fetched on mismatch. Interrupted downloads resume
+    from where they stopped. The ready marker is removed first and written
+    last, so a crash leaves the model marked not ready.
+
+    Args:
+        model_path: Where the model lives on the volume
+        repo_id: Hugging Face model repository
+        token: Hugging Face token for gated models
+
+    Returns:
+        What was verified, reused and downloaded
+    """
+    from huggingface_hub import hf_hub_download
+
+    start = time.perf_counter()
+    model_path.mkdir(parents=True, exist_ok=True)
+    marker = model_path / READY_FILE
+    previous: Dict[str, List[int]] = {}
+    if marker.exists():
+        with open(marker) as f:
+            previous = json.load(f).get("files", {})
+        marker.unlink()
+
+    # Stay on the revision already provisioned; adapters were trained against its weights
+    saved = load_manifest(model_path)
+    try:
+        manifest = fetch_manifest(repo_id, saved["revision"] if saved else None, token)
+    except Exception as e:
+        # Verify against the last known manifest when the Hub is unreachable
+        if saved is None:
+            raise
+        manifest = saved
+        print(f"Could not fetch the manifest from the Hub ({e}), using the saved one")
+    with open(model_path / MANIFEST_FILE, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    entries = [ManifestEntry(**e) for e in manifest["files"]]
+    report = ProvisionReport(revision=manifest["revision"], files=len(entries))
+
+    def check(entry: ManifestEntry) -> str:
+        path = model_path / entry.path
+        if path.exists() and previous.get(entry.path) == _file_state(path) and path.stat().st_size == entry.size:
+            return "reused"
+        return "verified" if verify_file(model_path, entry) else "missing"
+
+    with ThreadPoolExecutor(VERIFY_WORKERS) as pool:
+        states = list(pool.map(check, entries))
+    report.reused, report.verified = states.count("reused"), states.count("verified")
+    missing = [e for e, state in zip(entries, states) if state == "missing"]
+    print(f"{len(entries) - len(missing)}/{len(entries)} model files present and intact")
+
+    def fetch(entry: ManifestEntry):
+        path = model_path / entry.path
+        corrupt = path.exists()
+        print(f"{'Re-downloading corrupt' if corrupt else 'Downloading'} {entry.path} ({entry.size / 1e9:.2f} GB)")
+        hf_hub_download(
+            repo_id,
+            entry.path,
+            revision=manifest["revision"],
+            local_dir=model_path,
+            token=token,
+            force_download=corrupt,
+        )
+        if not verify_file(model_path, entry):
+            raise IOError(f"{entry.path} does not match the manifest after downloading")
+
+    with ThreadPoolExecutor(DOWNLOAD_WORKERS) as pool:
+        list(pool.map(fetch, missing))
+    report.downloaded = [e.path for e in missing]
+    report.bytes_downloaded = sum(e.size for e in missing)
+
+    with open(marker, "w") as f:
+        json.dump({
+            "revision": manifest["revision"],
+            "verified_at": time.time(),
+            "files": {e.path: _file_state(model_path / e.path) for e in entries},
+        }, f)
+    report.seconds = time.perf_counter() - start
+    print(
+        f"Model ready at revision {report.revision[:12]}: {report.reused} reused, {report.verified} verified, "
+        f"{len(report.downloaded)} downloaded ({report.bytes_downloaded / 1e9:.2f} GB) in {report.seconds:.0f}s"
+    )
+    return report
+
+
+@app.function(
+    image=training_image,
+    volumes={VOL_MOUNT_PATH: output_vol},
+    timeout=PROVISION_TIMEOUT,
+    secrets=[modal.Secret.from_name("huggingface-secret")],
+)
+def provision_base_model() -> dict:
+    """Provision the base model on the volume. Run once after deploying: `modal run model_provisioning.py::provision_base_model`."""
+    report = provision_model(token=os.getenv("HUGGINGFACE_TOKEN"))
+    output_vol.commit()
+    return asdict(report)
+
+
+async def ensure_model_provisioned(model_path: Path = MODEL_PATH):
+    """Provision the base model unless it is ready, joining any provisioning already in flight.
+
+    Every caller goes through the same `single_flight` key, so concurrent
+    fine-tunes and review jobs never download into the volume at once.
+    """
+    if await asyncio.to_thread(model_ready, model_path):
+        return
+    print("Base model is not ready, provisioning...")
+    await run_single_flight(PROVISION_KEY, provision_base_model.spawn.aio)
+    await output_vol.reload.aio()
+    if not await asyncio.to_thread(model_ready, model_path):
+        raise RuntimeError(f"Base model at {model_path} is still not ready after provisioning")
@@ -0,0 +1,340 @@
+from common import VOL_MOUNT_PATH
+
+import hashlib
+import json
+import random
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+PACKED_SEQ_LEN = 2048  # tokens per packed training sequence
+PACKING_VERSION = 3  # bump when tokenization or packing changes, to invalidate the cache
+PACKED_CACHE_DIR = VOL_MOUNT_PATH / "packed_datasets"
+CROSS_ENTROPY_IGNORE_IDX = -100  # torchtune's label for tokens excluded from the loss
+HOLDOUT_FRACTION = 0.1  # examples held out for early stopping
+MIN_EXAMPLES_FOR_HOLDOUT = 20  # smaller datasets train on everything, without early stopping
+MAX_HOLDOUT_EXAMPLES = 200
+
+Pack = Dict[str, List[int]]
+
+
+@dataclass
+class PackingStats:
+    """How well a dataset packed into fixed-length sequences."""
+    examples: int
+    truncated: int
+    packs: int
+    tokens: int
+    trained_tokens: int  # tokens that contribute to the loss
+    max_seq_len: int
+    validation_examples: int = 0
+    validation_packs: int = 0
+    holdout_rows: List[int] = field(default_factory=list)  # positions in the data file of the held-out examples
+
+    @property
+    def padding_fraction(self) -> float:
+        return 1 - self.tokens / (self.packs * self.max_seq_len) if self.packs else 0.0
+
+    @property
+    def mean_example_len(self) -> int:
+        return self.tokens // self.examples if self.examples else 0
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(data_path: Path, tokenizer_path: Path, max_seq_len: int = PACKED_SEQ_LEN, holdout_fraction: float = HOLDOUT_FRACTION) -> str:
+    """Key a packed dataset by its raw data, the tokenizer model and the packing parameters."""
+    import torchtune
+
+    parts = [
+        file_sha256(data_path),
+        file_sha256(tokenizer_path),
+        torchtune.__version__,
+        str(PACKING_VERSION),
+        str(max_seq_len),
+        str(holdout_fraction),
+    ]
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()[:32]
+
+
+def pack_examples(examples: List[Tuple[List[int], List[int]]], max_seq_len: int, padding_idx: int) -> List[Pack]:
+    """Pack tokenized examples into sequences of exactly `max_seq_len` tokens.
+
+    Uses first-fit decreasing, which leaves far less padding than packing in
+    arrival order when example lengths vary. Each pack has the layout
+    torchtune's `PackedDataset` produces: `seq_lens` delimits the examples
+    (plus a trailing padding segment), `input_pos` restarts at every example
+    boundary, and padding is ignored by the loss.
+
+    Args:
+        examples: (tokens, labels) pairs, each no longer than `max_seq_len`
+        max_seq_len: Length of every pack
+        padding_idx: Token ID used for padding
+
+    Returns:
+        Packs as dicts of "tokens", "labels", "input_pos" and "seq_lens" lists
+    """
+    bins: List[List[int]] = []  # example indices per pack
+    free: List[int] = []  # remaining capacity per pack
+    for i in sorted(range(len(examples)), key=lambda i: len(examples[i][0]), reverse=True):
+        length = len(examples[i][0])
+        for b, capacity in enumerate(free):
+            if length <= capacity:
+                bins[b].append(i)
+                free[b] -= length
+                break
+        else:
+            bins.append([i])
+            free.append(max_seq_len - length)
+
+    packs = []
+    for indices in bins:
+        pack: Pack = {"tokens": [], "labels": [], "input_pos": [], "seq_lens": []}
+        for i in indices:
+            tokens, labels = examples[i]
+            pack["tokens"] += tokens
+            pack["labels"] += labels
+            pack["input_pos"] += list(range(len(tokens)))
+            pack["seq_lens"].append(len(tokens))
+
+        num_padding = max_seq_len - len(pack["tokens"])
+        if num_padding:
+            last_pos = pack["input_pos"][-1]
+            pack["tokens"] += [padding_idx] * num_padding
+            pack["labels"] += [CROSS_ENTROPY_IGNORE_IDX] * num_padding
+            pack["input_pos"] += [min(last_pos + 1 + j, max_seq_len - 1) for j in range(num_padding)]
+            pack["seq_lens"].append(num_padding)
+        packs.append(pack)
+    return packs
+
+
+def tokenize_examples(data_path: Path, tokenizer) -> Tuple[List[Tuple[List[int], List[int]]], List[int], int]:
+    """Tokenize chat examples with the model's template and mask the loss to the assistant turns.
+
+    Tokenization goes through torchtune's own `chat_dataset`, so masking
+    matches unpacked training exactly.
+
+    Returns:
+        (tokens, labels) per example, the position of each in the data file,
+        and how many examples were truncated
+    """
+    from torchtune.datasets import chat_dataset
+
+    dataset = chat_dataset(
+        tokenizer,
+        source="json",
+        conversation_column="messages",
+        conversation_style="openai",
+        data_files=data_path.as_posix(),
+        split="train",
+        train_on_input=False,
+        packed=False,
+    )
+    examples, rows, truncated = [], [], 0
+    for row, sample in enumerate(dataset):
+        tokens, labels = list(sample["tokens"]), [int(label) for label in sample["labels"]]
+        if len(tokens) >= tokenizer.max_seq_len:
+            truncated += 1
+        if all(label == CROSS_ENTROPY_IGNORE_IDX for label in labels):
+            continue  # the assistant turn was truncated away; nothing to learn from
+        examples.append((tokens, labels))
+        rows.append(row)
+    return examples, rows, truncated
+
+
+def split_holdout(examples: list, fraction: float = HOLDOUT_FRACTION, seed: int = 0) -> Tuple[list, list]:
+    """Deterministically split off a validation set; small datasets keep every example for training."""
+    if len(examples) < MIN_EXAMPLES_FOR_HOLDOUT or fraction <= 0:
+        return examples, []
+    indices = list(range(len(examples)))
+    random.Random(seed).shuffle(indices)
+    num_holdout = min(MAX_HOLDOUT_EXAMPLES, max(1, round(fraction * len(examples))))
+    holdout = set(indices[:num_holdout])
+    return (
+        [e for i, e in enumerate(examples) if i not in holdout],
+        [e for i, e in enumerate(examples) if i in holdout],
+    )
+
+
+def without_holdout(examples: list, stats: PackingStats) -> list:
+    """The entries of a data file's example list that were not held out for validation.
+
+    Examples dropped during tokenization are kept: they can never be
+    trained on, so there is no point in offering them to a later run.
+    """
+    holdout = set(stats.holdout_rows)
+    return [e for row, e in enumerate(examples) if row not in holdout]
+
+
+def examples_path(packed_path: Path) -> Path:
+    """Where `prepare_packed_dataset` keeps the unpacked training examples of a packed dataset."""
+    return packed_path.with_suffix(".examples.pt")
+
+
+def remove_packed_dataset(packed_path: Path):
+    """Delete a packed dataset and everything `prepare_packed_dataset` wrote alongside it."""
+    for path in (packed_path, packed_path.with_suffix(".val.pt"), examples_path(packed_path), packed_path.with_suffix(".json")):
+        path.unlink(missing_ok=True)
+
+
+def save_examples(examples: List[Tuple[List[int], List[int]]], path: Path):
+    import torch
+
+    tmp_path = path.with_suffix(".tmp")
+    torch.save(
+        {
+            "tokens": [torch.tensor(tokens, dtype=torch.long) for tokens, _ in examples],
+            "labels": [torch.tensor(labels, dtype=torch.long) for _, labels in examples],
+        },
+        tmp_path,
+    )
+    tmp_path.replace(path)
+
+
+def save_packs(packs: List[Pack], path: Path):
+    import torch
+
+    tmp_path = path.with_suffix(".tmp")
+    torch.save(
+        {
+            "tokens": torch.tensor([p["tokens"] for p in packs], dtype=torch.long),
+            "labels": torch.tensor([p["labels"] for p in packs], dtype=torch.long),
+            "input_pos": torch.tensor([p["input_pos"] for p in packs], dtype=torch.long),
+            "seq_lens": [torch.tensor(p["seq_lens"], dtype=torch.long) for p in packs],
+        },
+        tmp_path,
+    )
+    tmp_path.replace(path)
+
+
+def prepare_packed_dataset(
+    data_path: Path,
+    tokenizer_path: Path,
+    max_seq_len: int = PACKED_SEQ_LEN,
+    cache_dir: Path = PACKED_CACHE_DIR,
+    holdout_fraction: float = HOLDOUT_FRACTION,
+) -> Tuple[Path, Optional[Path], PackingStats]:
+    """Tokenize and pack a user's training data, reusing a cached result when one exists.
+
+    Args:
+        data_path: The scraped examples (JSON list of {"messages": [...]})
+        tokenizer_path: Llama 3 `tokenizer.model` of the base model
+        max_seq_len: Length of every packed sequence
+        cache_dir: Where packed datasets are stored on the volume
+        holdout_fraction: Share of examples packed separately for validation
+
+    Returns:
+        Paths to the packed training and validation sets (torch files; the
+        latter None when the dataset is too small to hold any out) and the
+        packing statistics. The unpacked training examples are saved
+        alongside, see `examples_path`.
+    """
+    from torchtune.models.llama3 import llama3_tokenizer
+
+    key = cache_key(data_path, tokenizer_path, max_seq_len, holdout_fraction)
+    path = cache_dir / f"{key}.pt"
+    validation_path = cache_dir / f"{key}.val.pt"
+    stats_path = cache_dir / f"{key}.json"
+    if path.exists() and examples_path(path).exists() and stats_path.exists():
+        with open(stats_path) as f:
+            stats = PackingStats(**json.load(f))
+        print(f"Using cached packed dataset {path}")
+        return path, validation_path if stats.validation_packs else None, stats
+
+    tokenizer = llama3_tokenizer(path=tokenizer_path.as_posix(), max_seq_len=max_seq_len)
+    examples, rows, truncated = tokenize_examples(data_path, tokenizer)
+    train_indices, holdout_indices = split_holdout(list(range(len(examples))), holdout_fraction)
+    train_examples = [examples[i] for i in train_indices]
+    holdout_examples = [examples[i] for i in holdout_indices]
+    packs = pack_examples(train_examples, max_seq_len, tokenizer.pad_id)
+    validation_packs = pack_examples(holdout_examples, max_seq_len, tokenizer.pad_id)
+    stats = PackingStats(
+        examples=len(train_examples),
+        truncated=truncated,
+        packs=len(packs),
+        tokens=sum(len(tokens) for tokens, _ in train_examples),
+        trained_tokens=sum(label != CROSS_ENTROPY_IGNORE_IDX for _, labels in train_examples for label in labels),
+        max_seq_len=max_seq_len,
+        validation_examples=len(holdout_examples),
+        validation_packs=len(validation_packs),
+        holdout_rows=[rows[i] for i in holdout_indices],
+    )
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    save_packs(packs, path)
+    save_examples(train_examples, examples_path(path))
+    if validation_packs:
+        save_packs(validation_packs, validation_path)
+    with open(stats_path, "w") as f:
+        json.dump(asdict(stats), f)
+
+    print(
+        f"Packed {stats.examples} examples into {stats.packs} x {max_seq_len} tokens "
+        f"({stats.padding_fraction:.1%} padding, {stats.truncated} truncated), "
+        f"{stats.validation_examples} held out in {stats.validation_packs} pack(s)"
+    )
+    return path, validation_path if validation_packs else None, stats
+
+
+class CachedPackedDataset:
+    """Map-style dataset over packs written by `prepare_packed_dataset`."""
+
+    def __init__(self, path: str):
+        import torch
+
+        self.data = torch.load(path)
+
+    def __len__(self) -> int:
+        return len(self.data["seq_lens"])
+
+    def __getitem__(self, index: int) -> Dict:
+        return {
+            "tokens": self.data["tokens"][index],
+            "labels": self.data["labels"][index],
+            "input_pos": self.data["input_pos"][index],
+            "seq_lens": self.data["seq_lens"][index],
+        }
+
+
+def cached_packed_dataset(tokenizer, path: str, packed: bool = True) -> CachedPackedDataset:
+    """torchtune dataset builder for a pre-packed dataset.
+
+    The tokenizer is unused since the data is already tokenized; `packed`
+    must stay True so the recipe collates with `padded_collate_packed`.
+    """
+    if not packed:
+        raise ValueError("cached_packed_dataset only provides packed data; set dataset.packed=True")
+    return CachedPackedDataset(path)
+
+
+class CachedTokenizedDataset:
+    """Map-style dataset over the unpacked examples saved by `prepare_packed_dataset`."""
+
+    def __init__(self, path: str):
+        import torch
+
+        self.data = torch.load(path)
+        self.lengths = [len(tokens) for tokens in self.data["tokens"]]
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def __getitem__(self, index: int) -> Dict:
+        return {"tokens": self.data["tokens"][index].tolist(), "labels": self.data["labels"][index].tolist()}
+
+
+def cached_tokenized_dataset(tokenizer, path: str, packed: bool = False) -> CachedTokenizedDataset:
+    """torchtune dataset builder for the unpacked examples of a prepared dataset.
+
+    Batches are padded to their longest example, so pair this with length
+    bucketing (`length_bucketing: True`) to keep that padding small.
+    """
+    if packed:
+        raise ValueError("cached_tokenized_dataset provides unpacked data; use cached_packed_dataset to pack")
+    return CachedTokenizedDataset(path)
@@ -1,6 +1,10 @@
 from typing import AsyncIterator, Optional, List, Dict, Any, Tuple
 import re
 
+MAX_HUNK_LINES = 200  # maximum lines of diff context per hunk
+TRUNCATION_NOTICE = "\n... (truncated) ...\n"
+
+
 def split_into_hunks(patch: str) -> List[Tuple[int, str]]:
     """
     Parse a unified diff patch into discrete hunks, returning list of
@@ -31,6 +35,28 @@ def split_into_hunks(patch: str) -> List[Tuple[int, str]]:
         i += 1
     return hunks
    
+def prepare_hunks(patch: str) -> List[Tuple[int, str]]:
+    """
+    Split a file's patch into (new_start_line, hunk_text) hunks, truncating
+    overly long ones to their head and tail around a truncation notice so they
+    fit the model's context length.
+    """
+    hunks = split_into_hunks(patch)
+    if not hunks:
+        # fallback to a single hunk starting at line 1
+        hunks = [(1, patch)]
+
+    prepared = []
+    for new_start, hunk_text in hunks:
+        lines = hunk_text.splitlines(keepends=True)
+        if len(lines) > MAX_HUNK_LINES:
+            head = lines[:MAX_HUNK_LINES//2]
+            tail = lines[-MAX_HUNK_LINES//2:]
+            hunk_text = ''.join(head) + TRUNCATION_NOTICE + ''.join(tail)
+        prepared.append((new_start, hunk_text))
+    return prepared
+
+
 def extract_added_line_numbers(hunk_text: str, new_start: int) -> List[int]:
     """
     Given a unified diff hunk (including header), return the list of line numbers
@@ -54,4 +80,25 @@ def extract_added_line_numbers(hunk_text: str, new_start: int) -> List[int]:
         else:
             # Other (e.g. \ No newline at end), ignore
             continue
-    return added_lines
\ No newline at end of file
+    return added_lines
+
+def choose_anchor_line(hunk_text: str, new_start: int, comment: str) -> int:
+    """
+    Pick the line in the new file that a review comment on this hunk should be
+    attached to: the added line sharing the most identifiers with the comment,
+    or the first added line when nothing overlaps. Lines after a truncation
+    notice are ignored since their line numbers can no longer be recovered.
+    """
+    hunk_text = hunk_text.split(TRUNCATION_NOTICE)[0]
+    added_lines = extract_added_line_numbers(hunk_text, new_start)
+    if not added_lines:
+        return new_start
+
+    words = set(re.findall(r'[A-Za-z_][A-Za-z0-9_]{2,}', comment.lower()))
+    added_text = [line[1:] for line in hunk_text.splitlines()[1:] if line.startswith('+')]
+    best_line, best_overlap = added_lines[0], 0
+    for line_number, text in zip(added_lines, added_text):
+        overlap = len(words & set(re.findall(r'[A-Za-z_][A-Za-z0-9_]{2,}', text.lower())))
+        if overlap > best_overlap:
+            best_line, best_overlap = line_number, overlap
+    return best_line
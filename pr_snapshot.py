@@ -0,0 +1,141 @@
+from github_client import get_github_client
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+import hashlib
+
+from parsing_helpers import prepare_hunks
+
+FILES_PER_PAGE = 100
+MAX_FILE_PAGES = 30  # GitHub lists at most 3000 files per PR
+MAX_COMPARE_FILES = 300  # the compare API lists at most this many files, all on its first page
+
+
+def hunk_key(file_path: str, hunk_text: str) -> str:
+    """Identify a hunk by its file and content, ignoring its header so it survives line shifts elsewhere."""
+    body = hunk_text.split("\n", 1)[1] if "\n" in hunk_text else ""
+    return hashlib.sha1(f"{file_path}\n{body}".encode()).hexdigest()[:16]
+
+
+@dataclass
+class PRFile:
+    """One changed file of a PR, with its patch already split into hunks."""
+    filename: str
+    status: str
+    patch: str
+    hunks: List[Tuple[int, str]] = field(default_factory=list)
+
+
+@dataclass
+class PRSnapshot:
+    """Everything the review path needs about a PR, fetched once per webhook."""
+    repo_owner: str
+    repo_name: str
+    pr_number: int
+    head_sha: Optional[str]
+    files: List[PRFile]
+
+    def __post_init__(self):
+        self._by_path: Dict[str, PRFile] = {f.filename: f for f in self.files}
+
+    def file(self, path: str) -> Optional[PRFile]:
+        return self._by_path.get(path)
+
+    def hunks(self) -> List[Tuple[str, int, str]]:
+        """(file_path, new_start, hunk_text) for every hunk in the PR."""
+        return [(f.filename, new_start, hunk_text) for f in self.files for new_start, hunk_text in f.hunks]
+
+    def with_hunks(self, source: "PRSnapshot", keys: Iterable[str]) -> "PRSnapshot":
+        """This snapshot plus the hunks of `source` whose `hunk_key` is in `keys`, e.g. ones an earlier review skipped."""
+        keys = set(keys)
+        extra: Dict[str, List[Tuple[int, str]]] = {}
+        for f in source.files:
+            for new_start, hunk_text in f.hunks:
+                if hunk_key(f.filename, hunk_text) in keys:
+                    extra.setdefault(f.filename, []).append((new_start, hunk_text))
+
+        files = []
+        for f in self.files:
+            present = {hunk_key(f.filename, hunk_text) for _, hunk_text in f.hunks}
+            added = [h for h in extra.pop(f.filename, []) if hunk_key(f.filename, h[1]) not in present]
+            files.append(PRFile(f.filename, f.status, f.patch, f.hunks + added))
+        for path, hunks in extra.items():
+            f = source.file(path)
+            files.append(PRFile(f.filename, f.status, f.patch, hunks))
+        return PRSnapshot(self.repo_owner, self.repo_name, self.pr_number, self.head_sha, files)
+
+    @classmethod
+    def from_files(cls, repo_owner: str, repo_name: str, pr_number: int, head_sha: Optional[str], files: List[dict]) -> "PRSnapshot":
+        """Build a snapshot from a `/pulls/{n}/files`-shaped listing."""
+        return cls(repo_owner, repo_name, pr_number, head_sha, [
+            PRFile(f["filename"], f.get("status", "modified"), f.get("patch", ""), prepare_hunks(f.get("patch", "")))
+            for f in files
+        ])
+
+
+def fetch_pr_snapshot(repo_owner: str, repo_name: str, pr_number: int, token: str) -> PRSnapshot:
+    """Fetch the PR's head SHA and its complete, paginated file list.
+
+    Args:
+        repo_owner: Owner of the repository
+        repo_name: Name of the repository
+        pr_number: PR number to snapshot
+        token: GitHub token for authentication
+
+    Returns:
+        The snapshot, with every file's patch parsed into hunks
+    """
+    github = get_github_client()
+    base_url = f"/repos/{repo_owner}/{repo_name}/pulls/{pr_number}"
+
+    pr_response = github.get(base_url, token=token)
+    if pr_response.status_code != 200:
+        raise Exception(f"Failed to fetch PR: {pr_response.status_code} - {pr_response.text}")
+    head_sha = pr_response.json()["head"]["sha"]
+
+    files = []
+    for page in range(1, MAX_FILE_PAGES + 1):
+        response = github.get(f"{base_url}/files", token=token, params={"page": page, "per_page": FILES_PER_PAGE})
+        if response.status_code != 200:
+            raise Exception(f"Failed to fetch PR files: {response.status_code} - {response.text}")
+        batch = response.json()
+        files.extend(batch)
+        if len(batch) < FILES_PER_PAGE:
+            break
+
+    print(f"Snapshot of PR #{pr_number}: {len(files)} file(s) at {head_sha} in {page + 1} call(s)")
+    return PRSnapshot.from_files(repo_owner, repo_name, pr_number, head_sha, files)
+
+
+def fetch_incremental_snapshot(snapshot: PRSnapshot, base_sha: str, token: str) -> Optional[PRSnapshot]:
+    """Restrict a PR snapshot to what changed between `base_sha` and its head.
+
+    Uses the compare API, keeping only files that are part of the PR so
+    changes merged in from the base branch are not reviewed.
+
+    Returns:
+        The incremental snapshot, or None when the range cannot be compared
+        cleanly (unknown SHA, force-push, too many files) and the full PR
+        should be reviewed
+    """
+    github = get_github_client()
+    url = f"/repos/{snapshot.repo_owner}/{snapshot.repo_name}/compare/{base_sha}...{snapshot.head_sha}"
+
+    # `page`/`per_page` paginate the commits; changed files only come with the first page
+    response = github.get(url, token=token, params={"per_page": 1})
+    if response.status_code != 200:
+        print(f"Cannot compare {base_sha}...{snapshot.head_sha}: {response.status_code}")
+        return None
+    comparison = response.json()
+    if comparison.get("status") not in ("ahead", "identical"):
+        # A force-push rewrote history; the comparison would include unrelated changes
+        print(f"{base_sha}...{snapshot.head_sha} is {comparison.get('status')}, reviewing the full PR")
+        return None
+    files = comparison.get("files", [])
+    if len(files) >= MAX_COMPARE_FILES:
+        # The file list is truncated; reviewing from it would silently skip changes
+        print(f"{base_sha}...{snapshot.head_sha} changes {MAX_COMPARE_FILES}+ files, reviewing the full PR")
+        return None
+
+    pr_files = [f for f in files if snapshot.file(f["filename"]) is not None]
+    print(f"{len(pr_files)} PR file(s) changed since {base_sha}")
+    return PRSnapshot.from_files(snapshot.repo_owner, snapshot.repo_name, snapshot.pr_number, snapshot.head_sha, pr_files)
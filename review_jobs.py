@@ -0,0 +1,60 @@
+import json
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+from common import get_job_path, output_vol
+
+# Lifecycle of a review job; "done" and "failed" are terminal
+JOB_STATES = ("queued", "scraping", "training", "reviewing", "done", "failed")
+
+
+@dataclass
+class ReviewJob:
+    """Persisted state of one `@tech-lead-bot` invocation, keyed by webhook delivery ID."""
+    job_id: str
+    repo_owner: str
+    repo_name: str
+    pr_number: int
+    commenter: str
+    requested_users: List[str]
+    force_reload: bool = False
+    incremental: bool = False
+    installation_id: Optional[int] = None
+    status: str = "queued"
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+    samples: Dict[str, int] = field(default_factory=dict)
+    error: Optional[str] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def save(self):
+        """Write the job to the volume and commit, so other containers see it."""
+        path = get_job_path(self.job_id)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.updated_at = time.time()
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(asdict(self), f)
+        tmp_path.replace(path)
+        output_vol.commit()
+
+    def set_status(self, status: str, error: Optional[str] = None):
+        if status not in JOB_STATES:
+            raise ValueError(f"Unknown job status: {status}")
+        print(f"Job {self.job_id}: {self.status} -> {status}")
+        self.status = status
+        self.error = error
+        self.save()
+
+
+def load_job(job_id: str) -> Optional[ReviewJob]:
+    """Return the persisted job, or None if no job with this ID was enqueued."""
+    path = get_job_path(job_id)
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return ReviewJob(**json.load(f))
@@ -0,0 +1,32 @@
+import json
+import time
+from typing import List, Optional
+
+from common import get_review_state_path, output_vol
+
+
+def load_last_reviewed_sha(repo_owner: str, repo_name: str, pr_number: int, username: str) -> Optional[str]:
+    """Return the head SHA the bot last reviewed on this PR as `username`, if any."""
+    path = get_review_state_path(repo_owner, repo_name, pr_number, username)
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f).get("head_sha")
+
+
+def load_pending_hunks(repo_owner: str, repo_name: str, pr_number: int, username: str) -> List[str]:
+    """Return the `hunk_key`s the last review as `username` left unreviewed because of the hunk budget."""
+    path = get_review_state_path(repo_owner, repo_name, pr_number, username)
+    if not path.exists():
+        return []
+    with open(path) as f:
+        return json.load(f).get("pending_hunks", [])
+
+
+def record_reviewed_sha(repo_owner: str, repo_name: str, pr_number: int, username: str, head_sha: str, pending_hunks: Optional[List[str]] = None):
+    """Remember that the PR was reviewed as `username` up to `head_sha`, except for `pending_hunks`."""
+    path = get_review_state_path(repo_owner, repo_name, pr_number, username)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"head_sha": head_sha, "pending_hunks": pending_hunks or [], "reviewed_at": time.time()}, f)
+    output_vol.commit()
@@ -0,0 +1,129 @@
+import asyncio
+import time
+import uuid
+from typing import Any, Awaitable, Callable, List, Optional
+
+import modal
+
+from common import FINETUNE_BATCH_TIMEOUT, FINETUNE_TIMEOUT, HOURS, MINUTES, PROVISION_TIMEOUT, SCRAPE_TIMEOUT, inflight_jobs
+
+CLAIM_SETTLE_SECONDS = 1.0  # wait after claiming so a concurrent claimant's write lands first
+CLAIM_LEASE = 60  # seconds the claimant has to spawn its job before others may take over
+JOB_LEASE = max(SCRAPE_TIMEOUT, FINETUNE_TIMEOUT, FINETUNE_BATCH_TIMEOUT, PROVISION_TIMEOUT) + 1 * HOURS  # a job cannot outlive its lease
+LEASE_RENEW_INTERVAL = 10 * MINUTES  # the claimant extends the lease while the job is queued or running
+POLL_INTERVAL = 2.0
+
+
+def flight_key(stage: str, repo_owner: str, repo_name: str, username: str) -> str:
+    """Key of the shared work for one stage of one (user, repo) adapter."""
+    return f"{stage}:{repo_owner}/{repo_name}:{username}"
+
+
+async def run_single_flight(key: str, spawn: Callable[[], Awaitable[modal.FunctionCall]]) -> Any:
+    """Run a Modal job at most once at a time per key, sharing its result with concurrent callers.
+
+    The first caller claims `key` in a shared `modal.Dict`, spawns the job and
+    publishes its function call ID; callers arriving while it runs attach to
+    that call and wait for the same result. `modal.Dict` has no atomic
+    put-if-absent, so a claim is only trusted if it is still ours after
+    CLAIM_SETTLE_SECONDS. The claimant renews the lease while it waits, and
+    a lease outlasts the longest job timeout, so a crashed claimant cannot
+    block the key forever and a running job is never spawned twice.
+
+    Args:
+        key: Identifies the shared work, see `flight_key`
+        spawn: Starts the job and returns its function call
+
+    Returns:
+        The job's return value, whether we ran it or attached to it
+    """
+    while True:
+        entry = await inflight_jobs.get.aio(key)
+        if entry is None or entry["expires_at"] < time.time():
+            claim = uuid.uuid4().hex
+            await inflight_jobs.put.aio(key, {"claim": claim, "call_id": None, "expires_at": time.time() + CLAIM_LEASE})
+            await asyncio.sleep(CLAIM_SETTLE_SECONDS)
+            entry = await inflight_jobs.get.aio(key)
+            if entry is None or entry["claim"] != claim:
+                continue
+
+            renewal = None
+            try:
+                call = await spawn()
+                entry.update(call_id=call.object_id, expires_at=time.time() + JOB_LEASE)
+                await inflight_jobs.put.aio(key, entry)
+                renewal = asyncio.create_task(_renew_lease(key, claim))
+                return await call.get.aio()
+            finally:
+                if renewal is not None:
+                    renewal.cancel()
+                await _release(key, claim)
+
+        if entry["call_id"] is None:
+            # Claimed but not yet spawned
+            await asyncio.sleep(POLL_INTERVAL)
+            continue
+
+        print(f"Attaching to in-flight {key} ({entry['call_id']})")
+        try:
+            return await modal.FunctionCall.from_id(entry["call_id"]).get.aio()
+        except modal.exception.OutputExpiredError:
+            # The job finished long ago and its entry was never cleared; run it again
+            await _release(key, entry["claim"])
+
+
+async def _renew_lease(key: str, claim: str):
+    """Keep extending our claim on `key` until cancelled."""
+    while True:
+        await asyncio.sleep(LEASE_RENEW_INTERVAL)
+        entry = await inflight_jobs.get.aio(key)
+        if entry is None or entry["claim"] != claim:
+            return
+        entry["expires_at"] = time.time() + JOB_LEASE
+        await inflight_jobs.put.aio(key, entry)
+
+
+async def _release(key: str, claim: str):
+    """Remove the entry for `key` only if it is still `claim`, never a newer claimant's."""
+    entry = await inflight_jobs.get.aio(key)
+    if entry is None or entry["claim"] != claim:
+        return
+    try:
+        await inflight_jobs.pop.aio(key)
+    except KeyError:
+        pass
+
+
+def coalesce_spawns(spawn_many: Callable[[List[str]], Awaitable[modal.FunctionCall]], window: float = CLAIM_SETTLE_SECONDS) -> Callable[[str], Awaitable[modal.FunctionCall]]:
+    """Merge spawns requested within `window` seconds of each other into one job.
+
+    Pass the returned function's calls as the `spawn` of several concurrent
+    `run_single_flight`s: every key this caller wins is handled by the same
+    job, while keys already in flight elsewhere still attach to their own.
+
+    Args:
+        spawn_many: Starts one job for all the collected items
+        window: How long to wait for further items after the first
+
+    Returns:
+        A per-item spawn function
+    """
+    items: List[str] = []
+    pending: Optional[asyncio.Future] = None
+
+    async def spawn(item: str) -> modal.FunctionCall:
+        nonlocal items, pending
+        items.append(item)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        call = pending = asyncio.get_running_loop().create_future()
+        await asyncio.sleep(window)
+        batch, items, pending = items, [], None
+        try:
+            call.set_result(await spawn_many(batch))
+        except Exception as e:
+            call.set_exception(e)
+        return await call
+
+    return spawn
@@ -0,0 +1,55 @@
+import pytest
+
+from adapter_export import (
+    ADAPTER_CONFIG,
+    ADAPTER_WEIGHTS,
+    EXPORT_FILE,
+    TRAINING_WEIGHTS,
+    strip_checkpoint,
+    validate_adapter_config,
+)
+from common import MAX_LORA_RANK, MODEL_NAME
+
+
+def lora_config(**overrides) -> dict:
+    return {"r": 8, "lora_alpha": 16, "target_modules": ["q_proj", "v_proj"], **overrides}
+
+
+def test_valid_config_gets_the_fields_servers_expect():
+    config = validate_adapter_config(lora_config())
+    assert config["base_model_name_or_path"] == MODEL_NAME
+    assert config["task_type"] == "CAUSAL_LM"
+    assert config["peft_type"] == "LORA"
+
+
+def test_existing_fields_are_not_overwritten():
+    config = validate_adapter_config(lora_config(base_model_name_or_path="/models/base"))
+    assert config["base_model_name_or_path"] == "/models/base"
+
+
+@pytest.mark.parametrize("missing", ["r", "lora_alpha", "target_modules"])
+def test_config_without_lora_parameters_is_rejected(missing):
+    config = lora_config()
+    del config[missing]
+    with pytest.raises(ValueError, match=missing):
+        validate_adapter_config(config)
+
+
+def test_rank_above_the_serving_limit_is_rejected():
+    validate_adapter_config(lora_config(r=MAX_LORA_RANK))
+    with pytest.raises(ValueError, match="exceeds"):
+        validate_adapter_config(lora_config(r=MAX_LORA_RANK + 1))
+
+
+@pytest.mark.parametrize("keep_training_weights", [True, False])
+def test_strip_checkpoint_keeps_only_serving_files(tmp_path, keep_training_weights):
+    for name in (ADAPTER_WEIGHTS, ADAPTER_CONFIG, EXPORT_FILE, TRAINING_WEIGHTS, "tokenizer.json", "LICENSE"):
+        (tmp_path / name).write_bytes(b"x" * 10)
+    (tmp_path / "original").mkdir()
+    (tmp_path / "original" / "tokenizer.model").write_bytes(b"x" * 100)
+
+    freed = strip_checkpoint(tmp_path, keep_training_weights)
+
+    kept = {ADAPTER_WEIGHTS, ADAPTER_CONFIG, EXPORT_FILE} | ({TRAINING_WEIGHTS} if keep_training_weights else set())
+    assert {p.name for p in tmp_path.iterdir()} == kept
+    assert freed == 120 + (0 if keep_training_weights else 10)
@@ -0,0 +1,86 @@
+import threading
+import time
+
+from delivery_dedup import DeliveryDeduplicator, InMemoryDeliveryStore
+
+
+def dedup(store=None, **kwargs):
+    return DeliveryDeduplicator(store=store if store is not None else InMemoryDeliveryStore(), **kwargs)
+
+
+def test_redelivery_is_recognised():
+    deliveries = dedup()
+    assert not deliveries.seen("d1")
+    assert deliveries.seen("d1")
+    assert not deliveries.seen("d2")
+
+
+def test_redelivery_on_another_container_is_recognised():
+    store = InMemoryDeliveryStore()
+    assert not dedup(store).seen("d1")
+    assert dedup(store).seen("d1")
+
+
+def test_seen_does_not_wait_on_the_store():
+    start = time.monotonic()
+    assert not dedup().seen("d1")
+    assert time.monotonic() - start < 0.1
+
+
+def test_concurrent_duplicates_start_one_job():
+    store = InMemoryDeliveryStore()
+    containers = [dedup(store) for _ in range(8)]
+    recorded, started = threading.Barrier(len(containers)), []
+
+    def receive(deliveries):
+        # Every container may accept the delivery, but only one job run gets the ticket
+        accepted = not deliveries.seen("d1")
+        recorded.wait()
+        if accepted:
+            started.append(deliveries.claim_job("d1"))
+
+    threads = [threading.Thread(target=receive, args=(d,)) for d in containers]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert started.count(True) == 1
+    assert not dedup(store).claim_job("d1")
+
+
+def test_forget_lets_a_redelivery_through():
+    store = InMemoryDeliveryStore()
+    deliveries = dedup(store)
+    assert not deliveries.seen("d1")
+    deliveries.forget("d1")
+    assert not deliveries.claim_job("d1")
+    assert not dedup(store).seen("d1")
+    assert deliveries.seen("d1")
+    assert deliveries.claim_job("d1")
+
+
+def test_expired_deliveries_are_accepted_again_and_pruned():
+    store = InMemoryDeliveryStore()
+    now = time.time()
+    store.put("old", now - 7200)  # entry written by an older version
+    store.put("stale", {"claim": "x", "seen_at": now - 7200})
+    store.put("fresh", {"seen_at": now})
+    deliveries = dedup(store, ttl=3600)
+
+    assert deliveries.prune() == 2
+    assert set(store.data) == {"fresh"}
+    assert deliveries.seen("fresh")
+    assert not deliveries.seen("old")
+
+
+def test_local_cache_stays_bounded_with_out_of_order_timestamps():
+    store = InMemoryDeliveryStore()
+    now = time.time()
+    store.put("older", {"claim": "x", "seen_at": now - 600})
+    deliveries = dedup(store, ttl=3600, max_local=2)
+
+    assert not deliveries.seen("new")
+    assert deliveries.seen("older")  # cached with a timestamp older than "new"
+    assert not deliveries.seen("newest")
+    assert len(deliveries.local) == 2
+    assert list(deliveries.local) == ["older", "newest"]
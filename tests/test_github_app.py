@@ -0,0 +1,112 @@
+import asyncio
+import base64
+from datetime import datetime, timezone
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import github_app
+from github_app import JWT_CLOCK_SKEW, JWT_LIFETIME, TOKEN_REFRESH_MARGIN
+
+NOW = 1_700_000_000.0
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = NOW
+
+    def time(self) -> float:
+        return self.now
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, payload: dict):
+        self.status_code = status_code
+        self.payload = payload
+        self.text = ""
+
+    def json(self):
+        return self.payload
+
+
+class FakeGitHub:
+    """Mints installation tokens valid for an hour from the fake clock."""
+
+    def __init__(self, clock: FakeClock):
+        self.clock = clock
+        self.minted = 0
+        self.status_code = 201
+
+    async def post(self, path, token=None, scheme=None):
+        self.minted += 1
+        expires_at = datetime.fromtimestamp(self.clock.now + 3600, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        return FakeResponse(self.status_code, {"token": f"ghs_{self.minted}", "expires_at": expires_at})
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    monkeypatch.setenv("APP_ID", "1234")
+    monkeypatch.setenv("GITHUB_APP_PRIVATE_KEY", base64.b64encode(pem).decode())
+
+    clock = FakeClock()
+    monkeypatch.setattr(github_app, "time", clock)
+    monkeypatch.setattr(github_app, "_jwt", None)
+    monkeypatch.setattr(github_app, "_installation_ids", {})
+    monkeypatch.setattr(github_app, "_installation_tokens", {})
+    return clock
+
+
+@pytest.fixture
+def github(clock, monkeypatch):
+    fake = FakeGitHub(clock)
+    monkeypatch.setattr(github_app, "get_async_github_client", lambda: fake)
+    return fake
+
+
+def test_jwt_is_backdated_and_within_githubs_lifetime(clock):
+    payload = jwt.decode(github_app.app_jwt(), options={"verify_signature": False})
+    assert payload["iss"] == "1234"
+    assert payload["iat"] == NOW - JWT_CLOCK_SKEW
+    assert payload["exp"] == NOW + JWT_LIFETIME - JWT_CLOCK_SKEW
+    assert payload["exp"] - payload["iat"] <= JWT_LIFETIME
+
+
+def test_jwt_is_reused_until_the_clock_skew_margin(clock):
+    first = github_app.app_jwt()
+    expires_at = NOW + JWT_LIFETIME - JWT_CLOCK_SKEW
+
+    clock.now = expires_at - JWT_CLOCK_SKEW - 1
+    assert github_app.app_jwt() == first
+    clock.now = expires_at - JWT_CLOCK_SKEW
+    assert github_app.app_jwt() != first
+
+
+def test_installation_token_is_reused_until_the_refresh_margin(github, clock):
+    def token():
+        return asyncio.run(github_app.get_installation_token("octo", "repo", installation_id=42))
+
+    assert token() == "ghs_1"
+    clock.now = NOW + 3600 - TOKEN_REFRESH_MARGIN - 1
+    assert token() == "ghs_1"
+    clock.now = NOW + 3600 - TOKEN_REFRESH_MARGIN
+    assert token() == "ghs_2"
+    assert github.minted == 2
+
+
+def test_tokens_are_cached_per_installation(github):
+    first = asyncio.run(github_app.get_installation_token("octo", "repo", installation_id=1))
+    second = asyncio.run(github_app.get_installation_token("octo", "other", installation_id=2))
+    assert first != second
+    assert asyncio.run(github_app.get_installation_token("octo", "repo")) == first
+    assert github.minted == 2
+
+
+def test_uninstalled_app_forgets_the_installation(github):
+    github.status_code = 404
+    with pytest.raises(Exception, match="404"):
+        asyncio.run(github_app.get_installation_token("octo", "repo", installation_id=1))
+    assert ("octo", "repo") not in github_app._installation_ids
@@ -0,0 +1,114 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import github_client
+from github_client import (
+    MAX_RETRY_AFTER,
+    AsyncGitHubClient,
+    GitHubClient,
+    close_async_github_client,
+    get_async_github_client,
+)
+
+
+class GitHubStub(BaseHTTPRequestHandler):
+    """Answers with the queued (status, headers) responses, then 200."""
+    protocol_version = "HTTP/1.1"  # keep-alive, so connections can be reused
+    responses = []
+    hits = 0
+
+    def do_GET(self):
+        type(self).hits += 1
+        status, headers = self.responses.pop(0) if self.responses else (200, {})
+        body = b"{}"
+        self.send_response(status)
+        for name, value in {**headers, "Content-Length": str(len(body))}.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    GitHubStub.responses, GitHubStub.hits = [], 0
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), GitHubStub)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_sync_client_reuses_one_connection(server):
+    client = GitHubClient()
+    for _ in range(3):
+        assert client.get(f"{server}/repos/o/r").status_code == 200
+    assert client.stats().as_dict() == {"requests": 3, "connections": 1, "reused": 2, "retries": 0}
+
+
+def test_sync_client_retries_server_errors(server):
+    GitHubStub.responses = [(503, {}), (502, {})]
+    client = GitHubClient()
+    client.adapter.max_retries.backoff_factor = 0
+
+    assert client.get(f"{server}/repos/o/r").status_code == 200
+    assert GitHubStub.hits == 3
+    assert client.stats().retries == 2
+    assert client.stats().requests == 1
+
+
+def test_sync_client_never_retries_a_post(server):
+    GitHubStub.responses = [(503, {})]
+    assert GitHubClient().post(f"{server}/repos/o/r/pulls/1/reviews").status_code == 503
+    assert GitHubStub.hits == 1
+
+
+def test_sync_client_fails_on_a_long_retry_after(server):
+    GitHubStub.responses = [(429, {"Retry-After": str(MAX_RETRY_AFTER + 1)})]
+    response = GitHubClient().get(f"{server}/repos/o/r")
+    assert response.status_code == 429
+    assert GitHubStub.hits == 1
+
+
+def test_async_client_honours_a_short_retry_after_and_fails_on_a_long_one(server, monkeypatch):
+    slept = []
+
+    async def sleep(seconds):
+        slept.append(seconds)
+
+    monkeypatch.setattr(github_client.asyncio, "sleep", sleep)
+
+    async def run():
+        client = AsyncGitHubClient()
+        try:
+            GitHubStub.responses = [(429, {"Retry-After": "2"})]
+            assert (await client.get(f"{server}/repos/o/r")).status_code == 200
+            GitHubStub.responses = [(429, {"Retry-After": str(MAX_RETRY_AFTER + 1)})]
+            assert (await client.get(f"{server}/repos/o/r")).status_code == 429
+            return client.stats()
+        finally:
+            await client.aclose()
+
+    stats = asyncio.run(run())
+    assert slept == [2]
+    assert (stats.requests, stats.retries, stats.connections) == (2, 1, 1)
+
+
+def test_async_clients_are_per_loop_and_closed_on_shutdown():
+    async def client_of_loop():
+        client = get_async_github_client()
+        assert get_async_github_client() is client
+        await close_async_github_client()
+        assert client.client.is_closed
+        return client
+
+    first, second = asyncio.run(client_of_loop()), asyncio.run(client_of_loop())
+    assert first is not second
+    assert len(github_client._async_clients) == 0
@@ -0,0 +1,90 @@
+import asyncio
+import threading
+import time
+
+import inference
+from inference import ReviewGenerator, ReviewRequest
+from inference_engines import create_engine
+
+
+class OverlapCheckingVolume:
+    """Volume fake that records whether a reload ever ran during a commit."""
+
+    def __init__(self):
+        self.active = 0
+        self.overlaps = 0
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def _operation(self):
+        with self.lock:
+            self.active += 1
+            self.calls += 1
+            self.overlaps += self.active > 1
+        time.sleep(0.001)
+        with self.lock:
+            self.active -= 1
+
+    reload = commit = _operation
+
+
+def test_metrics_dumps_never_overlap_adapter_reloads(monkeypatch, tmp_path):
+    volume = OverlapCheckingVolume()
+    monkeypatch.setattr(inference, "output_vol", volume)
+    monkeypatch.setattr(inference, "get_user_checkpoint_path", lambda username, repo_name: tmp_path / username)
+    generator = ReviewGenerator(create_engine("fake"), persist=True)
+    monkeypatch.setattr(generator.metrics, "dump", lambda: None)
+
+    def dump():
+        for _ in range(20):
+            generator.dump_metrics()
+
+    def lookup():
+        for _ in range(20):
+            generator.adapter_for("alice", "octo", "repo")
+
+    threads = [threading.Thread(target=f) for f in (dump, lookup, lookup)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert volume.calls == 60
+    assert volume.overlaps == 0
+
+
+def test_local_generator_never_touches_the_volume(monkeypatch, tmp_path):
+    volume = OverlapCheckingVolume()
+    monkeypatch.setattr(inference, "output_vol", volume)
+    monkeypatch.setattr(inference, "get_user_checkpoint_path", lambda username, repo_name: tmp_path / username)
+    generator = ReviewGenerator(create_engine("fake"), persist=False)
+
+    adapter = generator.adapter_for("alice", "octo", "repo")
+    assert adapter.name == "alice-octo-alice"
+    assert volume.calls == 0
+
+
+def test_review_returns_one_anchored_line_with_a_confidence(tmp_path, monkeypatch):
+    monkeypatch.setattr(inference, "get_user_checkpoint_path", lambda username, repo_name: tmp_path / username)
+    generator = ReviewGenerator(create_engine("fake", token_latency=0), persist=False)
+    hunk = "@@ -1,1 +1,3 @@\n context\n+value = compute()\n+print(value)\n"
+
+    result = asyncio.run(generator.review(hunk, 1, "app.py", "alice"))
+
+    assert result.comment and "\n" not in result.comment
+    assert result.line in (2, 3)
+    assert 0 < result.confidence <= 1
+    assert result.completion_tokens == len(result.comment.split(" "))
+    assert result.prompt_tokens > 0
+    assert generator.metrics.snapshot()["requests"] == 1
+
+
+def test_review_batch_answers_every_request_in_order(tmp_path, monkeypatch):
+    monkeypatch.setattr(inference, "get_user_checkpoint_path", lambda username, repo_name: tmp_path / username)
+    generator = ReviewGenerator(create_engine("fake", token_latency=0), persist=False)
+    requests = [ReviewRequest(f"@@ -1,1 +{n},1 @@\n+x = {n}\n", n, "app.py", user) for n in (5, 9) for user in ("alice", "bob")]
+
+    results = asyncio.run(generator.review_batch(requests))
+
+    assert [r.line for r in results] == [5, 5, 9, 9]
+    assert all(r.comment for r in results)
@@ -0,0 +1,61 @@
+import random
+
+from length_bucketing import LengthBucketedBatchSampler, padding_tokens
+
+
+def random_lengths(n: int = 1000, seed: int = 1):
+    rng = random.Random(seed)
+    return [rng.randint(16, 2048) for _ in range(n)]
+
+
+def test_padding_tokens_pads_each_batch_to_its_longest_example():
+    assert padding_tokens([3, 5, 2, 2], [[0, 1], [2, 3]]) == 2
+
+
+def test_every_example_is_used_once_per_epoch():
+    lengths = random_lengths(103)
+    sampler = LengthBucketedBatchSampler(lengths, batch_size=8, drop_last=False, bucket_batches=4)
+
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == 13
+    assert sorted(i for batch in batches for i in batch) == list(range(103))
+
+
+def test_drop_last_keeps_only_full_batches():
+    sampler = LengthBucketedBatchSampler(random_lengths(103), batch_size=8, bucket_batches=4)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == 12
+    assert all(len(batch) == 8 for batch in batches)
+
+
+def test_bucketing_pads_far_less_than_shuffled_batches():
+    report = LengthBucketedBatchSampler(random_lengths(), batch_size=8).padding_report()
+    assert report.bucketed_padding < report.shuffled_padding / 4
+    assert 0 < report.savings < 1
+
+
+def test_epochs_are_deterministic_but_differ():
+    sampler = LengthBucketedBatchSampler(random_lengths(), batch_size=8, seed=3)
+    assert sampler.batches(0) == sampler.batches(0)
+    assert sampler.batches(0) != sampler.batches(1)
+
+    sampler.set_epoch(1)
+    assert list(sampler) == sampler.batches(1)
+
+
+def test_without_shuffle_batches_are_sorted_within_buckets():
+    lengths = [5, 1, 4, 2, 8, 7, 6, 3]
+    sampler = LengthBucketedBatchSampler(lengths, batch_size=2, shuffle=False, bucket_batches=2)
+    assert list(sampler) == [[1, 3], [2, 0], [7, 6], [5, 4]]
+
+
+def test_drop_last_drops_random_examples_not_the_longest():
+    lengths = list(range(10))
+    sampler = LengthBucketedBatchSampler(lengths, batch_size=4, bucket_batches=10)
+
+    dropped = set()
+    for epoch in range(20):
+        used = [i for batch in sampler.batches(epoch) for i in batch]
+        assert len(used) == len(set(used)) == 8
+        dropped |= set(range(10)) - set(used)
+    assert dropped - {8, 9}
@@ -0,0 +1,132 @@
+import asyncio
+import hashlib
+import json
+import sys
+import types
+
+import pytest
+
+import model_provisioning
+from model_provisioning import (
+    MANIFEST_FILE,
+    READY_FILE,
+    ManifestEntry,
+    model_ready,
+    provision_model,
+    verify_file,
+)
+
+FILES = {"config.json": b'{"hidden_size": 8}', "model.safetensors": b"\x00\x01" * 512}
+LFS_FILES = {"model.safetensors"}
+
+
+def manifest_entry(path: str, content: bytes) -> ManifestEntry:
+    if path in LFS_FILES:
+        return ManifestEntry(path, len(content), sha256=hashlib.sha256(content).hexdigest())
+    git_sha1 = hashlib.sha1(f"blob {len(content)}\0".encode() + content).hexdigest()
+    return ManifestEntry(path, len(content), git_sha1=git_sha1)
+
+
+MANIFEST = {
+    "repo_id": "test/model",
+    "revision": "abc123",
+    "files": [vars(manifest_entry(path, content)) for path, content in FILES.items()],
+}
+
+
+@pytest.fixture
+def hub(monkeypatch):
+    """Fake Hub that serves FILES and records every download."""
+    downloads = []
+
+    def hf_hub_download(repo_id, filename, revision, local_dir, token=None, force_download=False):
+        assert revision == MANIFEST["revision"]
+        downloads.append(filename)
+        (local_dir / filename).write_bytes(FILES[filename])
+
+    monkeypatch.setitem(sys.modules, "huggingface_hub", types.SimpleNamespace(hf_hub_download=hf_hub_download))
+    monkeypatch.setattr(model_provisioning, "fetch_manifest", lambda repo_id, revision, token: MANIFEST)
+    return downloads
+
+
+def test_verify_file_checks_size_and_both_checksum_kinds(tmp_path):
+    for path, content in FILES.items():
+        (tmp_path / path).write_bytes(content)
+        assert verify_file(tmp_path, manifest_entry(path, content))
+
+    (tmp_path / "config.json").write_bytes(b'{"hidden_size": 9}')  # same size, different content
+    assert not verify_file(tmp_path, manifest_entry("config.json", FILES["config.json"]))
+    assert not verify_file(tmp_path, manifest_entry("missing.bin", b""))
+
+
+def test_provisioning_downloads_missing_files_and_writes_the_marker(tmp_path, hub):
+    assert not model_ready(tmp_path)
+
+    report = provision_model(tmp_path, repo_id="test/model")
+
+    assert sorted(hub) == sorted(FILES)
+    assert report.bytes_downloaded == sum(len(c) for c in FILES.values())
+    assert json.loads((tmp_path / READY_FILE).read_text())["revision"] == MANIFEST["revision"]
+    assert json.loads((tmp_path / MANIFEST_FILE).read_text()) == MANIFEST
+    assert model_ready(tmp_path)
+
+
+def test_corrupt_file_is_redownloaded_and_intact_files_reused(tmp_path, hub):
+    provision_model(tmp_path, repo_id="test/model")
+    hub.clear()
+    weights = tmp_path / "model.safetensors"
+    weights.write_bytes(b"\xff" * len(FILES["model.safetensors"]))  # corrupt, but the size still matches
+
+    report = provision_model(tmp_path, repo_id="test/model")
+
+    assert hub == ["model.safetensors"]
+    assert report.reused == 1
+    assert weights.read_bytes() == FILES["model.safetensors"]
+    assert model_ready(tmp_path)
+
+
+def test_model_is_not_ready_without_a_matching_marker(tmp_path, hub):
+    provision_model(tmp_path, repo_id="test/model")
+
+    (tmp_path / "model.safetensors").write_bytes(b"short")
+    assert not model_ready(tmp_path)  # a file no longer has its verified size
+
+    provision_model(tmp_path, repo_id="test/model")
+    marker = tmp_path / READY_FILE
+    marker.write_text(json.dumps({**json.loads(marker.read_text()), "revision": "older"}))
+    assert not model_ready(tmp_path)
+
+    marker.unlink()
+    assert not model_ready(tmp_path)
+
+
+def test_failed_download_leaves_the_model_not_ready(tmp_path, hub, monkeypatch):
+    provision_model(tmp_path, repo_id="test/model")
+    (tmp_path / "config.json").unlink()
+
+    def broken_download(repo_id, filename, revision, local_dir, token=None, force_download=False):
+        (local_dir / filename).write_bytes(b"x" * len(FILES[filename]))
+
+    monkeypatch.setitem(sys.modules, "huggingface_hub", types.SimpleNamespace(hf_hub_download=broken_download))
+    with pytest.raises(IOError):
+        provision_model(tmp_path, repo_id="test/model")
+    assert not (tmp_path / READY_FILE).exists()
+    assert not model_ready(tmp_path)
+
+
+def test_ensure_provisioned_shares_one_job_and_skips_a_ready_model(tmp_path, hub, monkeypatch):
+    flights = []
+
+    async def run_single_flight(key, spawn):
+        flights.append(key)
+        provision_model(tmp_path, repo_id="test/model")
+
+    async def reload():
+        pass
+
+    monkeypatch.setattr(model_provisioning, "run_single_flight", run_single_flight)
+    monkeypatch.setattr(model_provisioning, "output_vol", types.SimpleNamespace(reload=types.SimpleNamespace(aio=reload)))
+
+    asyncio.run(model_provisioning.ensure_model_provisioned(tmp_path))
+    asyncio.run(model_provisioning.ensure_model_provisioned(tmp_path))
+    assert flights == [model_provisioning.PROVISION_KEY]
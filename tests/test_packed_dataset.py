@@ -0,0 +1,87 @@
+from packed_dataset import (
+    CROSS_ENTROPY_IGNORE_IDX,
+    MAX_HOLDOUT_EXAMPLES,
+    MIN_EXAMPLES_FOR_HOLDOUT,
+    PackingStats,
+    examples_path,
+    pack_examples,
+    remove_packed_dataset,
+    split_holdout,
+    without_holdout,
+)
+
+PAD = 0
+
+
+def example(length: int, token: int):
+    return [token] * length, [token] * length
+
+
+def test_packs_are_full_length_and_keep_every_example():
+    examples = [example(length, i + 1) for i, length in enumerate([7, 3, 5, 2, 9, 4])]
+    packs = pack_examples(examples, max_seq_len=10, padding_idx=PAD)
+
+    for pack in packs:
+        assert all(len(pack[field]) == 10 for field in ("tokens", "labels", "input_pos"))
+        assert sum(pack["seq_lens"]) == 10
+    packed_tokens = sorted(t for pack in packs for t in pack["tokens"] if t != PAD)
+    assert packed_tokens == sorted(t for tokens, _ in examples for t in tokens)
+    # First-fit decreasing: 9, 7+3, 5+4, 2
+    assert len(packs) == 4
+
+
+def test_positions_restart_per_example_and_padding_is_ignored():
+    (pack,) = pack_examples([example(3, 1), example(2, 2)], max_seq_len=8, padding_idx=PAD)
+
+    assert pack["seq_lens"] == [3, 2, 3]
+    assert pack["input_pos"][:5] == [0, 1, 2, 0, 1]
+    assert pack["input_pos"][5:] == [2, 3, 4]
+    assert pack["tokens"][5:] == [PAD] * 3
+    assert pack["labels"][5:] == [CROSS_ENTROPY_IGNORE_IDX] * 3
+
+
+def test_exact_fit_has_no_padding_segment():
+    (pack,) = pack_examples([example(4, 1), example(4, 2)], max_seq_len=8, padding_idx=PAD)
+    assert pack["seq_lens"] == [4, 4]
+
+
+def test_small_datasets_are_not_split():
+    examples = list(range(MIN_EXAMPLES_FOR_HOLDOUT - 1))
+    assert split_holdout(examples) == (examples, [])
+
+
+def test_holdout_is_deterministic_disjoint_and_capped():
+    examples = list(range(5000))
+    train, holdout = split_holdout(examples, fraction=0.1)
+
+    assert (train, holdout) == split_holdout(examples, fraction=0.1)
+    assert len(holdout) == MAX_HOLDOUT_EXAMPLES
+    assert sorted(train + holdout) == examples
+
+
+def test_remove_packed_dataset_deletes_every_cached_file(tmp_path):
+    packed_path = tmp_path / "key.pt"
+    files = [packed_path, tmp_path / "key.val.pt", examples_path(packed_path), tmp_path / "key.json"]
+    for path in files:
+        path.write_text("")
+    (tmp_path / "other.pt").write_text("")
+
+    remove_packed_dataset(packed_path)
+    remove_packed_dataset(packed_path)  # already gone
+
+    assert [path.name for path in tmp_path.iterdir()] == ["other.pt"]
+
+
+def test_without_holdout_keeps_only_the_rows_not_held_out():
+    examples = [{"messages": [{"role": "user", "content": str(i)}]} for i in range(5)]
+    stats = PackingStats(examples=3, truncated=0, packs=1, tokens=30, trained_tokens=15, max_seq_len=2048,
+                         validation_examples=2, validation_packs=1, holdout_rows=[1, 4])
+
+    assert without_holdout(examples, stats) == [examples[0], examples[2], examples[3]]
+
+
+def test_holdout_split_by_index_matches_split_by_example():
+    examples = [example(i % 7 + 1, i) for i in range(300)]
+    train_indices, holdout_indices = split_holdout(list(range(len(examples))))
+
+    assert ([examples[i] for i in train_indices], [examples[i] for i in holdout_indices]) == split_holdout(examples)
@@ -0,0 +1,33 @@
+from parsing_helpers import TRUNCATION_NOTICE, choose_anchor_line, extract_added_line_numbers
+
+HUNK = (
+    "@@ -10,4 +10,5 @@\n"
+    " def load(path):\n"
+    "-    data = open(path).read()\n"
+    "+    with open(path) as f:\n"
+    "+        data = f.read()\n"
+    "     return parse(data)\n"
+    "+\n"
+)
+
+
+def test_added_lines_are_numbered_in_the_new_file():
+    assert extract_added_line_numbers(HUNK, 10) == [11, 12, 14]
+
+
+def test_comment_is_anchored_to_the_added_line_it_mentions():
+    assert choose_anchor_line(HUNK, 10, "Why read the data here instead of streaming it?") == 12
+    assert choose_anchor_line(HUNK, 10, "Good use of a context manager for the open file") == 11
+
+
+def test_comment_without_overlap_goes_on_the_first_added_line():
+    assert choose_anchor_line(HUNK, 10, "Nice.") == 11
+
+
+def test_hunk_without_additions_anchors_to_its_start():
+    assert choose_anchor_line("@@ -3,2 +3,1 @@\n keep\n-gone\n", 3, "why remove gone?") == 3
+
+
+def test_lines_after_a_truncation_notice_are_never_chosen():
+    hunk = "@@ -1,1 +1,3 @@\n+first = 1" + TRUNCATION_NOTICE + "+target = 2\n+target = 3\n"
+    assert choose_anchor_line(hunk, 1, "target is wrong") == 1
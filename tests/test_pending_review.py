@@ -0,0 +1,102 @@
+import pytest
+
+import github_actions
+from github_actions import MAX_REVIEW_COMMENTS, PendingReview
+
+
+class FakeResponse:
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+        self.text = ""
+
+
+class FakeGitHub:
+    """Records submitted reviews; rejects any review containing a comment on `bad_line`."""
+
+    def __init__(self, bad_line=None):
+        self.bad_line = bad_line
+        self.reviews = []
+        self.individual = []
+        self.head_lookups = 0
+
+    def post(self, path, token=None, json=None):
+        if any(c["line"] == self.bad_line for c in json["comments"]):
+            return FakeResponse(422)
+        self.reviews.append(json)
+        return FakeResponse(200)
+
+    def post_comment(self, repo_owner, repo_name, pr_number, body, path, line, commenter, token, commit_id=None):
+        if line == self.bad_line:
+            return False
+        self.individual.append((path, line, commit_id))
+        return True
+
+    def head_sha(self, *args):
+        self.head_lookups += 1
+        return "resolved-sha"
+
+
+@pytest.fixture
+def github(monkeypatch):
+    fake = FakeGitHub()
+    monkeypatch.setattr(github_actions, "get_github_client", lambda: fake)
+    monkeypatch.setattr(github_actions, "post_github_comment", fake.post_comment)
+    monkeypatch.setattr(github_actions, "get_pr_head_sha", fake.head_sha)
+    return fake
+
+
+def review_with(count: int, head_sha="head-sha") -> PendingReview:
+    review = PendingReview("octo", "repo", 7, token="t", head_sha=head_sha)
+    for line in range(1, count + 1):
+        review.add("app.py", line, f"comment {line}")
+    return review
+
+
+def test_comments_are_submitted_as_one_review(github):
+    assert review_with(3).submit() == 3
+    (review,) = github.reviews
+    assert review["commit_id"] == "head-sha"
+    assert review["event"] == "COMMENT"
+    assert [c["line"] for c in review["comments"]] == [1, 2, 3]
+    assert github.individual == []
+
+
+def test_large_reviews_are_split_into_chunks(github):
+    assert review_with(2 * MAX_REVIEW_COMMENTS + 1).submit() == 2 * MAX_REVIEW_COMMENTS + 1
+    assert [len(r["comments"]) for r in github.reviews] == [MAX_REVIEW_COMMENTS, MAX_REVIEW_COMMENTS, 1]
+
+
+def test_body_goes_on_the_first_chunk_only(github):
+    review = review_with(0)
+    comments = [{"path": "app.py", "line": n, "side": "RIGHT", "body": "x"} for n in range(MAX_REVIEW_COMMENTS + 1)]
+    review.submit_comments(comments, body="Summary")
+    assert [r.get("body") for r in github.reviews] == ["Summary", None]
+
+
+def test_body_without_comments_is_submitted_on_its_own(github):
+    assert review_with(0).submit_comments([], body="Nothing to flag") == 0
+    assert github.reviews == [{"commit_id": "head-sha", "event": "COMMENT", "comments": [], "body": "Nothing to flag"}]
+
+
+def test_nothing_to_submit_makes_no_request(github):
+    assert review_with(0).submit() == 0
+    assert github.reviews == []
+
+
+def test_rejected_chunk_falls_back_to_individual_comments(github):
+    github.bad_line = 2
+    assert review_with(MAX_REVIEW_COMMENTS + 2).submit() == MAX_REVIEW_COMMENTS + 1
+
+    # The second chunk was accepted as a review; the first was salvaged comment by comment
+    assert [len(r["comments"]) for r in github.reviews] == [2]
+    assert len(github.individual) == MAX_REVIEW_COMMENTS - 1
+    assert all(commit_id == "head-sha" for _, _, commit_id in github.individual)
+
+
+def test_head_sha_is_resolved_once_when_missing(github):
+    review = review_with(1, head_sha=None)
+    review.submit()
+    review.add("app.py", 9, "again")
+    review.submit()
+    assert github.head_lookups == 1
+    assert [r["commit_id"] for r in github.reviews] == ["resolved-sha", "resolved-sha"]
@@ -0,0 +1,88 @@
+import pytest
+
+import pr_snapshot
+from pr_snapshot import MAX_COMPARE_FILES, PRSnapshot, fetch_incremental_snapshot, hunk_key
+
+
+def hunk(start: int, body: str) -> str:
+    return f"@@ -{start},1 +{start},1 @@\n{body}"
+
+
+def snapshot(files: dict) -> PRSnapshot:
+    return PRSnapshot.from_files("octo", "repo", 7, "head", [{"filename": path, "patch": patch} for path, patch in files.items()])
+
+
+def test_hunk_key_ignores_the_header_but_not_the_file():
+    assert hunk_key("a.py", hunk(1, "+x = 1")) == hunk_key("a.py", hunk(40, "+x = 1"))
+    assert hunk_key("a.py", hunk(1, "+x = 1")) != hunk_key("b.py", hunk(1, "+x = 1"))
+    assert hunk_key("a.py", hunk(1, "+x = 1")) != hunk_key("a.py", hunk(1, "+x = 2"))
+
+
+def test_with_hunks_adds_pending_hunks_once():
+    full = snapshot({"a.py": hunk(1, "+a = 1") + "\n" + hunk(20, "+a = 2"), "b.py": hunk(1, "+b = 1")})
+    incremental = snapshot({"a.py": hunk(20, "+a = 2")})
+    pending = [hunk_key("a.py", hunk(20, "+a = 2")), hunk_key("b.py", hunk(1, "+b = 1")), "gone"]
+
+    merged = incremental.with_hunks(full, pending)
+
+    assert [(path, start) for path, start, _ in merged.hunks()] == [("a.py", 20), ("b.py", 1)]
+    assert merged.head_sha == "head"
+    assert incremental.with_hunks(full, []).hunks() == incremental.hunks()
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, payload=None):
+        self.status_code = status_code
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+@pytest.fixture
+def compare(monkeypatch):
+    """Serve one canned compare API response and record the requests made for it."""
+    class FakeGitHub:
+        response = FakeResponse(404)
+        requests = []
+
+        def get(self, path, token=None, params=None):
+            self.requests.append((path, params))
+            return self.response
+
+    github = FakeGitHub()
+    monkeypatch.setattr(pr_snapshot, "get_github_client", lambda: github)
+    return github
+
+
+def pr() -> PRSnapshot:
+    return snapshot({"a.py": hunk(1, "+a = 1"), "b.py": hunk(1, "+b = 1")})
+
+
+def test_incremental_snapshot_keeps_only_pr_files(compare):
+    compare.response = FakeResponse(200, {"status": "ahead", "files": [
+        {"filename": "a.py", "patch": hunk(1, "+a = 1")},
+        {"filename": "merged_from_main.py", "patch": hunk(1, "+m = 1")},
+    ]})
+
+    incremental = fetch_incremental_snapshot(pr(), "base", token="t")
+
+    assert compare.requests == [("/repos/octo/repo/compare/base...head", {"per_page": 1})]
+    assert [f.filename for f in incremental.files] == ["a.py"]
+    assert incremental.head_sha == "head"
+
+
+def test_identical_range_yields_an_empty_snapshot(compare):
+    compare.response = FakeResponse(200, {"status": "identical", "files": []})
+    assert fetch_incremental_snapshot(pr(), "head", token="t").files == []
+
+
+@pytest.mark.parametrize("response", [
+    FakeResponse(404),  # base SHA no longer exists
+    FakeResponse(200, {"status": "diverged", "files": [{"filename": "a.py", "patch": hunk(1, "+a = 1")}]}),
+    FakeResponse(200, {"status": "behind", "files": []}),
+    FakeResponse(200, {"status": "ahead", "files": [{"filename": f"f{i}.py"} for i in range(MAX_COMPARE_FILES)]}),
+])
+def test_unreliable_comparisons_fall_back_to_the_full_pr(compare, response):
+    compare.response = response
+    assert fetch_incremental_snapshot(pr(), "base", token="t") is None
@@ -0,0 +1,145 @@
+import asyncio
+import copy
+import itertools
+
+import pytest
+
+import single_flight
+from common import FINETUNE_BATCH_TIMEOUT, FINETUNE_TIMEOUT, REVIEW_JOB_TIMEOUT, SCRAPE_TIMEOUT
+
+
+class _Method:
+    def __init__(self, fn):
+        self.aio = fn
+
+
+class FakeDict:
+    """In-memory stand-in for `modal.Dict`; values are copied like serialized ones."""
+
+    def __init__(self):
+        self.data = {}
+
+        async def get(key):
+            return copy.deepcopy(self.data.get(key))
+
+        async def put(key, value):
+            self.data[key] = copy.deepcopy(value)
+
+        async def pop(key):
+            return self.data.pop(key)
+
+        self.get, self.put, self.pop = _Method(get), _Method(put), _Method(pop)
+
+
+class FakeCall:
+    _ids = itertools.count()
+
+    def __init__(self, result):
+        self.object_id = f"fc-{next(self._ids)}"
+        self.done = asyncio.Event()
+        self.result = result
+
+        async def get():
+            await self.done.wait()
+            return self.result
+
+        self.get = _Method(get)
+
+
+@pytest.fixture
+def inflight(monkeypatch):
+    store = FakeDict()
+    monkeypatch.setattr(single_flight, "inflight_jobs", store)
+    monkeypatch.setattr(single_flight, "CLAIM_SETTLE_SECONDS", 0.01)
+    monkeypatch.setattr(single_flight, "POLL_INTERVAL", 0.01)
+    return store
+
+
+def attach_to(monkeypatch, calls):
+    monkeypatch.setattr(single_flight.modal.FunctionCall, "from_id", lambda call_id: calls[call_id])
+
+
+def test_job_lease_outlasts_every_job_timeout():
+    assert single_flight.JOB_LEASE > max(SCRAPE_TIMEOUT, FINETUNE_TIMEOUT, FINETUNE_BATCH_TIMEOUT)
+
+
+def test_review_job_outlasts_the_jobs_it_waits_on():
+    assert REVIEW_JOB_TIMEOUT > SCRAPE_TIMEOUT + max(FINETUNE_TIMEOUT, FINETUNE_BATCH_TIMEOUT)
+
+
+def test_concurrent_callers_share_one_job(inflight, monkeypatch):
+    calls = {}
+    attach_to(monkeypatch, calls)
+    spawned = []
+
+    async def spawn():
+        call = FakeCall("trained")
+        calls[call.object_id] = call
+        spawned.append(call)
+        asyncio.get_running_loop().call_later(0.1, call.done.set)
+        return call
+
+    async def main():
+        return await asyncio.gather(*[single_flight.run_single_flight("finetune:o/r:alice", spawn) for _ in range(4)])
+
+    assert asyncio.run(main()) == ["trained"] * 4
+    assert len(spawned) == 1
+    assert inflight.data == {}
+
+
+def test_release_keeps_a_newer_claim(inflight):
+    inflight.data["key"] = {"claim": "newer", "call_id": "fc-x", "expires_at": 0}
+    asyncio.run(single_flight._release("key", "older"))
+    assert inflight.data["key"]["claim"] == "newer"
+
+    asyncio.run(single_flight._release("key", "newer"))
+    assert "key" not in inflight.data
+
+
+def test_claimant_renews_its_lease_while_waiting(inflight, monkeypatch):
+    monkeypatch.setattr(single_flight, "LEASE_RENEW_INTERVAL", 0.02)
+    monkeypatch.setattr(single_flight, "JOB_LEASE", 1000)
+    expiries = []
+
+    async def spawn():
+        call = FakeCall(None)
+        asyncio.get_running_loop().call_later(0.15, call.done.set)
+        return call
+
+    async def watch():
+        while not inflight.data:
+            await asyncio.sleep(0.005)
+        while inflight.data:
+            expiries.append(inflight.data["key"]["expires_at"])
+            await asyncio.sleep(0.01)
+
+    async def main():
+        await asyncio.gather(single_flight.run_single_flight("key", spawn), watch())
+
+    asyncio.run(main())
+    assert len(set(expiries)) > 2  # claim lease, job lease, then renewals
+    assert inflight.data == {}
+
+
+def test_coalesced_spawns_start_one_job(inflight, monkeypatch):
+    calls = {}
+    attach_to(monkeypatch, calls)
+    batches = []
+
+    async def spawn_many(users):
+        batches.append(list(users))
+        call = FakeCall("batch")
+        calls[call.object_id] = call
+        call.done.set()
+        return call
+
+    async def main():
+        spawn = single_flight.coalesce_spawns(spawn_many, window=0.05)
+        return await asyncio.gather(*[
+            single_flight.run_single_flight(f"finetune:o/r:{user}", lambda user=user: spawn(user))
+            for user in ("alice", "bob", "carol")
+        ])
+
+    assert asyncio.run(main()) == ["batch"] * 3
+    assert len(batches) == 1
+    assert sorted(batches[0]) == ["alice", "bob", "carol"]
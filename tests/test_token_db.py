@@ -0,0 +1,48 @@
+import time
+
+import pytest
+from cryptography.fernet import Fernet
+
+import token_db
+from delivery_dedup import InMemoryDeliveryStore
+from token_db import StoredToken, TokenStore
+
+
+@pytest.fixture(autouse=True)
+def encryption_key(monkeypatch):
+    monkeypatch.setenv("ENCRYPTION_KEY", Fernet.generate_key().decode())
+    token_db._fernet.cache_clear()
+    yield
+    token_db._fernet.cache_clear()
+
+
+def test_tokens_are_encrypted_in_the_shared_store():
+    store = InMemoryDeliveryStore()
+    TokenStore(store).put("alice", StoredToken("gho_secret", "ghr_refresh"))
+    assert "gho_secret" not in str(store.data)
+    assert TokenStore(store).get("alice").refresh_token == "ghr_refresh"
+
+
+def test_replaced_token_reaches_other_containers_after_the_cache_ttl():
+    store = InMemoryDeliveryStore()
+    web, worker = TokenStore(store, cache_ttl=0.05), TokenStore(store, cache_ttl=0.05)
+    web.put("alice", StoredToken("old"))
+    assert worker.get("alice").token == "old"
+
+    web.put("alice", StoredToken("new"))
+    assert worker.get("alice").token == "old"  # still cached
+    time.sleep(0.06)
+    assert worker.get("alice").token == "new"
+
+
+def test_validation_is_shared_but_not_applied_to_a_replaced_token():
+    store = InMemoryDeliveryStore()
+    web, worker = TokenStore(store, cache_ttl=0), TokenStore(store, cache_ttl=0)
+    stale = web.put("alice", StoredToken("old"))
+    web.mark_validated("alice", stale)
+    assert worker.get("alice").validated_within(60)
+
+    worker.put("alice", StoredToken("new"))
+    web.mark_validated("alice", stale)
+    assert web.get("alice").token == "new"
+    assert not web.get("alice").validated_within(60)
@@ -0,0 +1,66 @@
+import pytest
+
+from packed_dataset import PACKED_SEQ_LEN
+from training_schedule import (
+    MAX_BATCH_SIZE,
+    MAX_EPOCHS,
+    MAX_GRAD_ACCUM,
+    MAX_TRAIN_TOKENS,
+    MAX_WARMUP_STEPS,
+    MIN_UPDATES_PER_EPOCH,
+    plan_schedule,
+)
+
+
+def trained_tokens(schedule, seq_len=PACKED_SEQ_LEN):
+    return schedule.total_updates * schedule.batch_size * schedule.gradient_accumulation_steps * seq_len
+
+
+def test_empty_dataset_is_rejected():
+    with pytest.raises(ValueError):
+        plan_schedule(0)
+
+
+def test_tiny_dataset_trains_every_pack_for_many_epochs():
+    schedule = plan_schedule(3)
+    assert (schedule.batch_size, schedule.gradient_accumulation_steps) == (3, 1)
+    assert schedule.epochs == MAX_EPOCHS
+    assert schedule.max_steps_per_epoch is None
+
+
+def test_small_dataset_accumulates_less_to_keep_updates_per_epoch():
+    schedule = plan_schedule(40)
+    assert schedule.batch_size == MAX_BATCH_SIZE
+    assert schedule.gradient_accumulation_steps == 1
+    assert schedule.updates_per_epoch == MIN_UPDATES_PER_EPOCH
+
+
+def test_large_dataset_is_capped_by_the_token_budget():
+    for num_packs in (5_000, 100_000):
+        schedule = plan_schedule(num_packs)
+        assert schedule.gradient_accumulation_steps == MAX_GRAD_ACCUM
+        assert schedule.max_steps_per_epoch is not None
+        assert trained_tokens(schedule) <= MAX_TRAIN_TOKENS
+    assert plan_schedule(100_000).epochs == 1
+
+
+def test_token_budget_accounts_for_the_sequence_length():
+    schedule = plan_schedule(50_000, seq_len=256)
+    assert schedule.max_steps_per_epoch is None
+    assert trained_tokens(schedule, seq_len=256) <= MAX_TRAIN_TOKENS
+
+
+def test_warm_started_runs_respect_max_epochs():
+    assert plan_schedule(400, max_epochs=2).epochs == 2
+
+
+def test_warmup_is_a_bounded_share_of_training():
+    for num_packs in (1, 40, 400, 5_000, 100_000):
+        schedule = plan_schedule(num_packs)
+        assert 1 <= schedule.num_warmup_steps <= min(MAX_WARMUP_STEPS, schedule.total_updates)
+
+
+def test_overrides_use_null_for_full_epochs():
+    overrides = plan_schedule(40).as_overrides()
+    assert "max_steps_per_epoch=null" in overrides
+    assert f"batch_size={MAX_BATCH_SIZE}" in overrides
@@ -0,0 +1,60 @@
+from triage import MINIFIED_LINE_LENGTH, classify_hunk, summarize_skipped, triage_hunks
+
+
+def hunk(*lines: str) -> str:
+    return "\n".join(["@@ -1,3 +1,3 @@", *lines])
+
+
+def test_reindented_and_respaced_lines_are_whitespace():
+    text = hunk("-def f(a, b):", "-    return a+b", "+def f(a,  b):", "+", "+\treturn a + b")
+    assert classify_hunk("app.py", 1, text).category == "whitespace"
+
+
+def test_reordered_statements_are_reviewed():
+    swapped = hunk("-a = 1", "-b = a + 1", "+b = a + 1", "+a = 1")
+    assert classify_hunk("app.py", 1, swapped).category == "code"
+
+
+def test_line_moved_past_context_is_reviewed():
+    moved = hunk("-a = 1", " b = a + 1", "+a = 1")
+    assert classify_hunk("app.py", 1, moved).category == "code"
+
+
+def test_no_newline_marker_is_not_content():
+    text = hunk("-x = 1", "\\ No newline at end of file", "+x  =  1")
+    assert classify_hunk("app.py", 1, text).category == "whitespace"
+
+
+def test_skipped_paths():
+    text = hunk("+x = 1")
+    assert classify_hunk("web/package-lock.json", 1, text).category == "lockfile"
+    assert classify_hunk("api/service_pb2.py", 1, text).category == "generated"
+    assert classify_hunk("vendor/lib/x.go", 1, text).category == "vendored"
+    assert classify_hunk("ui/__snapshots__/a.snap", 1, text).category == "snapshot"
+    assert classify_hunk("static/app.min.js", 1, text).category == "minified"
+
+
+def test_content_markers_and_long_lines():
+    assert classify_hunk("models.py", 1, hunk("+# @generated by protoc", "+x = 1")).category == "generated"
+    assert classify_hunk("models.go", 1, hunk("+// Code generated. DO NOT EDIT.")).category == "generated"
+    assert classify_hunk("app.js", 1, hunk("+" + "a" * (MINIFIED_LINE_LENGTH + 1))).category == "minified"
+    assert classify_hunk("app.py", 1, "@@ -1 +1 @@\n context").category == "empty"
+
+
+def test_risky_source_changes_outscore_docs_and_deletions():
+    code = classify_hunk("db.py", 1, hunk("+try:", "+    query(sql)", "+except Exception:", "+    pass"))
+    docs = classify_hunk("README.md", 1, hunk("+one", "+two", "+three", "+four"))
+    deletion = classify_hunk("db.py", 1, hunk("-a()", "-b()", "-c()", "-d()"))
+    assert code.score > docs.score > deletion.score > 0
+
+
+def test_budget_keeps_the_best_hunks_in_pr_order():
+    hunks = [(f"f{i}.py", 1, hunk(*["+x = 1"] * (i + 1))) for i in range(5)]
+    hunks.append(("yarn.lock", 1, hunk("+dep")))
+
+    kept, skipped = triage_hunks(hunks, budget=2)
+
+    assert [t.file_path for t in kept] == ["f3.py", "f4.py"]
+    assert sorted(t.category for t in skipped) == ["lockfile"] + ["over_budget"] * 3
+    assert summarize_skipped(skipped) == "lockfile: 1, over_budget: 3"
+    assert len(triage_hunks(hunks, budget=None)[0]) == 5
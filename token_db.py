@@ -2,53 +2,169 @@ from cryptography.fernet import Fernet
 import modal
 import os
 import json
-from pathlib import Path
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from dataclasses import dataclass, replace
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
 
 from common import (
     VOL_MOUNT_PATH,
+    oauth_tokens,
 )
 
+LEGACY_TOKENS_DIR = VOL_MOUNT_PATH / "tokens"  # earlier layouts: one JSON file per user, then tokens.db
+VALIDATION_TTL = 10 * 60  # seconds a successful `/user` check is trusted
+REFRESH_MARGIN = 5 * 60  # refresh expiring tokens this long before they expire
+CACHE_TTL = 60  # seconds a container trusts its cached token before checking the shared store for a newer one
 
-def store_token(username: str, token: str):
+
+@dataclass(frozen=True)
+class StoredToken:
+    """A user's decrypted OAuth token and what we know about its lifetime."""
+    token: str
+    refresh_token: Optional[str] = None
+    expires_at: Optional[float] = None  # None for tokens that do not expire
+    validated_at: Optional[float] = None
+    version: Optional[float] = None  # when the token was stored; changes whenever it is replaced
+
+    def expires_within(self, seconds: float) -> bool:
+        return self.expires_at is not None and self.expires_at - time.time() < seconds
+
+    def validated_within(self, seconds: float) -> bool:
+        return self.validated_at is not None and time.time() - self.validated_at < seconds
+
+
+@lru_cache(maxsize=1)
+def _fernet() -> Fernet:
     # Get encryption key from Modal secret
-    key = os.environ["ENCRYPTION_KEY"]
-    fernet = Fernet(key)
+    return Fernet(os.environ["ENCRYPTION_KEY"])
+
+
+class TokenStore:
+    """Encrypted OAuth tokens in a shared `modal.Dict`, with a per-container cache.
+
+    Nothing is kept open on the volume, and every container reads and
+    writes the same entries. Decrypted tokens are cached for CACHE_TTL
+    seconds. After that, the entry is fetched again and only decrypted if
+    its version changed, so a token replaced or refreshed in another
+    container is picked up within CACHE_TTL. Tokens from the older on-volume
+    layouts are imported on first lookup.
+    """
+
+    def __init__(self, store=oauth_tokens, cache_ttl: float = CACHE_TTL):
+        self.store = store
+        self.cache_ttl = cache_ttl
+        self.cache: Dict[str, Tuple[StoredToken, float]] = {}  # username -> (token, when it was last checked)
+        self.lock = threading.Lock()
+
+    def _encrypt(self, value: Optional[str]) -> Optional[str]:
+        return _fernet().encrypt(value.encode()).decode() if value else None
+
+    def _decrypt(self, value: Optional[str]) -> Optional[str]:
+        return _fernet().decrypt(value.encode()).decode() if value else None
+
+    def _remember(self, username: str, stored: StoredToken):
+        with self.lock:
+            self.cache[username] = (stored, time.time())
+
+    def put(self, username: str, stored: StoredToken) -> StoredToken:
+        """Store a token, replacing any previous one for the user."""
+        stored = replace(stored, version=time.time())
+        self.store.put(username, {
+            "token": self._encrypt(stored.token),
+            "refresh_token": self._encrypt(stored.refresh_token),
+            "expires_at": stored.expires_at,
+            "validated_at": stored.validated_at,
+            "version": stored.version,
+        })
+        self._remember(username, stored)
+        return stored
+
+    def get(self, username: str) -> Optional[StoredToken]:
+        with self.lock:
+            cached, checked_at = self.cache.get(username, (None, 0.0))
+        if cached is not None and time.time() - checked_at < self.cache_ttl:
+            return cached
+
+        entry = self.store.get(username)
+        if entry is None:
+            with self.lock:
+                self.cache.pop(username, None)
+            legacy = self._load_legacy(username)
+            return self.put(username, legacy) if legacy else None
+
+        if cached is not None and cached.version == entry["version"]:
+            # Same token; only its validation may have been refreshed elsewhere
+            stored = replace(cached, validated_at=entry["validated_at"])
+        else:
+            stored = StoredToken(
+                self._decrypt(entry["token"]), self._decrypt(entry["refresh_token"]),
+                entry["expires_at"], entry["validated_at"], entry["version"],
+            )
+        self._remember(username, stored)
+        return stored
+
+    def _load_legacy(self, username: str) -> Optional[StoredToken]:
+        legacy_path = LEGACY_TOKENS_DIR / f"{username}.json"
+        if legacy_path.exists():
+            with open(legacy_path) as f:
+                return StoredToken(self._decrypt(json.load(f)["token"]))
+
+        db_path = LEGACY_TOKENS_DIR / "tokens.db"
+        if db_path.exists():
+            # Open read-only and close straight away; open files on the volume block `reload()`
+            with closing(sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)) as conn:
+                row = conn.execute(
+                    "SELECT token, refresh_token, expires_at FROM tokens WHERE username = ?", (username,)
+                ).fetchone()
+            if row is not None:
+                return StoredToken(self._decrypt(row[0]), self._decrypt(row[1]), row[2])
+        return None
+
+    def mark_validated(self, username: str, stored: StoredToken):
+        """Record that GitHub accepted `stored` just now, unless it has been replaced since."""
+        entry = self.store.get(username)
+        if entry is None or entry["version"] != stored.version:
+            return
+        validated_at = time.time()
+        self.store.put(username, {**entry, "validated_at": validated_at})
+        self._remember(username, replace(stored, validated_at=validated_at))
+
+    def evict(self, username: str):
+        """Drop a cached token, e.g. one GitHub rejected, so the next lookup rereads the shared store."""
+        with self.lock:
+            self.cache.pop(username, None)
+
+
+token_store = TokenStore()
+
 
+def store_token(username: str, token: str, refresh_token: Optional[str] = None, expires_in: Optional[int] = None) -> StoredToken:
     """Store an encrypted GitHub token for a user"""
-    path = Path(f"{VOL_MOUNT_PATH}/tokens/{username}.json")
-    path.parent.mkdir(parents=True, exist_ok=True)
-    
-    encrypted = fernet.encrypt(token.encode())
-    with open(path, "w") as f:
-        json.dump({"token": encrypted.decode()}, f)
-
-def load_token(username: str) -> str:
+    expires_at = time.time() + expires_in if expires_in else None
+    return token_store.put(username, StoredToken(token, refresh_token, expires_at, validated_at=time.time()))
+
+
+def load_token(username: str) -> Optional[str]:
     """Load and decrypt a user's GitHub token"""
-    # Get encryption key from Modal secret
-    key = os.environ["ENCRYPTION_KEY"]
-    fernet = Fernet(key)
+    stored = token_store.get(username)
+    return stored.token if stored else None
 
-    path = Path(f"{VOL_MOUNT_PATH}/tokens/{username}.json")
-    if not path.exists():
-        return None
-        
-    with open(path) as f:
-        data = json.load(f)
-        return fernet.decrypt(data["token"].encode()).decode()
-    
-from fastapi import HTTPException
-import requests
 
-async def refresh_token(username: str, old_token: str):
-    """Attempt to refresh an expired token"""
-    # Get encryption key from Modal secret
+from fastapi import HTTPException
+from github_client import get_async_github_client
+import asyncio
 
+async def refresh_token(username: str, old_refresh_token: str) -> Optional[StoredToken]:
+    """Exchange a refresh token for a new access token and store it"""
     client_id = os.environ["GITHUB_CLIENT_ID"]
     client_secret = os.environ["GITHUB_CLIENT_SECRET"]
 
     try:
-        # Try to get a new token using the old one
-        response = requests.post(
+        response = await get_async_github_client().post(
             "https://github.com/login/oauth/access_token",
             headers={
                 "Accept": "application/json"
@@ -56,46 +172,57 @@ async def refresh_token(username: str, old_token: str):
             data={
                 "client_id": client_id,
                 "client_secret": client_secret,
-                "refresh_token": old_token
+                "grant_type": "refresh_token",
+                "refresh_token": old_refresh_token
             }
         )
-        
+
         if response.status_code == 200:
-            new_token = response.json().get("access_token")
+            data = response.json()
+            new_token = data.get("access_token")
             if new_token:
-                store_token(username, new_token)
-                return new_token
-    except:
-        pass
-    
+                return await asyncio.to_thread(
+                    store_token, username, new_token, data.get("refresh_token"), data.get("expires_in")
+                )
+    except Exception as e:
+        print(f"Failed to refresh token for {username}: {e}")
+
     return None
 
-async def get_github_token(username: str):
-    """Dependency to get and validate GitHub token"""
-    # Get encryption key from Modal secret
+async def validated_token(username: str) -> Optional[str]:
+    """Return the user's token if GitHub accepts it, refreshing it first when it is about to expire.
+
+    A successful validation is trusted for VALIDATION_TTL, so most calls make
+    no request to GitHub at all.
+    """
+    stored = await asyncio.to_thread(token_store.get, username)
+    if stored is None:
+        return None
+
+    if stored.refresh_token and stored.expires_within(REFRESH_MARGIN):
+        stored = await refresh_token(username, stored.refresh_token) or stored
+
+    if stored.validated_within(VALIDATION_TTL):
+        return stored.token
 
-    token = load_token(username)
-    if not token:
-        await refresh_token(username, token)
-    
-    # Verify token is still valid
     try:
-        response = requests.get(
-            "https://api.github.com/user",
-            headers={
-                "Authorization": f"token {token}",
-                "Accept": "application/vnd.github.v3+json"
-            }
-        )
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=401,
-                detail="Token expired. Please re-authenticate at /auth/github/login"
-            )
-    except:
+        response = await get_async_github_client().get("/user", token=stored.token)
+    except Exception as e:
+        print(f"Failed to validate token for {username}: {e}")
+        return None
+    if response.status_code == 200:
+        await asyncio.to_thread(token_store.mark_validated, username, stored)
+        return stored.token
+    if response.status_code == 401:
+        token_store.evict(username)
+    return None
+
+async def get_github_token(username: str):
+    """Dependency to get and validate GitHub token"""
+    token = await validated_token(username)
+    if token is None:
         raise HTTPException(
             status_code=401,
             detail="Token invalid. Please re-authenticate at /auth/github/login"
         )
-    
     return token
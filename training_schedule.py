@@ -0,0 +1,81 @@
+import math
+from dataclasses import dataclass
+from typing import List, Optional
+
+from packed_dataset import PACKED_SEQ_LEN
+
+MAX_BATCH_SIZE = 4  # packed sequences per micro-batch that fit on an H100 with activation checkpointing
+MAX_GRAD_ACCUM = 8
+MIN_UPDATES_PER_EPOCH = 10  # accumulate less on small datasets so each epoch still takes this many optimizer steps
+TARGET_UPDATES = 300  # optimizer steps to aim for across all epochs
+MAX_EPOCHS = 10
+MAX_TRAIN_TOKENS = 15_000_000  # keeps the largest datasets well inside finetune()'s timeout
+WARMUP_FRACTION = 0.05
+MAX_WARMUP_STEPS = 100
+EARLY_STOPPING_PATIENCE = 1  # epochs without validation improvement before stopping
+
+
+@dataclass
+class TrainingSchedule:
+    """Training hyperparameters derived from the size of a packed dataset."""
+    epochs: int
+    batch_size: int
+    gradient_accumulation_steps: int
+    max_steps_per_epoch: Optional[int]  # optimizer steps; None runs full epochs
+    num_warmup_steps: int
+    updates_per_epoch: int
+
+    @property
+    def total_updates(self) -> int:
+        return self.epochs * self.updates_per_epoch
+
+    def as_overrides(self) -> List[str]:
+        """torchtune command-line overrides for this schedule."""
+        return [
+            f"epochs={self.epochs}",
+            f"batch_size={self.batch_size}",
+            f"gradient_accumulation_steps={self.gradient_accumulation_steps}",
+            f"max_steps_per_epoch={'null' if self.max_steps_per_epoch is None else self.max_steps_per_epoch}",
+            f"lr_scheduler.num_warmup_steps={self.num_warmup_steps}",
+        ]
+
+
+def plan_schedule(num_packs: int, seq_len: int = PACKED_SEQ_LEN, max_epochs: int = MAX_EPOCHS) -> TrainingSchedule:
+    """Choose batch size, accumulation, epochs and warmup for `num_packs` training sequences.
+
+    Small datasets get small effective batches and many epochs, so they still
+    see enough optimizer steps and finish in minutes; large datasets get full
+    accumulation, few epochs and no per-epoch step cap until they approach
+    MAX_TRAIN_TOKENS. Early stopping on the held-out split ends training
+    sooner once validation loss stops improving.
+
+    Args:
+        num_packs: Number of packed training sequences
+        seq_len: Tokens per packed sequence
+        max_epochs: Upper bound on epochs, lower for warm-started runs
+
+    Returns:
+        The schedule to pass to the recipe
+    """
+    if num_packs < 1:
+        raise ValueError("Cannot plan a schedule for an empty dataset")
+
+    batch_size = min(MAX_BATCH_SIZE, num_packs)
+    micro_batches = num_packs // batch_size  # the recipe drops the last incomplete batch
+
+    grad_accum = 1
+    while grad_accum < MAX_GRAD_ACCUM and micro_batches // (grad_accum * 2) >= MIN_UPDATES_PER_EPOCH:
+        grad_accum *= 2
+    updates_per_epoch = max(1, micro_batches // grad_accum)
+
+    epochs = max(1, min(max_epochs, math.ceil(TARGET_UPDATES / updates_per_epoch)))
+
+    tokens_per_update = batch_size * grad_accum * seq_len
+    max_updates = max(1, MAX_TRAIN_TOKENS // tokens_per_update)
+    max_steps_per_epoch = None
+    if epochs * updates_per_epoch > max_updates:
+        max_steps_per_epoch = max(1, max_updates // epochs)
+        updates_per_epoch = max_steps_per_epoch
+
+    warmup = min(MAX_WARMUP_STEPS, max(1, round(WARMUP_FRACTION * epochs * updates_per_epoch)))
+    return TrainingSchedule(epochs, batch_size, grad_accum, max_steps_per_epoch, warmup, updates_per_epoch)
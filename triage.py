@@ -0,0 +1,162 @@
+from dataclasses import dataclass
+from fnmatch import fnmatch
+from typing import List, Optional, Tuple
+import math
+import re
+
+
+MAX_REVIEWED_HUNKS = 40  # per-PR budget of hunks sent to the model
+
+# Path patterns of files nobody wants review comments on
+SKIPPED_PATH_PATTERNS = {
+    "lockfile": [
+        "*package-lock.json", "*yarn.lock", "*pnpm-lock.yaml", "*poetry.lock", "*Pipfile.lock",
+        "*uv.lock", "*Cargo.lock", "*Gemfile.lock", "*composer.lock", "*go.sum", "*mix.lock",
+    ],
+    "generated": [
+        "*_pb2.py", "*_pb2_grpc.py", "*.pb.go", "*.pb.cc", "*.pb.h", "*.g.dart", "*.generated.*",
+        "*/generated/*", "generated/*", "*/__generated__/*", "*.designer.cs",
+    ],
+    "vendored": ["vendor/*", "*/vendor/*", "third_party/*", "*/third_party/*", "node_modules/*", "*/node_modules/*"],
+    "snapshot": ["*/__snapshots__/*", "*.snap", "*.ambr"],
+    "minified": ["*.min.js", "*.min.css", "*.map", "*.bundle.js"],
+}
+
+GENERATED_MARKERS = re.compile(r"@generated|DO NOT EDIT|auto-generated|autogenerated", re.IGNORECASE)
+MINIFIED_LINE_LENGTH = 300  # average added line length above which a hunk is treated as minified
+
+# Relative value of a comment, by kind of file
+PATH_WEIGHTS = [
+    (["*.md", "*.rst", "*.txt", "*.adoc", "LICENSE*", "CHANGELOG*"], 0.3),
+    (["*.json", "*.yaml", "*.yml", "*.toml", "*.ini", "*.cfg"], 0.5),
+    (["test_*", "*_test.*", "*/tests/*", "tests/*", "*.spec.*", "*.test.*"], 0.7),
+]
+RISKY_TOKENS = re.compile(r"\b(except|catch|raise|throw|lock|thread|async|await|sql|query|password|secret|token|eval|exec|TODO|FIXME)\b")
+
+
+@dataclass
+class TriagedHunk:
+    """A hunk with the triage stage's verdict on it."""
+    file_path: str
+    new_start: int
+    hunk_text: str
+    category: str  # "code" for reviewable hunks, otherwise why it was skipped
+    score: float
+
+    @property
+    def skipped(self) -> bool:
+        return self.category != "code"
+
+
+def classify_path(file_path: str) -> Optional[str]:
+    """Return the skip category of a path, or None if it looks like reviewable source."""
+    for category, patterns in SKIPPED_PATH_PATTERNS.items():
+        if any(fnmatch(file_path, pattern) for pattern in patterns):
+            return category
+    return None
+
+
+def diff_lines(hunk_text: str) -> Tuple[List[str], List[str]]:
+    """Return the (added, removed) line contents of a hunk, without their markers."""
+    added, removed = [], []
+    for line in hunk_text.splitlines()[1:]:
+        if line.startswith('+'):
+            added.append(line[1:])
+        elif line.startswith('-'):
+            removed.append(line[1:])
+    return added, removed
+
+
+def hunk_sides(hunk_text: str) -> Tuple[List[str], List[str]]:
+    """Return the (old, new) versions of a hunk's lines, context included, in order."""
+    old, new = [], []
+    for line in hunk_text.splitlines()[1:]:
+        if line.startswith('-'):
+            old.append(line[1:])
+        elif line.startswith('+'):
+            new.append(line[1:])
+        elif not line.startswith('\\'):  # "\ No newline at end of file"
+            old.append(line[1:])
+            new.append(line[1:])
+    return old, new
+
+
+def _without_whitespace(lines: List[str]) -> List[str]:
+    return [s for s in ("".join(line.split()) for line in lines) if s]
+
+
+def _only_whitespace_changed(hunk_text: str) -> bool:
+    # Compared in order: a hunk that only moves lines around still changes behaviour
+    old, new = hunk_sides(hunk_text)
+    return _without_whitespace(old) == _without_whitespace(new)
+
+
+def path_weight(file_path: str) -> float:
+    for patterns, weight in PATH_WEIGHTS:
+        if any(fnmatch(file_path, pattern) for pattern in patterns):
+            return weight
+    return 1.0
+
+
+def classify_hunk(file_path: str, new_start: int, hunk_text: str) -> TriagedHunk:
+    """Classify and score a single hunk using its path, diff statistics and content."""
+    category = classify_path(file_path)
+    added, removed = diff_lines(hunk_text)
+
+    if category is None:
+        if not added and not removed:
+            category = "empty"
+        elif GENERATED_MARKERS.search(hunk_text):
+            category = "generated"
+        elif added and sum(map(len, added)) / len(added) > MINIFIED_LINE_LENGTH:
+            category = "minified"
+        elif _only_whitespace_changed(hunk_text):
+            category = "whitespace"
+
+    if category is not None:
+        return TriagedHunk(file_path, new_start, hunk_text, category, 0.0)
+
+    # Bigger changes in source files are worth more; pure deletions have
+    # nothing to anchor a comment to, so they go last.
+    score = path_weight(file_path) * math.log1p(len(added) + 0.5 * len(removed))
+    score += 0.5 * len(RISKY_TOKENS.findall("\n".join(added)))
+    if not added:
+        score *= 0.1
+    return TriagedHunk(file_path, new_start, hunk_text, "code", score)
+
+
+def triage_hunks(
+    hunks: List[Tuple[str, int, str]],
+    budget: Optional[int] = MAX_REVIEWED_HUNKS
+) -> Tuple[List[TriagedHunk], List[TriagedHunk]]:
+    """Decide which of a PR's hunks are worth sending to the model.
+
+    Args:
+        hunks: (file_path, new_start, hunk_text) for every hunk in the PR
+        budget: Maximum number of hunks to keep, highest scores first
+
+    Returns:
+        (kept, skipped); kept hunks stay in their original PR order
+    """
+    triaged = [classify_hunk(*hunk) for hunk in hunks]
+    candidates = [t for t in triaged if not t.skipped]
+    skipped = [t for t in triaged if t.skipped]
+
+    if budget is not None and len(candidates) > budget:
+        ranked = sorted(range(len(candidates)), key=lambda i: candidates[i].score, reverse=True)
+        keep = set(ranked[:budget])
+        for i, t in enumerate(candidates):
+            if i not in keep:
+                t.category = "over_budget"
+        skipped += [t for i, t in enumerate(candidates) if i not in keep]
+        candidates = [t for i, t in enumerate(candidates) if i in keep]
+
+    return candidates, skipped
+
+
+def summarize_skipped(skipped: List[TriagedHunk]) -> str:
+    """One-line summary of skipped hunks by category, e.g. "lockfile: 3, whitespace: 1"."""
+    counts: dict[str, int] = {}
+    for t in skipped:
+        counts[t.category] = counts.get(t.category, 0) + 1
+    return ", ".join(f"{category}: {count}" for category, count in sorted(counts.items()))